@@ -0,0 +1,213 @@
+"""
+按客户端密钥的准入控制
+
+每个客户端密钥有自己的并发上限（client.json 中的 max_concurrency，未设置时用
+ADMISSION_KEY_CONCURRENCY），整个worker还有一个总并发上限 ADMISSION_MAX_CONCURRENCY。
+超出上限的请求进入该密钥自己的等待队列（最多 ADMISSION_QUEUE_SIZE 个，最多等待
+ADMISSION_QUEUE_TIMEOUT 秒），队列满或等待超时时返回429。
+
+有名额空出来时按加权公平的方式挑选下一个放行的密钥（stride调度）：每个密钥维护一个
+虚拟时间，每放行一个请求前进 1/weight，总是放行虚拟时间最小的密钥。
+一个密钥积压再多请求，也只是让它自己的队列变长，不会把其他密钥挤出去。
+
+只在事件循环线程中使用，不加锁。
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from api_keys import KeyInfo
+import metrics
+from metrics import Histogram, format_labels, render_histogram
+
+# 排队耗时的桶边界（秒），从几毫秒到队列超时
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class AdmissionRejected(Exception):
+    """请求未被放行：队列已满或排队超时"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _KeyState:
+    """单个密钥的并发计数、等待队列和统计"""
+
+    def __init__(self, key: KeyInfo):
+        self.key = key
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.pass_value = 0.0  # stride调度的虚拟时间
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds = Histogram(WAIT_BUCKETS)
+
+
+class AdmissionTicket:
+    """已放行请求持有的名额；release() 可重复调用（流式响应的生成器和后台任务都会调用）"""
+
+    __slots__ = ("_controller", "_state", "_released")
+
+    def __init__(self, controller: "AdmissionController", state: _KeyState):
+        self._controller = controller
+        self._state = state
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self._state)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency: Optional[int] = None, key_concurrency: Optional[int] = None,
+                 queue_size: Optional[int] = None, queue_timeout: Optional[float] = None):
+        # 0 表示不限制
+        self.max_concurrency = max_concurrency if max_concurrency is not None else int(os.getenv("ADMISSION_MAX_CONCURRENCY", "256"))
+        self.key_concurrency = key_concurrency if key_concurrency is not None else int(os.getenv("ADMISSION_KEY_CONCURRENCY", "64"))
+        self.queue_size = queue_size if queue_size is not None else int(os.getenv("ADMISSION_QUEUE_SIZE", "128"))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+        self.active = 0
+        self.waiting = 0
+        self._states: Dict[str, _KeyState] = {}
+        self._virtual_time = 0.0
+
+    def _state(self, key: KeyInfo) -> _KeyState:
+        state = self._states.get(key.digest)
+        if state is None:
+            state = self._states[key.digest] = _KeyState(key)
+        else:
+            # client.json 重载后使用新的上限和权重
+            state.key = key
+        return state
+
+    def _limit(self, state: _KeyState) -> int:
+        return state.key.max_concurrency or self.key_concurrency
+
+    def _has_capacity(self, state: _KeyState) -> bool:
+        limit = self._limit(state)
+        if limit and state.active >= limit:
+            return False
+        return not self.max_concurrency or self.active < self.max_concurrency
+
+    async def acquire(self, key: KeyInfo) -> AdmissionTicket:
+        """等待一个名额，队列满或超时时抛出 AdmissionRejected"""
+        state = self._state(key)
+        # 每次释放名额后都会先分给排队的请求，所以这里仍有空闲名额时不会插到别人前面
+        if not state.waiters and self._has_capacity(state):
+            self._grant(state)
+            state.wait_seconds.observe(0.0)
+            return AdmissionTicket(self, state)
+
+        if len(state.waiters) >= self.queue_size:
+            state.rejected += 1
+            raise AdmissionRejected(f"Too many queued requests for API key '{key.label}'")
+
+        if not state.waiters:
+            # 刚开始积压的密钥从当前虚拟时间起步，空闲期间不积累额度
+            state.pass_value = max(state.pass_value, self._virtual_time)
+        future = asyncio.get_running_loop().create_future()
+        state.waiters.append(future)
+        state.queued += 1
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 放行和超时/取消同时发生：名额已经分配，归还给下一个排队的请求
+                self._release(state)
+            else:
+                state.waiters.remove(future)
+                self.waiting -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                state.timed_out += 1
+                raise AdmissionRejected(
+                    f"API key '{key.label}' waited {self.queue_timeout:g}s without a free slot"
+                ) from None
+            raise
+        state.wait_seconds.observe(time.perf_counter() - started)
+        return AdmissionTicket(self, state)
+
+    def _grant(self, state: _KeyState) -> None:
+        state.active += 1
+        state.admitted += 1
+        self.active += 1
+
+    def _release(self, state: _KeyState) -> None:
+        state.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """把空出来的名额按加权公平顺序分给排队的密钥"""
+        while self.waiting:
+            chosen = None
+            for state in self._states.values():
+                if state.waiters and self._has_capacity(state):
+                    if chosen is None or state.pass_value < chosen.pass_value:
+                        chosen = state
+            if chosen is None:
+                return
+            future = chosen.waiters.popleft()
+            self.waiting -= 1
+            self._virtual_time = chosen.pass_value
+            chosen.pass_value += 1.0 / chosen.key.weight
+            self._grant(chosen)
+            future.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        keys = {}
+        for state in self._states.values():
+            keys[state.key.label] = {
+                "active": state.active,
+                "queue_depth": len(state.waiters),
+                "limit": self._limit(state),
+                "weight": state.key.weight,
+                "admitted": state.admitted,
+                "queued": state.queued,
+                "rejected": state.rejected,
+                "timed_out": state.timed_out,
+                "wait_seconds": state.wait_seconds.to_dict(),
+            }
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "key_concurrency": self.key_concurrency,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.queue_timeout,
+            "keys": keys,
+        }
+
+    def collect(self) -> List[str]:
+        """按密钥输出并发、排队深度、拒绝次数和排队耗时（Prometheus文本格式）"""
+        families = (
+            ("cb2api_admission_active", "gauge", "按客户端密钥的进行中请求数", "active"),
+            ("cb2api_admission_queue_depth", "gauge", "按客户端密钥的排队请求数", "queue_depth"),
+            ("cb2api_admission_rejected_total", "counter", "队列已满被拒绝的请求数", "rejected"),
+            ("cb2api_admission_timed_out_total", "counter", "排队超时被拒绝的请求数", "timed_out"),
+        )
+        lines = []
+        for name, kind, help_text, field in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for state in self._states.values():
+                value = len(state.waiters) if field == "queue_depth" else getattr(state, field)
+                lines.append(f"{name}{format_labels({'key': state.key.label})} {value}")
+        lines.append("# HELP cb2api_admission_wait_seconds 按客户端密钥的排队耗时")
+        lines.append("# TYPE cb2api_admission_wait_seconds histogram")
+        for state in self._states.values():
+            lines.extend(render_histogram("cb2api_admission_wait_seconds", {"key": state.key.label}, state.wait_seconds))
+        return lines
+
+
+admission = AdmissionController()
+metrics.COLLECTORS.append(admission.collect)
@@ -0,0 +1,147 @@
+"""
+客户端API密钥索引
+
+client.json 中的密钥加载后只保存 SHA-256 摘要：校验时对请求里的密钥做一次哈希再查字典，
+与密钥数量无关，内存和共享状态里也不会出现明文密钥。
+
+client.json 兼容原来的字符串列表，也可以为每个密钥附加元数据：
+
+    [
+        "sk-plain",
+        {"key": "sk-team-a", "label": "team-a", "max_concurrency": 8, "weight": 2, "models": ["claude-4.0"]},
+        {"key": "sk-batch", "label": "batch", "coalesce_ms": 20, "coalesce_bytes": 4096},
+        {"key_sha256": "9f86d08...", "label": "ci"}
+    ]
+
+- label: 日志和统计中使用的名称，默认取摘要前8位
+- max_concurrency: 该密钥允许的最大并发请求数，0 表示使用默认值（见 admission.py）
+- weight: worker满载时排队调度的权重，默认 1，权重为2的密钥获得两倍的放行机会
+- models: 允许使用的模型列表，省略表示不限制
+- coalesce_ms / coalesce_bytes: 流式响应中细碎增量的合并窗口和字节预算，省略时使用
+  SSE_COALESCE_MS / SSE_COALESCE_BYTES 环境变量的默认值，coalesce_ms 为0表示不合并（见 stream_buffer.py）
+
+只想在磁盘上保存摘要时，用 `python api_keys.py <密钥>` 生成对应的条目。
+"""
+import hashlib
+import sys
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+import json_codec
+
+
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class KeyInfo:
+    """单个客户端密钥的元数据（不含明文密钥）"""
+
+    __slots__ = ("digest", "label", "max_concurrency", "weight", "models", "coalesce_ms", "coalesce_bytes")
+
+    def __init__(self, digest: str, label: Optional[str] = None, max_concurrency: int = 0,
+                 models: Optional[Iterable[str]] = None, weight: float = 1.0,
+                 coalesce_ms: Optional[float] = None, coalesce_bytes: Optional[int] = None):
+        self.digest = digest
+        self.label = label or digest[:8]
+        self.max_concurrency = max_concurrency
+        self.weight = weight
+        self.models: Optional[FrozenSet[str]] = frozenset(models) if models is not None else None
+        # None 表示使用全局默认值
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+
+    def allows_model(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def to_dict(self) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {"key_sha256": self.digest, "label": self.label}
+        if self.max_concurrency:
+            entry["max_concurrency"] = self.max_concurrency
+        if self.weight != 1.0:
+            entry["weight"] = self.weight
+        if self.models is not None:
+            entry["models"] = sorted(self.models)
+        if self.coalesce_ms is not None:
+            entry["coalesce_ms"] = self.coalesce_ms
+        if self.coalesce_bytes is not None:
+            entry["coalesce_bytes"] = self.coalesce_bytes
+        return entry
+
+
+class ApiKeyIndex:
+    """摘要 -> KeyInfo 的只读索引；重载时整体替换，不在原对象上修改"""
+
+    def __init__(self, keys: Iterable[KeyInfo] = ()):
+        self._keys: Dict[str, KeyInfo] = {info.digest: info for info in keys}
+
+    @classmethod
+    def from_config(cls, data: Any) -> "ApiKeyIndex":
+        """解析 client.json 的内容（也用于共享状态中的 config:api_keys），格式错误时抛出 ValueError"""
+        if not isinstance(data, list):
+            raise ValueError("client.json 必须是密钥列表")
+        return cls(_parse_entry(entry, i) for i, entry in enumerate(data))
+
+    def lookup(self, api_key: Optional[str]) -> Optional[KeyInfo]:
+        if not api_key:
+            return None
+        return self._keys.get(hash_api_key(api_key))
+
+    def to_entries(self) -> List[Dict[str, Any]]:
+        """导出为不含明文的条目列表，可再次用 from_config 解析"""
+        return [info.to_dict() for info in self._keys.values()]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys.values())
+
+
+def _parse_entry(entry: Any, index: int) -> KeyInfo:
+    if isinstance(entry, str):
+        return KeyInfo(hash_api_key(entry))
+    if not isinstance(entry, dict):
+        raise ValueError(f"第 {index} 个密钥条目格式无效: {type(entry).__name__}")
+
+    if entry.get("key"):
+        digest = hash_api_key(entry["key"])
+    elif entry.get("key_sha256"):
+        digest = str(entry["key_sha256"]).lower()
+        if len(digest) != 64:
+            raise ValueError(f"第 {index} 个密钥条目的 key_sha256 不是有效的SHA-256摘要")
+    else:
+        raise ValueError(f"第 {index} 个密钥条目缺少 key 或 key_sha256")
+
+    weight = float(entry.get("weight", 1))
+    if weight <= 0:
+        raise ValueError(f"第 {index} 个密钥条目的 weight 必须大于0")
+    models = entry.get("models")
+    if models is not None and not isinstance(models, list):
+        raise ValueError(f"第 {index} 个密钥条目的 models 必须是列表")
+    coalesce_ms = entry.get("coalesce_ms")
+    if coalesce_ms is not None:
+        coalesce_ms = float(coalesce_ms)
+        if coalesce_ms < 0:
+            raise ValueError(f"第 {index} 个密钥条目的 coalesce_ms 不能为负数")
+    coalesce_bytes = entry.get("coalesce_bytes")
+    if coalesce_bytes is not None:
+        coalesce_bytes = int(coalesce_bytes)
+        if coalesce_bytes <= 0:
+            raise ValueError(f"第 {index} 个密钥条目的 coalesce_bytes 必须大于0")
+    return KeyInfo(
+        digest,
+        label=entry.get("label"),
+        max_concurrency=int(entry.get("max_concurrency") or 0),
+        models=models,
+        weight=weight,
+        coalesce_ms=coalesce_ms,
+        coalesce_bytes=coalesce_bytes
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python api_keys.py <密钥> [label]")
+        sys.exit(1)
+    info = KeyInfo(hash_api_key(sys.argv[1]), label=sys.argv[2] if len(sys.argv) > 2 else None)
+    print(json_codec.dumps(info.to_dict()).decode("utf-8"))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+上游HTTP/2多路复用基准
+
+以HTTPS启动模拟后端（hypercorn，ALPN支持h2和http/1.1），用 main.create_upstream_client() 创建的
+上游客户端同时打开 N 个流式请求，分别在HTTP/1.1（默认）和 UPSTREAM_POOL_HTTP2=1 下运行，对比：
+- 新建的上游连接数（cb2api_upstream_connections_total）和峰值时连接池中的连接数
+- 客户端进程的内存增量（VmHWM - 发请求前的VmRSS）
+- 首字节时间（TTFB）p50/p95/p99 和全部流结束的总耗时
+
+每种模式在单独的子进程中运行，内存数据互不影响。两种模式的连接池上限都是 --streams，
+HTTP/1.1下每个并发流占用一条TCP+TLS连接。
+
+用法（需要 pip install hypercorn h2）:
+    python benchmarks/bench_http2_upstream.py
+    python benchmarks/bench_http2_upstream.py --streams 200 --mock-tokens 50 --mock-token-rate 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.append(ROOT)
+sys.path.append(BENCH_DIR)
+
+import httpx
+
+from load_driver import free_port, percentile, proc_memory_kb
+
+FIXTURES = os.path.join(ROOT, "test_fixtures")
+CERTFILE = os.path.join(FIXTURES, "tls_localhost.crt")
+KEYFILE = os.path.join(FIXTURES, "tls_localhost.key")
+
+
+async def one_stream(client: httpx.AsyncClient, url: str, started: float) -> float:
+    """发送一个流式请求并读完响应，返回TTFB（从整批开始计时）"""
+    body = {"model": "mock-model", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+    ttfb = 0.0
+    async with client.stream("POST", url, json=body) as response:
+        response.raise_for_status()
+        async for _ in response.aiter_bytes():
+            if not ttfb:
+                ttfb = time.perf_counter() - started
+    return ttfb
+
+
+async def run_streams(streams: int, url: str) -> Dict[str, Any]:
+    import main
+    import metrics
+    from http_pool import get_pool_stats
+
+    client = main.create_upstream_client()
+    baseline = proc_memory_kb(os.getpid()).get("VmRSS", 0)
+    peak = {"connections": 0}
+
+    async def sample():
+        while True:
+            stats = get_pool_stats(client)
+            peak["connections"] = max(peak["connections"], stats["in_use"] + stats["idle"])
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    try:
+        ttfbs = await asyncio.gather(*(one_stream(client, url, started) for _ in range(streams)))
+    finally:
+        sampler.cancel()
+    wall = time.perf_counter() - started
+    memory = proc_memory_kb(os.getpid())
+    await client.aclose()
+
+    connections = {protocol: int(counter.value) for (_, protocol), counter in metrics.UPSTREAM_CONNECTIONS._children.items()}
+    return {
+        "connections": connections,
+        "peak_pool_connections": peak["connections"],
+        "memory_kb": memory.get("VmHWM", 0) - baseline,
+        "ttfb_ms": [percentile(ttfbs, pct) * 1000 for pct in (50, 95, 99)],
+        "wall_s": wall,
+    }
+
+
+def child(args):
+    """子进程：按环境变量创建上游客户端并运行一批流"""
+    # main.py 导入时会在当前目录创建日志文件，放到临时目录中
+    os.chdir(tempfile.mkdtemp(prefix="bench-h2-"))
+    import logging
+    import log_pipeline
+
+    log_pipeline.shutdown_logging()
+    logging.getLogger().handlers = [logging.NullHandler()]
+    result = asyncio.run(run_streams(args.streams, args.url))
+    print(json.dumps(result))
+
+
+def run_mode(args, url: str, http2: bool) -> Dict[str, Any]:
+    env = {
+        **os.environ,
+        # 让 main.create_upstream_ssl_context() 信任测试证书
+        "SSL_CERT_FILE": CERTFILE,
+        "UPSTREAM_POOL_HTTP2": "1" if http2 else "0",
+        "UPSTREAM_POOL_MAX_CONNECTIONS": str(args.streams),
+        "UPSTREAM_POOL_MAX_KEEPALIVE": str(args.streams),
+        "UPSTREAM_POOL_HTTP2_MAX_STREAMS": str(args.h2_max_streams),
+    }
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "--url", url,
+                             "--streams", str(args.streams)], env=env, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="上游HTTP/2多路复用基准")
+    parser.add_argument("--streams", type=int, default=500, help="同时打开的流数")
+    parser.add_argument("--h2-max-streams", type=int, default=100, help="每个HTTP/2连接的最大并发流数（客户端和模拟后端）")
+    parser.add_argument("--mock-tokens", type=int, default=100, help="每个流的token数")
+    parser.add_argument("--mock-token-rate", type=float, default=50, help="每个流每秒的token数，使所有流同时处于打开状态")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    port = free_port()
+    env = {**os.environ, "MOCK_TOKENS": str(args.mock_tokens), "MOCK_TOKEN_RATE": str(args.mock_token_rate)}
+    backend = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_backend.py"), "--port", str(port),
+                                "--certfile", CERTFILE, "--keyfile", KEYFILE, "--h2-max-streams", str(args.h2_max_streams)],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"https://localhost:{port}/v2/chat/completions"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                httpx.get(f"https://localhost:{port}/", verify=CERTFILE, timeout=1.0)
+                break
+            except httpx.HTTPError:
+                if backend.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("模拟后端启动失败（是否安装了 hypercorn？）")
+                time.sleep(0.1)
+
+        results = {"HTTP/1.1": run_mode(args, url, http2=False), "HTTP/2": run_mode(args, url, http2=True)}
+    finally:
+        backend.terminate()
+        backend.wait()
+
+    print(f"{args.streams} 个并发流，每个 {args.mock_tokens} tokens @ {args.mock_token_rate:g} tokens/s")
+    print(f"{'模式':<10} {'新建连接':>16} {'峰值连接':>8} {'内存增量':>10} {'TTFB p50/p95/p99 (ms)':>26} {'总耗时':>8}")
+    for mode, result in results.items():
+        connections = ", ".join(f"{protocol}={count}" for protocol, count in sorted(result["connections"].items()))
+        ttfb = "/".join(f"{value:.0f}" for value in result["ttfb_ms"])
+        print(f"{mode:<10} {connections:>16} {result['peak_pool_connections']:>8} "
+              f"{result['memory_kb'] / 1024:>8.1f}MB {ttfb:>26} {result['wall_s']:>7.2f}s")
+
+
+if __name__ == "__main__":
+    main_bench()
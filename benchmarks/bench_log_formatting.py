@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+热路径日志参数格式化微基准
+
+对比请求热路径上两种写日志的方式在大请求体下的开销：
+- eager：改动前的写法，f-string 和 str(content)[:100] 预览在调用 logger 之前就构造好；
+- lazy：log_pipeline.request_logger 门面 + preview()，级别未开启或请求未采样时什么都不做。
+
+覆盖 transform_messages（system消息内容预览，改动前的消息处理见 bench_message_normalizer.py）
+和 forward_request（请求头和请求体预览）两处，
+分别在 INFO（调试日志关闭）和 DEBUG + 未采样请求（LOG_SAMPLE_RATE<1）两种配置下计时。
+
+用法:
+    python benchmarks/bench_log_formatting.py
+    python benchmarks/bench_log_formatting.py --prompt-kb 64 --prompt-kb 1024 --repeat 200
+"""
+import argparse
+import logging
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# main.py 导入时会在当前目录创建日志文件，放到临时目录中
+os.chdir(tempfile.mkdtemp(prefix="bench-log-"))
+
+import json_codec
+import log_pipeline
+from log_pipeline import BoundedQueueHandler, RequestContextFilter, begin_request, end_request, preview
+from bench_message_normalizer import old_fix_tool_call_sequence, old_transform_messages
+
+logger = logging.getLogger("bench.eager")
+request_log = log_pipeline.request_logger("bench.lazy")
+
+
+def make_messages(prompt_kb: int) -> List[Dict]:
+    """一条system消息（内容块列表）+ 若干轮对话，总大小约 prompt_kb KB"""
+    block = {"type": "text", "text": "系统提示 " * 64}
+    blocks = [block] * max(1, prompt_kb * 1024 // len(json_codec.dumps(block)))
+    return [
+        {"role": "system", "content": blocks},
+        {"role": "user", "content": "你好"},
+        {"role": "assistant", "content": "你好，有什么可以帮忙？"},
+        {"role": "system", "content": "x" * (prompt_kb * 256)},
+        {"role": "user", "content": "继续"},
+    ]
+
+
+def eager_transform_messages(messages: List[Dict], request_id: str) -> List[Dict]:
+    """改动前 transform_messages 的日志写法（消息转换逻辑相同）"""
+    messages = old_fix_tool_call_sequence(messages, request_id)
+    transformed_messages = []
+    system_to_user_count = 0
+    for i, message in enumerate(messages):
+        transformed_message = message.copy()
+        if message.get("role") == "system":
+            transformed_message["role"] = "user"
+            system_to_user_count += 1
+            logger.debug(f"[{request_id}] 将第 {i + 1} 条消息从 system 转换为 user")
+            content = message.get("content", "")
+            if isinstance(content, str):
+                content_preview = content[:100] + "..." if len(content) > 100 else content
+            else:
+                content_preview = str(content)[:100] + "..." if len(str(content)) > 100 else str(content)
+            logger.debug(f"[{request_id}] 转换内容预览: {content_preview}")
+        transformed_messages.append(transformed_message)
+    if system_to_user_count > 0:
+        logger.info(f"[{request_id}] 总共转换了 {system_to_user_count} 条 system 消息为 user 消息")
+    return transformed_messages
+
+
+def eager_forward_logs(url: str, headers: Dict[str, str], body: bytes) -> None:
+    """改动前 forward_request 的调试日志"""
+    logger.debug(f"Forwarding request to: {url}")
+    logger.debug(f"Headers: {headers}")
+    logger.debug(f"Body: {body[:500]}...")
+
+
+def lazy_forward_logs(url: str, headers: Dict[str, str], body: bytes) -> None:
+    request_log.debug("Forwarding request to: %s", url)
+    request_log.debug("Headers: %s", headers)
+    request_log.debug("Body: %s", preview(body, 500))
+
+
+def time_call(func: Callable[[], None], repeat: int) -> float:
+    """返回单次调用耗时中位数（微秒）"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1e6
+
+
+def configure(level: int) -> QueueListener:
+    """日志走和生产相同的队列+过滤器，输出丢弃，只测事件循环线程上的开销"""
+    handler = BoundedQueueHandler(queue.Queue(maxsize=100000))
+    handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    listener = QueueListener(handler.queue, logging.NullHandler())
+    listener.start()
+    return listener
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="热路径日志参数格式化微基准")
+    parser.add_argument("--prompt-kb", type=int, action="append", help="请求体大小（KB，可重复），默认 16/256/1024")
+    parser.add_argument("--repeat", type=int, default=50, help="每项计时次数，取中位数")
+    args = parser.parse_args()
+
+    log_pipeline.shutdown_logging()
+    sizes = args.prompt_kb or [16, 256, 1024]
+    headers = {"authorization": "Bearer sk-bench", "content-type": "application/json", "accept": "text/event-stream"}
+    url = "http://127.0.0.1:8000/v1/chat/completions"
+    configs = [("INFO", logging.INFO, 1.0), ("DEBUG+未采样", logging.DEBUG, 0.0)]
+
+    print(f"{'请求体':>8} {'配置':<14} {'路径':<20} {'eager(us)':>11} {'lazy(us)':>10} {'节省':>7}")
+    for prompt_kb in sizes:
+        messages = make_messages(prompt_kb)
+        body = json_codec.dumps({"model": "m", "messages": messages})
+        for config_name, level, sample_rate in configs:
+            listener = configure(level)
+            token = begin_request("bench", sample_rate=sample_rate)
+            try:
+                cases = [
+                    ("transform_messages",
+                     lambda: eager_transform_messages(messages, "bench"),
+                     lambda: old_transform_messages(messages, "bench")),
+                    ("forward_request日志",
+                     lambda: eager_forward_logs(url, headers, body),
+                     lambda: lazy_forward_logs(url, headers, body)),
+                ]
+                for name, eager, lazy in cases:
+                    eager_us = time_call(eager, args.repeat)
+                    lazy_us = time_call(lazy, args.repeat)
+                    saved = 1 - lazy_us / eager_us if eager_us else 0.0
+                    print(f"{prompt_kb:>6}KB {config_name:<14} {name:<20} {eager_us:>11.1f} {lazy_us:>10.1f} {saved:>6.0%}")
+            finally:
+                end_request(token)
+                listener.stop()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+消息规范化微基准
+
+在长的agent对话（默认2000条消息：多轮工具调用、插入的用户消息、穿插的system提醒）上对比：
+- reference：改动前的 fix_tool_call_sequence + transform_messages（复制每条消息）+ insert(0, 占位消息)，
+  原样复制在本文件中（含日志）；
+- normalize_messages：main.py 中的单遍实现。
+
+输出单次调用耗时中位数和 tracemalloc 峰值内存。
+
+用法:
+    python benchmarks/bench_message_normalizer.py
+    python benchmarks/bench_message_normalizer.py --messages 2000 --messages 20000 --repeat 50
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# main.py 导入时会在当前目录创建日志文件，放到临时目录中
+os.chdir(tempfile.mkdtemp(prefix="bench-normalize-"))
+
+import log_pipeline
+from log_pipeline import preview
+from main import normalize_messages
+
+request_log = log_pipeline.request_logger("main")
+
+
+def old_fix_tool_call_sequence(messages: List[Dict], request_id: str) -> List[Dict]:
+    """改动前的 main.fix_tool_call_sequence（原样保留，含日志）"""
+    if not messages:
+        return messages
+
+    fixed_messages = []
+    i = 0
+
+    while i < len(messages):
+        current_msg = messages[i]
+
+        # 检查是否是assistant的tool_calls消息
+        if (current_msg.get("role") == "assistant" and
+            current_msg.get("tool_calls")):
+
+            # 收集所有工具调用ID
+            expected_tool_ids = {tc.get("id") for tc in current_msg.get("tool_calls", []) if tc.get("id")}
+
+            # 添加tool_calls消息
+            fixed_messages.append(current_msg)
+            i += 1
+
+            # 查找对应的tool_result消息
+            tool_results = []
+            found_tool_ids = set()
+            potential_interrupts = []
+
+            # 收集后续消息直到找到所有tool_result或遇到新的assistant消息
+            while i < len(messages):
+                next_msg = messages[i]
+
+                # 如果是tool_result消息
+                if (next_msg.get("role") == "tool" and
+                    next_msg.get("tool_call_id")):
+                    tool_call_id = next_msg.get("tool_call_id")
+
+                    # 验证tool_call_id是否匹配
+                    if tool_call_id in expected_tool_ids:
+                        tool_results.append(next_msg)
+                        found_tool_ids.add(tool_call_id)
+                        request_log.debug("[%s] 找到匹配的tool_result: %s", request_id, tool_call_id)
+                    else:
+                        request_log.warning("[%s] 发现不匹配的tool_result ID: %s", request_id, tool_call_id)
+                        # 仍然添加，但记录警告
+                        tool_results.append(next_msg)
+
+                    i += 1
+
+                # 如果是用户消息，暂存（无论是中断还是其他原因）
+                elif next_msg.get("role") == "user":
+                    potential_interrupts.append(next_msg)
+                    request_log.debug("[%s] 检测到插入的用户消息，暂存", request_id)
+                    i += 1
+                    continue
+
+                # 如果遇到新的assistant消息，停止收集
+                elif next_msg.get("role") == "assistant":
+                    break
+                else:
+                    # 其他类型消息，停止收集
+                    break
+
+            # 处理插入的消息：无论是中断还是其他原因，都需要重新排列
+            if potential_interrupts:
+                request_log.info("[%s] 检测到 %d 个插入消息，将其移到tool_result之后", request_id, len(potential_interrupts))
+
+                # 验证工具调用完整性
+                missing_tools = expected_tool_ids - found_tool_ids
+                if missing_tools:
+                    request_log.warning("[%s] 缺少工具调用结果: %s", request_id, missing_tools)
+
+                    # 如果缺少工具结果，可能需要特殊处理
+                    # 但仍然要保持消息序列的正确性
+                    pass
+
+            # 添加所有找到的tool_result消息
+            fixed_messages.extend(tool_results)
+
+            # 将插入的消息放在tool_result之后（保持API规范的同时不丢失消息）
+            fixed_messages.extend(potential_interrupts)
+
+            if tool_results:
+                request_log.info("[%s] 修复工具调用序列：找到 %d 个tool_result，预期 %d 个", request_id, len(tool_results), len(expected_tool_ids))
+            if potential_interrupts:
+                request_log.info("[%s] 将 %d 个插入消息移到tool_result之后", request_id, len(potential_interrupts))
+        else:
+            # 普通消息，直接添加
+            fixed_messages.append(current_msg)
+            i += 1
+
+    return fixed_messages
+
+
+def old_transform_messages(messages: List[Dict], request_id: str) -> List[Dict]:
+    """改动前的 main.transform_messages（原样保留，含日志）"""
+    # 首先修复工具调用序列
+    messages = old_fix_tool_call_sequence(messages, request_id)
+
+    transformed_messages = []
+    system_to_user_count = 0
+
+    for i, message in enumerate(messages):
+        transformed_message = message.copy()
+
+        if message.get("role") == "system":
+            transformed_message["role"] = "user"
+            system_to_user_count += 1
+            request_log.debug("[%s] 将第 %d 条消息从 system 转换为 user", request_id, i + 1)
+            # 记录转换的内容（只显示前100个字符）
+            request_log.debug("[%s] 转换内容预览: %s", request_id, preview(message.get("content", ""), 100))
+
+        transformed_messages.append(transformed_message)
+
+    if system_to_user_count > 0:
+        request_log.info("[%s] 总共转换了 %d 条 system 消息为 user 消息", request_id, system_to_user_count)
+    else:
+        request_log.info("[%s] 没有发现需要转换的 system 消息", request_id)
+
+    return transformed_messages
+
+
+def reference_normalize(messages: List[Dict], request_id: str) -> List[Dict]:
+    """改动前 prepare_codebuddy_body 中的消息处理"""
+    transformed_messages = old_transform_messages(messages, request_id)
+    transformed_messages.insert(0, {"role": "system", "content": '.'})
+    return transformed_messages
+
+
+def agent_transcript(count: int, seed: int) -> List[Dict]:
+    """模拟agent对话：用户提问后连续多轮工具调用，偶尔有用户插话和system提醒"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "你是一个编程助手。" * 50}]
+    n = 0
+    while len(messages) < count:
+        messages.append({"role": "user", "content": "请修改代码 " * rng.randint(5, 50)})
+        for _ in range(rng.randint(1, 8)):
+            n += 1
+            call_ids = [f"call_{n}_{k}" for k in range(rng.randint(1, 3))]
+            messages.append({
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {"id": call_id, "type": "function", "function": {"name": "read_file", "arguments": '{"path": "main.py"}'}}
+                    for call_id in call_ids
+                ],
+            })
+            for k, call_id in enumerate(call_ids):
+                messages.append({"role": "tool", "tool_call_id": call_id, "content": "文件内容 " * rng.randint(20, 200)})
+                if k == 0 and rng.random() < 0.1:
+                    messages.append({"role": "user", "content": "等一下，先看另一个文件"})
+            if rng.random() < 0.1:
+                messages.append({"role": "system", "content": "<system-reminder>注意上下文长度</system-reminder>"})
+        messages.append({"role": "assistant", "content": "已完成修改。"})
+    return messages[:count]
+
+
+def measure(func: Callable[[], object], repeat: int):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(samples) * 1e6, peak
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="消息规范化微基准")
+    parser.add_argument("--messages", type=int, action="append", help="对话消息条数（可重复），默认 200/2000/20000")
+    parser.add_argument("--repeat", type=int, default=30, help="每项计时次数，取中位数")
+    parser.add_argument("--seed", type=int, default=18)
+    args = parser.parse_args()
+
+    # 生产默认 INFO 级别，日志输出丢弃
+    log_pipeline.shutdown_logging()
+    logging.getLogger().handlers = [logging.NullHandler()]
+    logging.getLogger().setLevel(logging.INFO)
+
+    print(f"{'消息数':>8} {'实现':<20} {'耗时(us)':>10} {'峰值内存(KB)':>14}")
+    for count in args.messages or [200, 2000, 20000]:
+        messages = agent_transcript(count, args.seed)
+        assert normalize_messages(messages, "bench") == reference_normalize(messages, "bench")
+        results = [
+            ("reference", measure(lambda: reference_normalize(messages, "bench"), args.repeat)),
+            ("normalize_messages", measure(lambda: normalize_messages(messages, "bench"), args.repeat)),
+        ]
+        for name, (elapsed_us, peak) in results:
+            print(f"{count:>8} {name:<20} {elapsed_us:>10.1f} {peak / 1024:>14.1f}")
+        speedup = results[0][1][0] / results[1][1][0]
+        print(f"{count:>8} {'加速比':<20} {speedup:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+对话前缀缓存微基准
+
+模拟一次agent会话：每一轮客户端重新发送完整历史（新解析的JSON），末尾追加一次工具调用和工具结果。
+对每一轮计时 server.py 路径上的消息处理：
+- convert_anthropic_to_openai（format_proxy 的前缀缓存）
+- normalize_messages（main 的前缀缓存）
+分别在关闭缓存（PREFIX_CACHE_ENABLED=0 的效果）和开启缓存时运行，按历史长度输出单轮耗时。
+开启缓存后转换只处理新增的消息，但每一轮仍要序列化整个历史并按字节确认前缀，
+单轮耗时依然随历史长度线性增长，只是斜率更低（1000~2000条消息时约1.7~1.8倍加速）。
+
+用法:
+    python benchmarks/bench_prefix_cache.py
+    python benchmarks/bench_prefix_cache.py --turns 1000 --report-every 200
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# main.py 导入时会在当前目录创建日志文件，放到临时目录中
+os.chdir(tempfile.mkdtemp(prefix="bench-prefix-"))
+
+import format_proxy
+import json_codec
+import log_pipeline
+import main
+from prefix_cache import PrefixCache
+
+
+def turn_messages(i: int) -> List[Dict]:
+    """一轮agent交互：assistant调用工具，user返回工具结果"""
+    return [
+        {"role": "assistant", "content": [
+            {"type": "text", "text": f"我来查看第 {i} 个文件。"},
+            {"type": "tool_use", "id": f"toolu_{i:05d}", "name": "read_file",
+             "input": {"path": f"src/module_{i}.py", "offset": 0, "limit": 200}},
+        ]},
+        {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i:05d}", "content": f"# module {i}\n" + "def f():\n    pass\n" * 20},
+        ]},
+    ]
+
+
+def run_session(turns: int, report_every: int, enabled: bool) -> Dict[int, float]:
+    """返回 {历史消息数: 最近 report_every 轮的单轮耗时中位数（微秒）}"""
+    format_proxy.conversion_cache = PrefixCache("bench_conversion", enabled=enabled)
+    main.normalize_cache = PrefixCache("bench_normalize", enabled=enabled)
+    history = [{"role": "user", "content": "请帮我重构这个项目"}]
+    raw_system = "你是一个编程助手。" * 100
+    samples = []
+    results = {}
+    for i in range(turns):
+        history.extend(turn_messages(i))
+        # 每一轮都是新解析的请求体，不复用上一轮的对象
+        request = json_codec.loads(json_codec.dumps({"model": "claude", "system": raw_system, "messages": history}))
+        started = time.perf_counter()
+        openai_req = format_proxy.convert_anthropic_to_openai(request)
+        main.normalize_messages(openai_req["messages"], "bench")
+        samples.append(time.perf_counter() - started)
+        if (i + 1) % report_every == 0:
+            results[len(history)] = statistics.median(samples[-report_every:]) * 1e6
+    return results
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="对话前缀缓存微基准")
+    parser.add_argument("--turns", type=int, default=500, help="会话轮数（每轮新增2条消息）")
+    parser.add_argument("--report-every", type=int, default=100, help="每隔多少轮输出一次")
+    args = parser.parse_args()
+
+    # 生产默认 INFO 级别，日志输出丢弃
+    log_pipeline.shutdown_logging()
+    logging.getLogger().handlers = [logging.NullHandler()]
+    logging.getLogger().setLevel(logging.INFO)
+
+    uncached = run_session(args.turns, args.report_every, enabled=False)
+    cached = run_session(args.turns, args.report_every, enabled=True)
+    print(f"{'历史消息数':>10} {'无缓存(us)':>12} {'前缀缓存(us)':>14} {'加速比':>8}")
+    for length, elapsed in uncached.items():
+        print(f"{length:>10} {elapsed:>12.1f} {cached[length]:>14.1f} {elapsed / cached[length]:>7.1f}x")
+    print("缓存统计:")
+    print("  convert_anthropic_to_openai:", format_proxy.conversion_cache.get_stats())
+    print("  normalize_messages:", main.normalize_cache.get_stats())
+
+
+if __name__ == "__main__":
+    main_bench()
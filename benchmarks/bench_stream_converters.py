@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+流式转换器微基准
+
+把录制的OpenAI / Anthropic SSE转录通过伪造的 httpx.Response 回放给
+stream_openai_to_anthropic、stream_anthropic_to_openai 和 stream_response_handler，
+统计 事件/秒、字节/秒、内存分配和单事件延迟p99，并可保存/对比基线JSON。
+
+用法:
+    python benchmarks/bench_stream_converters.py
+    python benchmarks/bench_stream_converters.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_stream_converters.py --compare benchmarks/baseline.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+import format_proxy
+import json_codec
+from sse_transcripts import load_transcripts
+
+# 转换器名 -> (输入格式, 构造输出流的函数)
+CONVERTERS: Dict[str, Any] = {
+    "openai_to_anthropic": ("openai", lambda chunks: format_proxy.stream_openai_to_anthropic(fake_response(chunks))),
+    "anthropic_to_openai": ("anthropic", lambda chunks: format_proxy.stream_anthropic_to_openai(fake_response(chunks))),
+    "response_handler": ("anthropic", lambda chunks: format_proxy.stream_response_handler(replay(chunks))),
+}
+
+# 用于回归判断的指标及方向（True 表示越大越好）
+COMPARED_METRICS = {"events_per_sec": True, "bytes_per_sec": True, "p99_event_us": False, "alloc_peak_kb": False}
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    """按录制时的分块回放的字节流"""
+
+    def __init__(self, chunks: List[bytes]):
+        self._chunks = chunks
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for chunk in self._chunks:
+            yield chunk
+
+
+async def replay(chunks: List[bytes]) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+def fake_response(chunks: List[bytes]) -> httpx.Response:
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=ReplayStream(chunks))
+
+
+def rechunk(events: List[bytes], chunk_size: int) -> List[bytes]:
+    """chunk_size 为0时每个事件一个chunk（上游逐事件flush），否则按固定大小切分模拟TCP读取"""
+    if chunk_size <= 0:
+        return events
+    data = b"".join(events)
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+async def drain(make_stream: Callable, chunks: List[bytes]) -> int:
+    count = 0
+    async for _ in make_stream(chunks):
+        count += 1
+    return count
+
+
+async def timed_drain(make_stream: Callable, chunks: List[bytes]) -> List[int]:
+    """返回相邻两次输出之间的耗时（纳秒）"""
+    gaps = []
+    last = time.perf_counter_ns()
+    async for _ in make_stream(chunks):
+        now = time.perf_counter_ns()
+        gaps.append(now - last)
+        last = now
+    return gaps
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_case(make_stream: Callable, events: List[bytes], chunk_size: int, repeat: int) -> Dict[str, Any]:
+    chunks = rechunk(events, chunk_size)
+    input_bytes = sum(len(c) for c in chunks)
+
+    # 预热
+    output_events = asyncio.run(drain(make_stream, chunks))
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asyncio.run(drain(make_stream, chunks))
+        durations.append(time.perf_counter() - start)
+    elapsed = statistics.median(durations)
+
+    gaps = asyncio.run(timed_drain(make_stream, chunks))
+
+    # 分配统计单独跑一遍，避免tracemalloc开销影响计时
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    blocks_before = sys.getallocatedblocks()
+    asyncio.run(drain(make_stream, chunks))
+    blocks_after = sys.getallocatedblocks()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "input_events": len(events),
+        "output_events": output_events,
+        "input_bytes": input_bytes,
+        "seconds": round(elapsed, 6),
+        "events_per_sec": round(len(events) / elapsed, 1),
+        "bytes_per_sec": round(input_bytes / elapsed, 1),
+        "p50_event_us": round(percentile(gaps, 50) / 1000.0, 2),
+        "p99_event_us": round(percentile(gaps, 99) / 1000.0, 2),
+        "alloc_peak_kb": round(peak / 1024.0, 1),
+        "alloc_retained_blocks": blocks_after - blocks_before,
+    }
+
+
+def run_all(args) -> Dict[str, Any]:
+    transcripts = load_transcripts()
+    results = {}
+    for scenario, formats in transcripts.items():
+        if args.scenario and scenario not in args.scenario:
+            continue
+        for name, (fmt, make_stream) in CONVERTERS.items():
+            if args.converter and name not in args.converter:
+                continue
+            if fmt not in formats:
+                continue
+            key = f"{scenario}/{name}"
+            results[key] = run_case(make_stream, formats[fmt], args.chunk_size, args.repeat)
+            r = results[key]
+            print(f"{key:<45} {r['events_per_sec']:>12,.0f} ev/s {r['bytes_per_sec'] / 1e6:>8.2f} MB/s "
+                  f"p99 {r['p99_event_us']:>8.1f}us  峰值 {r['alloc_peak_kb']:>9.1f}KB")
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """返回超出容差的回归项"""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get("results", {}).get(key)
+        if not previous:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{key} {metric}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式转换器微基准")
+    parser.add_argument("--scenario", action="append", help="只运行指定场景（可重复）")
+    parser.add_argument("--converter", action="append", choices=list(CONVERTERS), help="只运行指定转换器（可重复）")
+    parser.add_argument("--repeat", type=int, default=5, help="计时重复次数，取中位数")
+    parser.add_argument("--chunk-size", type=int, default=0, help="回放分块大小，0表示每个事件一个chunk")
+    parser.add_argument("--save-baseline", metavar="PATH", help="把结果保存为基线JSON")
+    parser.add_argument("--compare", metavar="PATH", help="与基线JSON对比，发现回归时退出码为1")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的相对回退比例")
+    args = parser.parse_args()
+
+    # 转换器内的逐事件日志会淹没测量结果
+    logging.disable(logging.WARNING)
+
+    results = run_all(args)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "json_codec": json_codec.CODEC_NAME,
+                "chunk_size": args.chunk_size,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("❌ 发现性能回归:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"✅ 与基线相比无超过 {args.tolerance:.0%} 的回归")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+端到端压测驱动
+
+启动模拟后端（benchmarks/mock_backend.py）和被测代理进程，用N个并发客户端
+发送流式/非流式请求，统计首字节时间（TTFB）、tokens/秒、代理每请求CPU时间和内存峰值（VmHWM）。
+--slow-readers 让一部分客户端以固定速率慢速读取流式响应（小接收缓冲），观察代理的流缓冲暂停指标。
+
+被测目标:
+    format_proxy        format_proxy.py 直连模拟后端（--backend-type 选择 openai / anthropic）
+    format_proxy+main   format_proxy.py -> main.py -> 模拟后端（生产部署链路）
+    server              server.py（同进程网关）-> 模拟后端
+
+用法:
+    python benchmarks/load_driver.py --target format_proxy --concurrency 50 --requests 500
+    python benchmarks/load_driver.py --target server --stream-ratio 0.5 --mock-token-rate 200
+    python benchmarks/load_driver.py --proxy-url http://127.0.0.1:8181 --proxy-pid 1234
+    python benchmarks/load_driver.py --target server --mock-tokens 3000 --slow-readers 0.5 --slow-read-rate 8192
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+import httpx
+
+from sse_parser import SSEParser
+import json_codec
+
+API_KEY = "sk-bench"
+MODEL = "bench-model"
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+SLOW_READER_RCVBUF = 4096
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def proc_cpu_seconds(pid: int) -> Optional[float]:
+    """读取 /proc/<pid>/stat 中的 utime + stime"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLK_TCK
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def proc_tree(pid: int) -> List[int]:
+    """返回进程及其所有子孙进程（uvicorn --workers 的worker是子进程）"""
+    parents: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(entry))
+    result, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        result.append(current)
+        queue.extend(parents.get(current, []))
+    return result
+
+
+def proc_memory_kb(pid: int) -> Dict[str, int]:
+    """读取 /proc/<pid>/status 中的 VmHWM / VmRSS"""
+    result = {}
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith(("VmHWM:", "VmRSS:")):
+                    key, value = line.split(":", 1)
+                    result[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return result
+
+
+class ServiceProcess:
+    """以子进程方式运行的uvicorn服务"""
+
+    def __init__(self, name: str, app: str, port: int, env: Dict[str, str], cwd: str, app_dir: str,
+                 workers: int = 1):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        full_env = {**os.environ, **env, "PYTHONPATH": REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+        self.log = open(os.path.join(cwd, f"{name}.log"), "wb")
+        command = [sys.executable, "-m", "uvicorn", app, "--app-dir", app_dir, "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning", "--no-access-log"]
+        if workers > 1:
+            command += ["--workers", str(workers)]
+        self.process = subprocess.Popen(command, cwd=cwd, env=full_env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def wait_ready(self, path: str = "/", timeout: float = 30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} 启动失败，日志见 {self.log.name}")
+            try:
+                httpx.get(self.url + path, timeout=1.0)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{self.name} 启动超时")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+class SharedStateProcess:
+    """多worker模式下的共享状态sidecar"""
+
+    def __init__(self, workdir: str):
+        self.socket = os.path.join(workdir, "state.sock")
+        self.log = open(os.path.join(workdir, "shared_state.log"), "wb")
+        self.process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "shared_state.py"),
+                                         "--socket", self.socket],
+                                        cwd=workdir, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket):
+            if self.process.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f"共享状态服务启动失败，日志见 {self.log.name}")
+            time.sleep(0.05)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+        self.log.close()
+
+
+def write_codebuddy_configs(workdir: str):
+    """main.py / server.py 启动时从工作目录读取的配置文件"""
+    with open(os.path.join(workdir, "codebuddy_accounts.txt"), "w", encoding="utf-8") as f:
+        f.write("bench@example.com|x|2025-01-01|bench|bench-access-token\n")
+    with open(os.path.join(workdir, "models.json"), "w", encoding="utf-8") as f:
+        json.dump({MODEL: MODEL}, f)
+    with open(os.path.join(workdir, "client.json"), "w", encoding="utf-8") as f:
+        json.dump([API_KEY], f)
+
+
+def start_services(args, workdir: str) -> List[ServiceProcess]:
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    mock_env = {f"MOCK_{k.upper()}": str(v) for k, v in {
+        "tokens": args.mock_tokens, "token_rate": args.mock_token_rate, "latency_ms": args.mock_latency_ms,
+        "error_rate": args.mock_error_rate, "error_status": args.mock_error_status,
+        "tool_calls": args.mock_tool_calls, "seed": args.seed,
+    }.items()}
+    services = []
+    mock = ServiceProcess("mock_backend", "mock_backend:app", free_port(), mock_env, workdir, bench_dir)
+    services.append(mock)
+    mock.wait_ready()
+
+    proxy_env = {"LOG_LEVEL": args.proxy_log_level}
+    main_env = {"CODEBUDDY_API_URL": mock.url + "/v2/chat/completions"}
+    if args.workers > 1 and args.target != "format_proxy":
+        # 多worker时 main / server 的共享状态放在sidecar中
+        state = SharedStateProcess(workdir)
+        services.append(state)
+        main_env["SHARED_STATE_SOCKET"] = state.socket
+
+    if args.target == "format_proxy":
+        proxy_env.update(BACKEND_TYPE=args.backend_type, BACKEND_BASE_URL=mock.url)
+    elif args.target == "format_proxy+main":
+        write_codebuddy_configs(workdir)
+        main = ServiceProcess("main", "main:app", free_port(), main_env, workdir, REPO_ROOT, args.workers)
+        services.append(main)
+        main.wait_ready("/v1/models")
+        proxy_env.update(BACKEND_TYPE="openai", BACKEND_BASE_URL=main.url)
+    elif args.target == "server":
+        write_codebuddy_configs(workdir)
+        proxy_env.update(main_env)
+
+    module = "server" if args.target == "server" else "format_proxy"
+    proxy = ServiceProcess(module, f"{module}:app", free_port(), proxy_env, workdir, REPO_ROOT, args.workers)
+    services.append(proxy)
+    proxy.wait_ready()
+    return services
+
+
+def request_body(stream: bool, max_tokens: int, prompt_kb: int = 0) -> bytes:
+    # OpenAI 和 Anthropic 请求在这个最小形态下字段相同
+    messages = [{"role": "user", "content": "Summarise the benchmark results in one paragraph."}]
+    # 模拟长对话历史：每条约4KB的交替消息
+    for i in range(prompt_kb // 4):
+        messages.append({"role": "assistant" if i % 2 == 0 else "user", "content": f"history {i} " + "x" * 4086})
+    if len(messages) % 2 == 0:
+        messages.append({"role": "user", "content": "continue"})
+    return json_codec.dumps({"model": MODEL, "max_tokens": max_tokens, "messages": messages, "stream": stream})
+
+
+def count_stream_tokens(data: bytes) -> Tuple[int, int]:
+    """
+    统计一个SSE事件中的内容增量数和其中携带的输出token用量（两种格式都支持）。
+    代理合并细碎增量后一个增量可能包含多个token，有用量时以用量为准。
+    """
+    if data == b"[DONE]" or not data:
+        return 0, 0
+    try:
+        payload = json_codec.loads(data)
+    except ValueError:
+        return 0, 0
+    if payload.get("type") == "content_block_delta":
+        return 1, 0
+    usage = payload.get("usage") or {}
+    usage_tokens = usage.get("completion_tokens") or usage.get("output_tokens") or 0
+    tokens = 0
+    for choice in payload.get("choices") or []:
+        delta = choice.get("delta") or {}
+        if delta.get("content"):
+            tokens += 1
+        tokens += len(delta.get("tool_calls") or [])
+    return tokens, usage_tokens
+
+
+def count_response_tokens(payload: Dict[str, Any]) -> int:
+    usage = payload.get("usage") or {}
+    return usage.get("completion_tokens") or usage.get("output_tokens") or 0
+
+
+async def one_request(client: httpx.AsyncClient, base_url: str, api: str, stream: bool,
+                      max_tokens: int, prompt_kb: int = 0, read_rate: float = 0.0) -> Dict[str, Any]:
+    path = "/v1/messages" if api == "messages" else "/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {API_KEY}", "x-api-key": API_KEY, "Content-Type": "application/json",
+               "anthropic-version": "2023-06-01"}
+    result = {"api": api, "stream": stream, "slow": read_rate > 0, "ok": False, "ttfb": None, "seconds": None,
+              "tokens": 0}
+    start = time.perf_counter()
+    try:
+        if stream:
+            async with client.stream("POST", base_url + path, content=request_body(True, max_tokens, prompt_kb),
+                                     headers=headers) as response:
+                parser = SSEParser()
+                usage_tokens = 0
+                async for chunk in response.aiter_bytes():
+                    if result["ttfb"] is None:
+                        result["ttfb"] = time.perf_counter() - start
+                    for event in parser.feed(chunk):
+                        deltas, usage = count_stream_tokens(event.data)
+                        result["tokens"] += deltas
+                        usage_tokens = usage or usage_tokens
+                    if read_rate > 0:
+                        # 慢客户端：按固定速率读取，接收缓冲满后代理的写入被阻塞
+                        await asyncio.sleep(len(chunk) / read_rate)
+                if usage_tokens and result["tokens"]:
+                    result["tokens"] = usage_tokens
+        else:
+            response = await client.post(base_url + path, content=request_body(False, max_tokens, prompt_kb),
+                                          headers=headers)
+            result["ttfb"] = time.perf_counter() - start
+            if response.status_code == 200:
+                result["tokens"] = count_response_tokens(json_codec.loads(response.content))
+        # 代理可能以200状态返回后端错误，没有任何内容也算失败
+        result["ok"] = response.status_code == 200 and result["tokens"] > 0
+        result["status"] = "200-empty" if response.status_code == 200 and not result["ok"] else response.status_code
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+async def run_load(args, base_url: str) -> List[Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    apis = ["chat", "messages"] if args.api == "both" else [args.api]
+    plan = [(rng.choice(apis), rng.random() < args.stream_ratio, rng.random() < args.slow_readers)
+            for _ in range(args.requests)]
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    # 慢客户端使用很小的接收缓冲，数据积压在代理一侧而不是客户端内核中
+    slow_transport = httpx.AsyncHTTPTransport(
+        limits=limits, socket_options=[(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_READER_RCVBUF)])
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client, \
+            httpx.AsyncClient(transport=slow_transport, timeout=args.timeout) as slow_client:
+        async def worker():
+            while True:
+                try:
+                    api, stream, slow = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if stream and slow:
+                    results.append(await one_request(slow_client, base_url, api, stream, args.mock_tokens,
+                                                     args.prompt_kb, args.slow_read_rate))
+                else:
+                    results.append(await one_request(client, base_url, api, stream, args.mock_tokens,
+                                                     args.prompt_kb))
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results
+
+
+def stream_buffer_stats(base_url: str) -> Dict[str, float]:
+    """从代理的 /metrics 汇总流缓冲的暂停指标（所有 stream 标签合计）"""
+    families = {
+        "cb2api_stalled_streams_total": "stalled_streams",
+        "cb2api_stream_buffer_stalls_total": "stalls",
+        "cb2api_stream_buffer_stall_seconds_total": "stall_seconds",
+    }
+    stats: Dict[str, float] = {}
+    try:
+        text = httpx.get(base_url + "/metrics", timeout=5.0).text
+    except httpx.HTTPError:
+        return stats
+    for line in text.splitlines():
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in families:
+            key = families[name]
+            stats[key] = stats.get(key, 0.0) + float(line.rsplit(" ", 1)[1])
+    return stats
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))]
+
+
+def summarise(results: List[Dict[str, Any]], wall: float, cpu_seconds: Optional[float],
+              memory: Dict[str, int]) -> Dict[str, Any]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in results:
+        name = f"{r['api']}/{'stream' if r['stream'] else 'non-stream'}" + ("/slow" if r.get("slow") else "")
+        groups.setdefault(name, []).append(r)
+
+    summary: Dict[str, Any] = {"requests": len(results), "wall_seconds": round(wall, 3),
+                               "requests_per_sec": round(len(results) / wall, 1) if wall else 0, "groups": {}}
+    for name, items in sorted(groups.items()):
+        ok = [r for r in items if r["ok"]]
+        ttfb = [r["ttfb"] * 1000 for r in ok if r["ttfb"] is not None]
+        per_request_rate = [r["tokens"] / r["seconds"] for r in ok if r["seconds"]]
+        summary["groups"][name] = {
+            "requests": len(items),
+            "errors": len(items) - len(ok),
+            "error_statuses": dict(Counter(str(r.get("status", r.get("error"))) for r in items if not r["ok"])),
+            "ttfb_ms_p50": round(percentile(ttfb, 50), 2),
+            "ttfb_ms_p95": round(percentile(ttfb, 95), 2),
+            "ttfb_ms_p99": round(percentile(ttfb, 99), 2),
+            "tokens_per_sec_per_request": round(statistics.median(per_request_rate), 1) if per_request_rate else 0,
+            "tokens_per_sec_total": round(sum(r["tokens"] for r in ok) / wall, 1) if wall else 0,
+        }
+
+    if cpu_seconds is not None and results:
+        summary["proxy_cpu_ms_per_request"] = round(cpu_seconds * 1000 / len(results), 3)
+        summary["proxy_cpu_utilisation"] = round(cpu_seconds / wall, 3) if wall else 0
+    if memory:
+        summary["proxy_vm_hwm_mb"] = round(memory.get("VmHWM", 0) / 1024, 1)
+        summary["proxy_vm_rss_mb"] = round(memory.get("VmRSS", 0) / 1024, 1)
+    return summary
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f"请求数 {summary['requests']}，耗时 {summary['wall_seconds']}s，{summary['requests_per_sec']} req/s")
+    for name, g in summary["groups"].items():
+        print(f"  {name:<22} 请求 {g['requests']:>6} 错误 {g['errors']:>4}  "
+              f"TTFB p50/p95/p99 {g['ttfb_ms_p50']:>7.1f}/{g['ttfb_ms_p95']:>7.1f}/{g['ttfb_ms_p99']:>7.1f}ms  "
+              f"tokens/s 单请求 {g['tokens_per_sec_per_request']:>9.1f} 合计 {g['tokens_per_sec_total']:>10.1f}")
+        if g["error_statuses"]:
+            print(f"    错误分布: {g['error_statuses']}")
+    if "proxy_cpu_ms_per_request" in summary:
+        print(f"  代理CPU {summary['proxy_cpu_ms_per_request']}ms/请求（利用率 {summary['proxy_cpu_utilisation']:.0%}）")
+    if "proxy_vm_hwm_mb" in summary:
+        print(f"  代理内存峰值 VmHWM {summary['proxy_vm_hwm_mb']}MB，当前 RSS {summary['proxy_vm_rss_mb']}MB"
+              f"（{summary.get('processes', 1)} 个进程合计）")
+    buffer_stats = summary.get("stream_buffer")
+    if buffer_stats:
+        print(f"  流缓冲暂停 {buffer_stats.get('stalls', 0):.0f} 次，涉及 {buffer_stats.get('stalled_streams', 0):.0f} 个流，"
+              f"共 {buffer_stats.get('stall_seconds', 0):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测驱动")
+    parser.add_argument("--target", choices=["format_proxy", "format_proxy+main", "server"], default="format_proxy")
+    parser.add_argument("--backend-type", choices=["openai", "anthropic"], default="openai",
+                        help="format_proxy 目标使用的后端格式")
+    parser.add_argument("--proxy-url", help="压测已运行的代理，不启动任何子进程")
+    parser.add_argument("--proxy-pid", type=int, action="append",
+                        help="配合 --proxy-url 采集该进程的CPU和内存（可重复，多个进程合计）")
+    parser.add_argument("--api", choices=["chat", "messages", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--stream-ratio", type=float, default=0.8, help="流式请求所占比例")
+    parser.add_argument("--prompt-kb", type=int, default=0, help="在请求中附加约N KB的对话历史")
+    parser.add_argument("--slow-readers", type=float, default=0.0, help="慢速读取流式响应的客户端比例")
+    parser.add_argument("--slow-read-rate", type=float, default=4096, help="慢客户端每秒读取的字节数")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mock-tokens", type=int, default=200)
+    parser.add_argument("--mock-token-rate", type=float, default=0.0, help="每个流每秒token数，0不限速")
+    parser.add_argument("--mock-latency-ms", type=float, default=0.0)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-error-status", type=int, default=500)
+    parser.add_argument("--mock-tool-calls", type=int, default=0)
+    parser.add_argument("--proxy-log-level", default="WARNING")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="被测服务的uvicorn worker数，大于1时 main / server 通过共享状态sidecar运行")
+    parser.add_argument("--json", metavar="PATH", help="把汇总结果写入JSON文件")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时工作目录（含各服务日志）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="cb2api-bench-")
+    services: List[ServiceProcess] = []
+    try:
+        if args.proxy_url:
+            base_url, proxy_pids = args.proxy_url.rstrip("/"), args.proxy_pid or []
+        else:
+            services = start_services(args, workdir)
+            # 被测服务包括除模拟后端以外的所有进程及其worker（format_proxy+main 为两个服务合计）
+            base_url = services[-1].url
+            proxy_pids = [pid for service in services[1:] for pid in proc_tree(service.pid)]
+
+        cpu_before = [proc_cpu_seconds(pid) for pid in proxy_pids]
+        start = time.perf_counter()
+        results = asyncio.run(run_load(args, base_url))
+        wall = time.perf_counter() - start
+        cpu_after = [proc_cpu_seconds(pid) for pid in proxy_pids]
+
+        cpu = None
+        if proxy_pids and None not in cpu_before and None not in cpu_after:
+            cpu = sum(cpu_after) - sum(cpu_before)
+        memory: Dict[str, int] = Counter()
+        for pid in proxy_pids:
+            memory.update(proc_memory_kb(pid))
+        summary = summarise(results, wall, cpu, dict(memory))
+        summary["processes"] = len(proxy_pids)
+        summary["stream_buffer"] = stream_buffer_stats(base_url)
+        summary["target"] = args.proxy_url or args.target
+        print_summary(summary)
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+    finally:
+        for service in reversed(services):
+            service.stop()
+        if args.keep_workdir:
+            print(f"工作目录: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
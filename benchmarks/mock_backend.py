@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+模拟OpenAI / Anthropic / CodeBuddy后端
+
+用于在没有外部服务的情况下压测 format_proxy.py、server.py 和 main.py。
+行为通过环境变量配置，也可以用同名请求头按请求覆盖（如 X-Mock-Tokens: 50）：
+
+    MOCK_TOKENS          每次回复的文本token数（默认200）
+    MOCK_TOKEN_RATE      每个流每秒输出的token数，0表示不限速（默认0）
+    MOCK_LATENCY_MS      首字节前的延迟毫秒数（默认0）
+    MOCK_ERROR_RATE      返回错误的概率 0~1（默认0）
+    MOCK_ERROR_STATUS    注入错误时的状态码（默认500）
+    MOCK_TOOL_CALLS      每次回复的并行工具调用数（默认0）
+    MOCK_TOOL_FRAGMENT   工具参数分片的最大长度（默认12）
+    MOCK_SEED            随机种子（默认0）
+
+运行:
+    python benchmarks/mock_backend.py --port 8856
+    # HTTPS，通过ALPN同时支持HTTP/2和HTTP/1.1（需要 pip install hypercorn）
+    python benchmarks/mock_backend.py --port 8857 --certfile test_fixtures/tls_localhost.crt --keyfile test_fixtures/tls_localhost.key
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+import json_codec
+from json_codec import CodecJSONResponse
+from sse_transcripts import TurnSpec, generate_spec, render_anthropic, render_openai
+
+DEFAULTS = {
+    "tokens": 200,
+    "token_rate": 0.0,
+    "latency_ms": 0.0,
+    "error_rate": 0.0,
+    "error_status": 500,
+    "tool_calls": 0,
+    "tool_fragment": 12,
+    "seed": 0,
+}
+
+app = FastAPI(default_response_class=CodecJSONResponse)
+
+_rng = random.Random(int(os.getenv("MOCK_SEED", "0")))
+_stats = {"requests": 0, "streams": 0, "errors": 0}
+
+
+def mock_settings(request: Request) -> Dict[str, Any]:
+    """环境变量为默认值，X-Mock-* 请求头按请求覆盖"""
+    settings = {}
+    for name, default in DEFAULTS.items():
+        raw = request.headers.get(f"x-mock-{name.replace('_', '-')}", os.getenv(f"MOCK_{name.upper()}"))
+        settings[name] = type(default)(raw) if raw is not None else default
+    return settings
+
+
+def build_turn(settings: Dict[str, Any], body: Dict[str, Any]) -> TurnSpec:
+    max_tokens = body.get("max_tokens")
+    tokens = settings["tokens"]
+    if isinstance(max_tokens, int) and 0 < max_tokens < tokens:
+        tokens = max_tokens
+    spec = generate_spec(tokens, settings["tool_calls"], seed=settings["seed"],
+                         fragment_size=max(1, settings["tool_fragment"]))
+    if tokens < settings["tokens"] and not settings["tool_calls"]:
+        spec.finish_reason = "length"
+    return spec
+
+
+async def paced(events: List[bytes], token_rate: float):
+    """按 token_rate 均匀输出事件（首个事件立即发送）"""
+    start = time.perf_counter()
+    for i, event in enumerate(events):
+        if token_rate > 0:
+            delay = start + i / token_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield event
+
+
+def openai_completion(spec: TurnSpec, model: str) -> Dict[str, Any]:
+    message: Dict[str, Any] = {"role": "assistant", "content": "".join(spec.text_deltas)}
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    for index, tool_id, name, fragment in spec.tool_deltas:
+        if index not in tool_calls:
+            tool_calls[index] = {"id": tool_id, "type": "function", "function": {"name": name, "arguments": ""}}
+        tool_calls[index]["function"]["arguments"] += fragment
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return {
+        "id": f"chatcmpl-mock{_rng.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": spec.finish_reason}],
+        "usage": {"prompt_tokens": spec.prompt_tokens, "completion_tokens": spec.completion_tokens,
+                  "total_tokens": spec.prompt_tokens + spec.completion_tokens},
+    }
+
+
+def anthropic_message(spec: TurnSpec, model: str) -> Dict[str, Any]:
+    content: List[Dict[str, Any]] = [{"type": "text", "text": "".join(spec.text_deltas)}]
+    arguments: Dict[int, List[str]] = {}
+    for index, tool_id, name, fragment in spec.tool_deltas:
+        if index not in arguments:
+            arguments[index] = []
+            content.append({"type": "tool_use", "id": tool_id, "name": name, "_index": index})
+        arguments[index].append(fragment)
+    for block in content[1:]:
+        block["input"] = json_codec.loads("".join(arguments[block.pop("_index")]))
+    stop_reason = {"length": "max_tokens", "tool_calls": "tool_use"}.get(spec.finish_reason, "end_turn")
+    return {
+        "id": f"msg_mock{_rng.getrandbits(32):08x}",
+        "type": "message",
+        "role": "assistant",
+        "content": content,
+        "model": model,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": spec.prompt_tokens, "output_tokens": spec.completion_tokens},
+    }
+
+
+async def handle(request: Request, api_format: str):
+    settings = mock_settings(request)
+    body = json_codec.loads(await request.body())
+    _stats["requests"] += 1
+
+    if settings["latency_ms"] > 0:
+        await asyncio.sleep(settings["latency_ms"] / 1000.0)
+
+    if settings["error_rate"] > 0 and _rng.random() < settings["error_rate"]:
+        _stats["errors"] += 1
+        if api_format == "anthropic":
+            error = {"type": "error", "error": {"type": "api_error", "message": "mock injected error"}}
+        else:
+            error = {"error": {"message": "mock injected error", "type": "server_error"}}
+        return CodecJSONResponse(content=error, status_code=settings["error_status"])
+
+    spec = build_turn(settings, body)
+    model = body.get("model", "mock-model")
+
+    if body.get("stream"):
+        _stats["streams"] += 1
+        events = render_anthropic(spec) if api_format == "anthropic" else render_openai(spec)
+        return StreamingResponse(paced(events, settings["token_rate"]), media_type="text/event-stream")
+
+    if api_format == "anthropic":
+        return anthropic_message(spec, model)
+    return openai_completion(spec, model)
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat_completions(request: Request):
+    return await handle(request, "openai")
+
+
+@app.post("/v2/chat/completions")
+async def codebuddy_chat_completions(request: Request):
+    """CodeBuddy上游接口（OpenAI流格式）"""
+    return await handle(request, "openai")
+
+
+@app.post("/v1/messages")
+async def anthropic_messages(request: Request):
+    return await handle(request, "anthropic")
+
+
+@app.post("/v1/messages/count_tokens")
+async def count_tokens(request: Request):
+    body = json_codec.loads(await request.body())
+    return {"input_tokens": len(json_codec.dumps(body.get("messages", []))) // 4}
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "mock-model", "object": "model", "created": 0, "owned_by": "mock"}]}
+
+
+@app.get("/")
+async def root():
+    return {"status": "ok", "service": "mock_backend", **_stats}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="模拟后端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8856)
+    parser.add_argument("--certfile", help="启用HTTPS（hypercorn，ALPN支持h2和http/1.1）")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--h2-max-streams", type=int, default=100, help="HTTP/2每个连接的最大并发流数")
+    args = parser.parse_args()
+    if args.certfile:
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"{args.host}:{args.port}"]
+        config.certfile = args.certfile
+        config.keyfile = args.keyfile
+        config.h2_max_concurrent_streams = args.h2_max_streams
+        config.backlog = 2048
+        config.loglevel = "WARNING"
+        asyncio.run(serve(app, config))
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
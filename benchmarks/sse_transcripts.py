@@ -0,0 +1,175 @@
+"""
+上游SSE录制样本
+
+按上游真实的线上格式（OpenAI: data 行；Anthropic: event + data 行）生成确定性的SSE转录，
+同一场景同时提供两种格式。也可以把用 curl 录制的真实转录放到 benchmarks/fixtures/ 下，
+文件名形如 <场景名>.openai.sse / <场景名>.anthropic.sse，会与内置场景一起被加载。
+"""
+import glob
+import json
+import os
+import random
+from typing import Any, Dict, List, Tuple
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+SCENARIOS = ["short_chat", "long_text_32k", "parallel_tool_calls", "tiny_deltas"]
+
+_WORDS = ("the quick brown fox jumps over lazy dog 数据 流式 响应 async await "
+          "import def class return self value None True False 🚀 \"quoted\" path/to\\file").split(" ")
+
+
+class TurnSpec:
+    """一次助手回复的内容：文本片段、工具调用参数片段、结束原因和用量"""
+
+    def __init__(self):
+        self.text_deltas: List[str] = []
+        # (tool_index, tool_id, name, argument_fragment) 按发送顺序排列，同一index第一次出现即为开始
+        self.tool_deltas: List[Tuple[int, str, str, str]] = []
+        self.finish_reason = "stop"
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+def _words(rng: random.Random, count: int) -> List[str]:
+    return [rng.choice(_WORDS) + " " for _ in range(count)]
+
+
+def _interleave_tool_calls(rng: random.Random, spec: TurnSpec, count: int, fragment_size: int):
+    """生成 count 个并行工具调用，参数按随机顺序交错分片发送"""
+    tools = [(i, f"call_{i:04d}", rng.choice(["read_file", "grep", "run_shell", "write_file"])) for i in range(count)]
+    arguments = {i: json.dumps({"path": f"src/module_{i}.py", "query": " ".join(_words(rng, 60))}) for i, _, _ in tools}
+    offsets = {i: 0 for i, _, _ in tools}
+    started = set()
+    while offsets:
+        index, tool_id, name = tools[rng.choice(sorted(offsets))]
+        fragment = arguments[index][offsets[index]:offsets[index] + rng.randint(1, fragment_size)]
+        offsets[index] += len(fragment)
+        spec.tool_deltas.append((index, tool_id if index not in started else "", name, fragment))
+        started.add(index)
+        if offsets[index] >= len(arguments[index]):
+            del offsets[index]
+    if count:
+        spec.finish_reason = "tool_calls"
+
+
+def generate_spec(text_tokens: int, tool_calls: int = 0, seed: Any = 0, fragment_size: int = 12,
+                  prompt_tokens: int = 1200) -> TurnSpec:
+    """按参数生成回复内容，供模拟后端使用"""
+    rng = random.Random(seed)
+    spec = TurnSpec()
+    spec.text_deltas = _words(rng, text_tokens)
+    _interleave_tool_calls(rng, spec, tool_calls, fragment_size)
+    spec.prompt_tokens = prompt_tokens
+    spec.completion_tokens = len(spec.text_deltas) + len(spec.tool_deltas)
+    return spec
+
+
+def build_spec(scenario: str) -> TurnSpec:
+    rng = random.Random(scenario)
+    spec = TurnSpec()
+
+    if scenario == "short_chat":
+        spec.text_deltas = _words(rng, 40)
+    elif scenario == "long_text_32k":
+        spec.text_deltas = _words(rng, 32768)
+        spec.finish_reason = "length"
+    elif scenario == "parallel_tool_calls":
+        spec.text_deltas = _words(rng, 20)
+        _interleave_tool_calls(rng, spec, 16, 12)
+    elif scenario == "tiny_deltas":
+        text = "".join(_words(rng, 2000))
+        spec.text_deltas = list(text)
+    else:
+        raise ValueError(f"未知场景: {scenario}")
+
+    spec.prompt_tokens = 1200
+    spec.completion_tokens = len(spec.text_deltas) + len(spec.tool_deltas)
+    return spec
+
+
+def _openai_event(payload: Dict) -> bytes:
+    return b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def render_openai(spec: TurnSpec) -> List[bytes]:
+    """渲染为OpenAI chat.completion.chunk事件列表（每个元素是一个完整SSE事件）"""
+    base = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4o"}
+    events = [_openai_event({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                                    "finish_reason": None}]})]
+    for text in spec.text_deltas:
+        events.append(_openai_event({**base, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}))
+    for index, tool_id, name, fragment in spec.tool_deltas:
+        tool_call = {"index": index, "function": {"arguments": fragment}}
+        if tool_id:
+            tool_call = {"index": index, "id": tool_id, "type": "function",
+                         "function": {"name": name, "arguments": fragment}}
+        events.append(_openai_event({**base, "choices": [{"index": 0, "delta": {"tool_calls": [tool_call]},
+                                                            "finish_reason": None}]}))
+    events.append(_openai_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": spec.finish_reason}],
+                                 "usage": {"prompt_tokens": spec.prompt_tokens,
+                                           "completion_tokens": spec.completion_tokens,
+                                           "total_tokens": spec.prompt_tokens + spec.completion_tokens}}))
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+
+def _anthropic_event(payload: Dict) -> bytes:
+    return (b"event: " + payload["type"].encode() + b"\ndata: "
+            + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+
+def render_anthropic(spec: TurnSpec) -> List[bytes]:
+    """渲染为Anthropic messages流事件列表"""
+    events = [_anthropic_event({"type": "message_start", "message": {
+        "id": "msg_bench", "type": "message", "role": "assistant", "content": [], "model": "claude-sonnet",
+        "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": spec.prompt_tokens, "output_tokens": 1}}})]
+    events.append(_anthropic_event({"type": "content_block_start", "index": 0,
+                                    "content_block": {"type": "text", "text": ""}}))
+    events.append(_anthropic_event({"type": "ping"}))
+    for text in spec.text_deltas:
+        events.append(_anthropic_event({"type": "content_block_delta", "index": 0,
+                                        "delta": {"type": "text_delta", "text": text}}))
+    events.append(_anthropic_event({"type": "content_block_stop", "index": 0}))
+
+    block_index = {}
+    for index, tool_id, name, fragment in spec.tool_deltas:
+        if index not in block_index:
+            block_index[index] = len(block_index) + 1
+            events.append(_anthropic_event({"type": "content_block_start", "index": block_index[index],
+                                            "content_block": {"type": "tool_use", "id": tool_id, "name": name,
+                                                              "input": {}}}))
+        events.append(_anthropic_event({"type": "content_block_delta", "index": block_index[index],
+                                        "delta": {"type": "input_json_delta", "partial_json": fragment}}))
+    for index in block_index.values():
+        events.append(_anthropic_event({"type": "content_block_stop", "index": index}))
+
+    stop_reason = {"length": "max_tokens", "tool_calls": "tool_use"}.get(spec.finish_reason, "end_turn")
+    events.append(_anthropic_event({"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                    "usage": {"output_tokens": spec.completion_tokens}}))
+    events.append(_anthropic_event({"type": "message_stop"}))
+    return events
+
+
+def _split_recorded(data: bytes) -> List[bytes]:
+    """把录制文件按空行切回事件列表"""
+    normalized = data.replace(b"\r\n", b"\n")
+    return [part + b"\n\n" for part in normalized.split(b"\n\n") if part.strip()]
+
+
+def load_transcripts() -> Dict[str, Dict[str, List[bytes]]]:
+    """返回 {场景: {"openai": [事件...], "anthropic": [事件...]}}"""
+    transcripts = {}
+    for scenario in SCENARIOS:
+        spec = build_spec(scenario)
+        transcripts[scenario] = {"openai": render_openai(spec), "anthropic": render_anthropic(spec)}
+
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.sse"))):
+        name = os.path.basename(path)[:-len(".sse")]
+        scenario, _, fmt = name.rpartition(".")
+        if fmt not in ("openai", "anthropic") or not scenario:
+            continue
+        with open(path, "rb") as f:
+            transcripts.setdefault(f"recorded:{scenario}", {})[fmt] = _split_recorded(f.read())
+
+    return transcripts
@@ -0,0 +1,107 @@
+"""
+把OpenAI流式响应的增量聚合为非流式的 chat.completion
+
+非流式请求在上游也以流式方式获取。逐个增量拼接字符串（尤其是 tool_calls[idx]["function"]["arguments"] += ...，
+字典中的字符串无法原地扩展）在长参数下是平方级的复制。这里把片段收集到列表中，构建结果时一次性 join。
+支持多个choice（n>1）和不连续的工具调用index（不会为缺失的index补空的工具调用）。
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+
+class _ToolCallParts:
+    __slots__ = ("id", "type", "name", "arguments")
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.type = "function"
+        self.name = ""
+        self.arguments: List[str] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        tool_call = {"type": self.type, "function": {"name": self.name, "arguments": "".join(self.arguments)}}
+        if self.id is not None:
+            tool_call["id"] = self.id
+        return tool_call
+
+
+class _ChoiceParts:
+    __slots__ = ("content", "tool_calls", "finish_reason")
+
+    def __init__(self):
+        self.content: List[str] = []
+        # 上游的工具调用index -> 片段
+        self.tool_calls: Dict[int, _ToolCallParts] = {}
+        self.finish_reason: Optional[str] = None
+
+    def add_delta(self, delta: Dict[str, Any]) -> None:
+        content = delta.get("content")
+        if content:
+            self.content.append(content)
+
+        for tool_call in delta.get("tool_calls") or ():
+            index = tool_call.get("index")
+            if index is None:
+                continue
+            parts = self.tool_calls.get(index)
+            if parts is None:
+                parts = self.tool_calls[index] = _ToolCallParts()
+
+            function = tool_call.get("function")
+            if function:
+                if function.get("name"):
+                    parts.name = function["name"]
+                if function.get("arguments") is not None:
+                    parts.arguments.append(function["arguments"])
+            if "id" in tool_call:
+                parts.id = tool_call["id"]
+            if "type" in tool_call:
+                parts.type = tool_call["type"]
+
+    def to_dict(self, index: int) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": "assistant"}
+        if self.tool_calls:
+            message["tool_calls"] = [self.tool_calls[i].to_dict() for i in sorted(self.tool_calls)]
+        else:
+            message["content"] = "".join(self.content)
+        return {"index": index, "message": message, "finish_reason": self.finish_reason or "stop"}
+
+
+class CompletionAccumulator:
+    """逐个接收流式chunk（已解析的JSON），最后用 build() 生成 chat.completion"""
+
+    def __init__(self):
+        self.response_id: Optional[str] = None
+        self.usage: Dict[str, Any] = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        # choice index -> 片段，没有收到任何choice时也输出 index 0
+        self._choices: Dict[int, _ChoiceParts] = {}
+
+    def add_chunk(self, chunk: Dict[str, Any]) -> None:
+        # 取第一个chunk的ID
+        if self.response_id is None:
+            self.response_id = chunk.get("id")
+
+        for choice in chunk.get("choices") or ():
+            index = choice.get("index") or 0
+            parts = self._choices.get(index)
+            if parts is None:
+                parts = self._choices[index] = _ChoiceParts()
+            parts.add_delta(choice.get("delta") or {})
+            # 结束原因以最后一个chunk为准
+            if choice.get("finish_reason"):
+                parts.finish_reason = choice["finish_reason"]
+
+        # 用量以最后一个带usage的chunk为准
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+
+    def build(self, model: str) -> Dict[str, Any]:
+        choices = self._choices or {0: _ChoiceParts()}
+        return {
+            "id": self.response_id or f"chatcmpl-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [choices[i].to_dict(i) for i in sorted(choices)],
+            "usage": self.usage,
+        }
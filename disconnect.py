@@ -0,0 +1,87 @@
+"""
+客户端断开检测
+
+请求体读完后，ASGI receive() 只会在客户端断开时返回 http.disconnect。
+这里在等待上游的同时监听它：客户端先断开时立即取消上游请求，连接马上还给连接池，
+而不是等上游把整个回复生成完（非流式）或等下一次写入失败（流式）。
+
+流式响应由 stream_buffer.StreamBuffer 使用同样的监听，非流式请求用 cancel_on_disconnect() 包装。
+每次取消记录在 cb2api_client_disconnects_total，节省的上游时间按同类请求的平均耗时减去已经过的时间估算，
+记录在 cb2api_upstream_seconds_saved_total。
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+# 客户端断开时返回的状态码（nginx 的 "Client Closed Request"），只会出现在日志和指标中
+CLIENT_CLOSED_REQUEST = 499
+
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+
+
+class ClientDisconnected(Exception):
+    """客户端在上游响应完成前断开"""
+
+
+async def wait_for_disconnect(receive: Receive) -> None:
+    """等到 receive() 返回 http.disconnect（请求体必须已经读完）"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def record_completed(name: str, elapsed: float) -> None:
+    """记录正常完成的上游请求耗时，作为估算节省时间的基准"""
+    metrics.UPSTREAM_DURATION.labels(name).observe(elapsed)
+
+
+def record_disconnect(name: str, elapsed: float) -> float:
+    """记录一次因客户端断开而取消的上游请求，返回估算节省的秒数"""
+    completed = metrics.UPSTREAM_DURATION.labels(name)
+    saved = max(0.0, completed.sum / completed.count - elapsed) if completed.count else 0.0
+    metrics.CLIENT_DISCONNECTS.labels(name).inc()
+    metrics.UPSTREAM_SECONDS_SAVED.labels(name).inc(saved)
+    return saved
+
+
+async def stop_task(task: "asyncio.Task[Any]") -> None:
+    """取消任务并等它运行完清理代码（关闭上游响应、归还连接）。
+
+    不用 gather：外层任务在等待时再次被取消（anyio 的取消作用域会反复取消），
+    gather 会把取消传给任务，打断它正在进行的清理。
+    """
+    if not task.done():
+        task.cancel()
+    await asyncio.wait((task,))
+
+
+async def cancel_on_disconnect(receive: Optional[Receive], awaitable: Awaitable[T], name: str) -> T:
+    """等待上游请求完成；客户端先断开时取消它并抛出 ClientDisconnected"""
+    if receive is None:
+        return await awaitable
+
+    started = time.perf_counter()
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    done = set()
+    try:
+        done, _ = await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            await stop_task(task)
+
+    if task not in done:
+        if not watcher.cancelled():
+            # receive() 出错也说明连接已经不可用，按断开处理
+            watcher.exception()
+        record_disconnect(name, time.perf_counter() - started)
+        raise ClientDisconnected()
+    result = task.result()
+    record_completed(name, time.perf_counter() - started)
+    return result
@@ -1,96 +1,129 @@
 import traceback
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request, HTTPException, Header
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 import httpx
 import json
 import os
 import logging
-from typing import Dict, Any, List, Optional, Union, AsyncGenerator
+from typing import Dict, Any, List, Optional, Tuple, Union, AsyncGenerator, AsyncIterator
 from pydantic import BaseModel, Field
 import uuid
 import time
 from datetime import datetime
 import asyncio
-try:
-    import tiktoken
-    TIKTOKEN_AVAILABLE = True
-except ImportError:
-    TIKTOKEN_AVAILABLE = False
-    # logger.warning("tiktoken not available, OpenAI token counting will be disabled")
-
-logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
-logger = logging.getLogger(__name__)
 
-app = FastAPI()
+from http_pool import PoolConfig, create_async_client, get_pool_stats
+import metrics
+from metrics import CONVERSION_DURATION, timed
+from sse_parser import SSEParser, aiter_sse_events
+import json_codec
+from json_codec import CodecJSONResponse
+import log_pipeline
+from log_pipeline import preview
+import sse_frames
+from json_scan import TopLevelScanner
+from token_counter import TIKTOKEN_AVAILABLE, token_counter
+from prefix_cache import PrefixCache
+from stream_buffer import buffered, coalescing_for
+from disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, cancel_on_disconnect
+
+logger = logging.getLogger(__name__)
+# 请求热路径上的日志：级别未开启或请求未采样时不格式化参数
+request_log = log_pipeline.request_logger(__name__)
 
 BACKEND_TYPE = os.getenv("BACKEND_TYPE", "openai").lower()
 BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 PROXY_PORT = int(os.getenv("PROXY_PORT", "8181"))
 
+# Anthropic→OpenAI 消息转换的对话前缀缓存
+conversion_cache = PrefixCache("anthropic_to_openai")
+
+# 每个worker共享一个后端客户端，复用到后端的TCP连接
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def create_backend_client() -> httpx.AsyncClient:
+    return create_async_client(
+        PoolConfig("BACKEND_POOL_"),
+        event_hooks={"request": [metrics.upstream_connect_hook(BACKEND_TYPE)]}
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的后端客户端，未经lifespan初始化时按需创建"""
+    global http_client
+    if http_client is None:
+        http_client = create_backend_client()
+    return http_client
 
-def count_tokens_openai(messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    log_pipeline.setup_logging()
+    http_client = create_backend_client()
+    if TIKTOKEN_AVAILABLE and BACKEND_TYPE == "openai":
+        # 编码器加载可能需要下载词表，放到线程里避免阻塞事件循环
+        await asyncio.to_thread(token_counter.preload)
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        http_client = None
+        token_counter.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=CodecJSONResponse)
+metrics.install(app, BACKEND_TYPE)
+log_pipeline.install(app)
+
+
+async def count_tokens_openai(messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
     """
-    使用tiktoken计算OpenAI格式消息的token数量
+    使用tiktoken计算OpenAI格式消息的token数量（编码器和单条消息的计数均有缓存，
+    大段未命中内容在编码池中计算，不阻塞事件循环）
     """
     if not TIKTOKEN_AVAILABLE:
         logger.error("tiktoken库未安装，无法计算token数量")
         return 0
 
     try:
-        # 获取模型对应的编码器
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            # 如果模型不支持，使用默认编码器
-            encoding = tiktoken.get_encoding("cl100k_base")
-
-        total_tokens = 0
-
-        for message in messages:
-            # 每条消息的基础token开销（角色标识等）
-            total_tokens += 4  # 每条消息的基础开销
-
-            role = message.get("role", "")
-            content = message.get("content", "")
-
-            # 计算角色token
-            total_tokens += len(encoding.encode(role))
-
-            # 计算内容token
-            if isinstance(content, str):
-                total_tokens += len(encoding.encode(content))
-            elif isinstance(content, list):
-                # 处理多模态内容
-                for item in content:
-                    if item.get("type") == "text":
-                        total_tokens += len(encoding.encode(item.get("text", "")))
-                    elif item.get("type") == "image_url":
-                        # 图片token计算（简化处理）
-                        total_tokens += 85  # 基础图片token开销
-
-            # 处理工具调用
-            if "tool_calls" in message and message["tool_calls"]:
-                for tool_call in message["tool_calls"]:
-                    if "function" in tool_call:
-                        func = tool_call["function"]
-                        total_tokens += len(encoding.encode(func.get("name", "")))
-                        total_tokens += len(encoding.encode(func.get("arguments", "")))
-
-        # 对话的额外开销
-        total_tokens += 2
-
-        return total_tokens
-
+        return await token_counter.count_messages_async(messages, model)
     except Exception as e:
         logger.error(f"Token计算失败: {e}")
         return 0
 
 
+def error_frame(error: Union[bytes, str], event: Optional[str] = None) -> bytes:
+    """流式响应中的错误帧 {"error": ...}；后端错误内容可能含引号和换行，按JSON转义"""
+    if isinstance(error, bytes):
+        error = error.decode("utf-8", errors="replace")
+    if event is None:
+        return b"data: " + json_codec.dumps({"error": error}) + b"\n\n"
+    return sse_frames.sse_frame(event, {"error": error})
+
+
+async def read_request_body(request: Request) -> bytes:
+    """读取完整请求体；与 request.body() 不同，结果不会缓存在 Request 上，解析后可以及时释放"""
+    chunks = [chunk async for chunk in request.stream()]
+    return b"".join(chunks)
+
+
 def safe_json_loads(data: Union[bytes, str]) -> Dict[str, Any]:
     """
     安全的JSON解析函数，自动处理bytes/string类型转换和详细错误诊断
     """
+    # 快速路径：绝大多数请求体是合法JSON，直接交给编解码器解析bytes，失败再走下面的诊断流程
+    if isinstance(data, (bytes, str)):
+        try:
+            return json_codec.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass
+
     try:
         # 检测数据类型并进行适当转换
         if isinstance(data, bytes):
@@ -138,10 +171,9 @@ def safe_json_loads(data: Union[bytes, str]) -> Dict[str, Any]:
         logger.error(f"JSON解析错误 - 位置: 第{e.lineno}行第{e.colno}列 (字符{e.pos})")
         logger.error(f"错误消息: {e.msg}")
         if isinstance(data, (bytes, str)):
-            # 安全地显示前200个字符用于调试，避免敏感信息泄露
-            preview = str(data)[:200] if len(str(data)) > 200 else str(data)
-            logger.error(f"请求体预览: {preview}...")
-            logger.error(f"数据类型: {type(data)}, 长度: {len(data)}")
+            # 安全地显示前200个字符用于调试，避免敏感信息泄露（只转换需要的前缀）
+            request_log.error("请求体预览: %s", preview(data, 200))
+            request_log.error("数据类型: %s, 长度: %d", type(data), len(data))
 
             # 检查是否有多个JSON对象连接在一起
             data_str = data.decode('utf-8') if isinstance(data, bytes) else data
@@ -280,6 +312,7 @@ class AnthropicRequest(BaseModel):
 
 
 
+@timed(CONVERSION_DURATION, "convert_openai_to_anthropic")
 def convert_openai_to_anthropic(openai_req: Dict[str, Any]) -> Dict[str, Any]:
     anthropic_messages = []
     system_content = None
@@ -329,11 +362,11 @@ def convert_openai_to_anthropic(openai_req: Dict[str, Any]) -> Dict[str, Any]:
                     "type": "tool_use",
                     "id": tool_call["id"],
                     "name": tool_call["function"]["name"],
-                    "input": json.loads(tool_call["function"]["arguments"])
+                    "input": json_codec.loads(tool_call["function"]["arguments"])
                 })
 
         if "tool_call_id" in msg and msg["tool_call_id"]:
-            tool_result_content = content if isinstance(content, str) else json.dumps(content)
+            tool_result_content = content if isinstance(content, str) else json_codec.dumps_str(content)
             anthropic_content.append({
                 "type": "tool_result",
                 "tool_use_id": msg["tool_call_id"],
@@ -390,6 +423,73 @@ def convert_openai_to_anthropic(openai_req: Dict[str, Any]) -> Dict[str, Any]:
     return anthropic_req
 
 
+def _convert_anthropic_message(msg: Dict[str, Any], openai_messages: List[Dict[str, Any]]) -> None:
+    """把一条Anthropic消息转换为OpenAI消息（工具结果会拆成单独的tool消息），追加到 openai_messages"""
+    role = msg["role"]
+    content = msg["content"]
+
+    if isinstance(content, str):
+        openai_messages.append({"role": role, "content": content})
+    elif isinstance(content, list):
+        openai_content = []
+        tool_calls = []
+        tool_results = []
+
+        for block in content:
+            block_type = block.get("type")
+
+            if block_type == "text":
+                openai_content.append({
+                    "type": "text",
+                    "text": block["text"]
+                })
+            elif block_type == "image":
+                source = block["source"]
+                if source["type"] == "base64":
+                    url = f"data:{source['media_type']};base64,{source['data']}"
+                    openai_content.append({
+                        "type": "image_url",
+                        "image_url": {"url": url}
+                    })
+            elif block_type == "tool_use":
+                tool_calls.append({
+                    "id": block["id"],
+                    "type": "function",
+                    "function": {
+                        "name": block["name"],
+                        "arguments": json_codec.dumps_str(block["input"])
+                    }
+                })
+            elif block_type == "tool_result":
+                try:
+                    tool_results.append({
+                        "tool_call_id": block["tool_use_id"],
+                        "content": block["content"]
+                    })
+                except Exception as e:
+                    se = traceback.format_exception(e)
+                    print(se)
+
+        if openai_content or tool_calls:
+            msg_dict = {"role": role}
+            if openai_content:
+                if len(openai_content) == 1 and openai_content[0]["type"] == "text":
+                    msg_dict["content"] = openai_content[0]["text"]
+                else:
+                    msg_dict["content"] = openai_content
+            if tool_calls:
+                msg_dict["tool_calls"] = tool_calls
+            openai_messages.append(msg_dict)
+
+        for tool_result in tool_results:
+            openai_messages.append({
+                "role": "tool",
+                "tool_call_id": tool_result["tool_call_id"],
+                "content": tool_result["content"]
+            })
+
+
+@timed(CONVERSION_DURATION, "convert_anthropic_to_openai")
 def convert_anthropic_to_openai(anthropic_req: Dict[str, Any]) -> Dict[str, Any]:
     openai_messages = []
 
@@ -405,69 +505,15 @@ def convert_anthropic_to_openai(anthropic_req: Dict[str, Any]) -> Dict[str, Any]
             if system_text:
                 openai_messages.append({"role": "system", "content": system_text.strip()})
 
-    for msg in anthropic_req["messages"]:
-        role = msg["role"]
-        content = msg["content"]
-
-        if isinstance(content, str):
-            openai_messages.append({"role": role, "content": content})
-        elif isinstance(content, list):
-            openai_content = []
-            tool_calls = []
-            tool_results = []
-
-            for block in content:
-                block_type = block.get("type")
-
-                if block_type == "text":
-                    openai_content.append({
-                        "type": "text",
-                        "text": block["text"]
-                    })
-                elif block_type == "image":
-                    source = block["source"]
-                    if source["type"] == "base64":
-                        url = f"data:{source['media_type']};base64,{source['data']}"
-                        openai_content.append({
-                            "type": "image_url",
-                            "image_url": {"url": url}
-                        })
-                elif block_type == "tool_use":
-                    tool_calls.append({
-                        "id": block["id"],
-                        "type": "function",
-                        "function": {
-                            "name": block["name"],
-                            "arguments": json.dumps(block["input"])
-                        }
-                    })
-                elif block_type == "tool_result":
-                    try:
-                        tool_results.append({
-                            "tool_call_id": block["tool_use_id"],
-                            "content": block["content"]
-                        })
-                    except Exception as e:
-                        se = traceback.format_exception(e)
-                        print(se)
-
-            if openai_content or tool_calls:
-                msg_dict = {"role": role}
-                if openai_content:
-                    if len(openai_content) == 1 and openai_content[0]["type"] == "text":
-                        msg_dict["content"] = openai_content[0]["text"]
-                    else:
-                        msg_dict["content"] = openai_content
-                if tool_calls:
-                    msg_dict["tool_calls"] = tool_calls
-                openai_messages.append(msg_dict)
-
-            for tool_result in tool_results:
-                openai_messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_result["tool_call_id"],
-                    "content": tool_result["content"]
-                })
+    # 命中缓存前缀时只转换新增的消息
+    messages = anthropic_req["messages"]
+    match = conversion_cache.match(messages)
+    head = len(openai_messages)
+    if match.value:
+        openai_messages.extend(match.value)
+    for msg in messages[match.start:]:
+        _convert_anthropic_message(msg, openai_messages)
+    match.commit(len(messages), openai_messages[head:])
 
     openai_req = {
         "model": anthropic_req["model"],
@@ -526,6 +572,7 @@ def convert_anthropic_to_openai(anthropic_req: Dict[str, Any]) -> Dict[str, Any]
     return openai_req
 
 
+@timed(CONVERSION_DURATION, "convert_openai_response_to_anthropic")
 def convert_openai_response_to_anthropic(openai_resp: Dict[str, Any]) -> Dict[str, Any]:
     # Check if this is an error response
     if "error" in openai_resp:
@@ -564,7 +611,7 @@ def convert_openai_response_to_anthropic(openai_resp: Dict[str, Any]) -> Dict[st
                 "type": "tool_use",
                 "id": tool_call["id"],
                 "name": tool_call["function"]["name"],
-                "input": json.loads(tool_call["function"]["arguments"])
+                "input": json_codec.loads(tool_call["function"]["arguments"])
             })
 
     # Ensure content is not empty
@@ -599,6 +646,7 @@ def convert_openai_response_to_anthropic(openai_resp: Dict[str, Any]) -> Dict[st
     }
 
 
+@timed(CONVERSION_DURATION, "convert_anthropic_response_to_openai")
 def convert_anthropic_response_to_openai(anthropic_resp: Dict[str, Any]) -> Dict[str, Any]:
     # Check if this is an error response
     if anthropic_resp.get("type") == "error":
@@ -632,7 +680,7 @@ def convert_anthropic_response_to_openai(anthropic_resp: Dict[str, Any]) -> Dict
                 "type": "function",
                 "function": {
                     "name": block["name"],
-                    "arguments": json.dumps(block["input"])
+                    "arguments": json_codec.dumps_str(block["input"])
                 }
             })
 
@@ -680,31 +728,22 @@ def convert_anthropic_response_to_openai(anthropic_resp: Dict[str, Any]) -> Dict
 
 async def stream_response_handler(response_generator) -> AsyncGenerator[bytes, None]:
     """Handle streaming response with proper buffering"""
-    buffer = ""
+    parser = SSEParser()
     try:
         async for chunk in response_generator:
-            buffer += chunk.decode("utf-8")
-
-            # Process complete lines
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                line = line.strip()
-
-                if line:
-                    # Yield the complete line with proper formatting
-                    if line.startswith("data: "):
-                        yield (line + "\n\n").encode("utf-8")
-                    elif line.startswith("event: "):
-                        yield (line + "\n").encode("utf-8")
-                    else:
-                        yield (line + "\n").encode("utf-8")
+            # Re-emit every complete event in canonical SSE framing
+            for event in parser.feed(chunk):
+                yield event.encode()
+
+        for event in parser.flush():
+            yield event.encode()
 
     except Exception as e:
         logger.error(f"Error in stream handler: {str(e)}")
-        yield f"data: {{\"error\": \"{str(e)}\"}}\n\n".encode("utf-8")
+        yield error_frame(str(e))
 
 
-async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator[str, None]:
+async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator[bytes, None]:
     message_id = f"msg_{uuid.uuid4().hex[:24]}"
 
     # Send message_start event (usage will be updated later)
@@ -726,13 +765,13 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
             }
         }
     }
-    yield f"event: message_start\ndata: {json.dumps(message_data)}\n\n"
+    yield sse_frames.sse_frame("message_start", message_data)
 
     # Start with text content block
-    yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
+    yield sse_frames.text_block_start(0)
 
     # Send a ping to keep the connection alive
-    yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
+    yield sse_frames.PING
 
     tool_index = None
     current_tool_call = None
@@ -746,16 +785,13 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
     last_tool_index = 0
     tool_call_map = {}  # Maps OpenAI tool call index to Anthropic content block index
 
-    async for line in response.aiter_lines():
-        if not line or not line.startswith("data: "):
-            continue
-
-        data = line[6:]
-        if data == "[DONE]":
+    async for event in aiter_sse_events(response.aiter_bytes()):
+        data = event.data
+        if data == b"[DONE]":
             break
 
         try:
-            chunk = json.loads(data)
+            chunk = json_codec.loads(data)
             if not chunk.get("choices"):
                 continue
 
@@ -785,7 +821,7 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                 # Always emit text deltas if no tool calls started
                 if tool_index is None and not text_block_closed:
                     text_sent = True
-                    yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta['content']}})}\n\n"
+                    yield sse_frames.text_delta(0, delta['content'])
 
             # Handle tool calls
             if "tool_calls" in delta and delta["tool_calls"]:
@@ -794,17 +830,17 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                     # If we've been streaming text, close that text block
                     if text_sent and not text_block_closed:
                         text_block_closed = True
-                        yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                        yield sse_frames.block_stop(0)
                     # If we've accumulated text but not sent it, emit it now
                     elif accumulated_text and not text_sent and not text_block_closed:
                         text_sent = True
-                        yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                        yield sse_frames.text_delta(0, accumulated_text)
                         text_block_closed = True
-                        yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                        yield sse_frames.block_stop(0)
                     # Close text block even if we haven't sent anything
                     elif not text_block_closed:
                         text_block_closed = True
-                        yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                        yield sse_frames.block_stop(0)
 
                 for tc in delta["tool_calls"]:
                     tc_index = tc.get("index", 0)
@@ -822,7 +858,7 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                         tool_id = tc.get("id", f"toolu_{uuid.uuid4().hex[:24]}")
 
                         # Start a new tool_use block
-                        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
+                        yield sse_frames.tool_use_block_start(anthropic_tool_index, tool_id, name)
                         tool_index = tc_index
                         tool_content = ""
                     else:
@@ -835,7 +871,7 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                         tool_content += args_json
 
                         # Send the update
-                        yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
+                        yield sse_frames.input_json_delta(anthropic_tool_index, args_json)
 
             # Handle finish reason
             if choice.get("finish_reason") and not has_sent_stop_reason:
@@ -844,13 +880,13 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                 # Close any open tool call blocks
                 if tool_index is not None:
                     for i in range(1, last_tool_index + 1):
-                        yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                        yield sse_frames.block_stop(i)
 
                 # If we accumulated text but never sent or closed text block, do it now
                 if not text_block_closed:
                     if accumulated_text and not text_sent:
-                        yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                        yield sse_frames.text_delta(0, accumulated_text)
+                    yield sse_frames.block_stop(0)
 
                 # Map OpenAI finish_reason to Anthropic stop_reason
                 finish_reason = choice["finish_reason"]
@@ -867,10 +903,10 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
                     "input_tokens": input_tokens,
                     "output_tokens": output_tokens
                 }
-                yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
+                yield sse_frames.message_delta(stop_reason, usage)
 
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse chunk: {data}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.error(f"Failed to parse chunk: {event.text}")
             continue
 
     # If we didn't get a finish reason, close any open blocks
@@ -878,24 +914,24 @@ async def stream_openai_to_anthropic(response: httpx.Response) -> AsyncGenerator
         # Close any open tool call blocks
         if tool_index is not None:
             for i in range(1, last_tool_index + 1):
-                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                yield sse_frames.block_stop(i)
 
         # Close the text content block
         if not text_block_closed:
-            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+            yield sse_frames.block_stop(0)
 
         # Send final message_delta with usage
         usage = {
             "input_tokens": input_tokens,
             "output_tokens": output_tokens
         }
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})}\n\n"
+        yield sse_frames.message_delta('end_turn', usage)
 
     # Send message_stop event
-    yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+    yield sse_frames.MESSAGE_STOP
 
     # Send final [DONE] marker
-    yield "data: [DONE]\n\n"
+    yield b"data: [DONE]\n\n"
 
 
 async def stream_anthropic_to_openai_from_sse(sse_message: str) -> AsyncGenerator[str, None]:
@@ -906,23 +942,20 @@ async def stream_anthropic_to_openai_from_sse(sse_message: str) -> AsyncGenerato
     yield sse_message
 
 
-async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator[str, None]:
+async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator[bytes, None]:
     chunk_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
     tool_calls = []
     tool_index_map = {}  # Maps Anthropic block index to tool call index
     first_chunk = True
 
-    async for line in response.aiter_lines():
-        if not line or not line.startswith("data: "):
-            continue
-
-        data = line[6:]
-        if data == "[DONE]":
-            yield "data: [DONE]\n\n"
+    async for sse_event in aiter_sse_events(response.aiter_bytes()):
+        data = sse_event.data
+        if data == b"[DONE]":
+            yield b"data: [DONE]\n\n"
             break
 
         try:
-            event = json.loads(data)
+            event = json_codec.loads(data)
             event_type = event.get("type")
 
             if event_type == "message_start":
@@ -940,7 +973,7 @@ async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator
                 }
                 if first_chunk:
                     first_chunk = False
-                yield f"data: {json.dumps(chunk)}\n\n"
+                yield b"data: " + json_codec.dumps(chunk) + b"\n\n"
 
             elif event_type == "content_block_start":
                 block = event["content_block"]
@@ -972,7 +1005,7 @@ async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator
                             "finish_reason": None
                         }]
                     }
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                    yield b"data: " + json_codec.dumps(chunk) + b"\n\n"
 
                     tool_calls.append({
                         "id": block["id"],
@@ -999,7 +1032,7 @@ async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator
                             "finish_reason": None
                         }]
                     }
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                    yield b"data: " + json_codec.dumps(chunk) + b"\n\n"
 
                 elif delta["type"] == "input_json_delta":
                     tool_index = tool_index_map.get(block_index, 0)
@@ -1021,7 +1054,7 @@ async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator
                             "finish_reason": None
                         }]
                     }
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                    yield b"data: " + json_codec.dumps(chunk) + b"\n\n"
 
             elif event_type == "message_delta":
                 stop_reason = event.get("delta", {}).get("stop_reason")
@@ -1043,18 +1076,136 @@ async def stream_anthropic_to_openai(response: httpx.Response) -> AsyncGenerator
                     }],
                     "usage": event.get("usage", None)
                 }
-                yield f"data: {json.dumps(chunk)}\n\n"
+                yield b"data: " + json_codec.dumps(chunk) + b"\n\n"
 
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse event: {data}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.error(f"Failed to parse event: {sse_event.text}")
             continue
 
 
+async def open_passthrough(request: Request, headers: Dict[str, str]) -> Tuple[httpx.Response, TopLevelScanner]:
+    """
+    把客户端请求体边接收边转发给后端（不缓冲、不解析），同时增量扫描顶层 stream 和 model 字段。
+    返回已收到响应头的后端响应（调用方负责关闭）和扫描器。
+    """
+    scanner = TopLevelScanner(("stream", "model"))
+    body_sent = asyncio.Event()
+
+    async def body_chunks():
+        async for chunk in request.stream():
+            scanner.feed(chunk)
+            yield chunk
+        body_sent.set()
+
+    async def receive_after_body():
+        # 请求体转发完之前 receive() 返回的是请求体，只能在之后监听断开
+        await body_sent.wait()
+        return await request.receive()
+
+    # 请求体原样转发，带上客户端的 Content-Length 可以避免改用分块传输编码
+    forward_headers = {k: v for k, v in headers.items()
+                       if k.lower() in ["authorization", "content-type", "accept", "x-api-key", "content-length"]}
+
+    client = get_http_client()
+    upstream_request = client.build_request(
+        request.method,
+        f"{BACKEND_BASE_URL}{request.url.path}",
+        headers=forward_headers,
+        content=body_chunks()
+    )
+    # 后端可能在生成完回复后才返回响应头，等待期间客户端断开也立即取消
+    response = await cancel_on_disconnect(receive_after_body, client.send(upstream_request, stream=True),
+                                          "passthrough_headers")
+    return response, scanner
+
+
+async def passthrough_request(request: Request, headers: Dict[str, str], api_format: str):
+    """客户端与后端格式一致时的透传处理，api_format 决定错误响应的格式"""
+    response, scanner = await open_passthrough(request, headers)
+
+    fields = scanner.result()
+    if fields is not None:
+        is_stream = bool(fields.get("stream"))
+        metrics.set_request_model(fields.get("model"))
+    else:
+        # 请求体顶层结构无法识别（通常是非法JSON，由后端返回错误），按响应类型判断
+        logger.warning(f"无法从请求体识别 stream 字段（已扫描 {scanner.bytes_scanned} 字节），按后端响应类型处理")
+        is_stream = response.headers.get("content-type", "").startswith("text/event-stream")
+
+    if response.status_code == 429:
+        # 后端准入控制的限流原样返回状态码和 Retry-After，客户端SDK据此退避重试（流式请求也一样）
+        content = await response.aread()
+        await response.aclose()
+        retry_after = response.headers.get("retry-after")
+        return Response(
+            content=content,
+            status_code=429,
+            media_type="application/json",
+            headers={"Retry-After": retry_after} if retry_after else None
+        )
+
+    if is_stream:
+        async def stream_generator():
+            try:
+                if response.status_code >= 400:
+                    error_text = await response.aread()
+                    logger.error(f"Backend error response: {error_text}")
+                    if api_format == "anthropic":
+                        yield error_frame(error_text, "error")
+                    else:
+                        yield error_frame(error_text)
+                    return
+
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+            finally:
+                await response.aclose()
+
+        return StreamingResponse(
+            buffered(stream_generator(), "passthrough", request.receive, coalesce=coalescing_for(None)),
+            media_type="text/event-stream",
+            background=BackgroundTask(response.aclose)
+        )
+
+    try:
+        # 请求体已经全部转发，客户端断开时不再等后端生成完
+        await cancel_on_disconnect(request.receive, response.aread(), "passthrough_non_stream")
+    finally:
+        await response.aclose()
+
+    if response.status_code >= 400:
+        logger.error(f"Backend error response: {response.text}")
+
+    try:
+        response_data = safe_json_loads(response.content)
+        return CodecJSONResponse(content=response_data, status_code=response.status_code)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse backend response as JSON: {e}")
+        logger.error(f"Backend response text: {response.text[:500]}...")
+        if api_format == "anthropic":
+            content = {
+                "type": "error",
+                "error": {
+                    "type": "backend_error",
+                    "message": f"Backend response parsing failed: {str(e)}"
+                }
+            }
+        else:
+            content = {
+                "error": {
+                    "message": f"Backend response parsing failed: {str(e)}",
+                    "type": "backend_error",
+                    "code": None
+                }
+            }
+        return CodecJSONResponse(content=content, status_code=500)
+
+
 async def forward_request_stream(
         path: str,
         method: str,
         headers: Dict[str, str],
-        body: Optional[bytes] = None,
+        body: Optional[Union[bytes, AsyncIterator[bytes]]] = None,
         params: Optional[Dict[str, Any]] = None
 ):
     url = f"{BACKEND_BASE_URL}{path}"
@@ -1065,36 +1216,36 @@ async def forward_request_stream(
         if key_lower in ["authorization", "content-type", "accept", "x-api-key"]:
             forward_headers[key] = value
 
-    logger.debug(f"Forwarding streaming request to: {url}")
-    logger.debug(f"Headers: {forward_headers}")
-    if body:
-        logger.debug(f"Body: {body[:500]}...")
+    request_log.debug("Forwarding streaming request to: %s", url)
+    request_log.debug("Headers: %s", forward_headers)
+    if isinstance(body, bytes):
+        request_log.debug("Body: %s", preview(body, 500))
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-        async with client.stream(
-                method=method,
-                url=url,
-                headers=forward_headers,
-                content=body,
-                params=params
-        ) as response:
-            logger.debug(f"Response status: {response.status_code}")
+    client = get_http_client()
+    async with client.stream(
+            method=method,
+            url=url,
+            headers=forward_headers,
+            content=body,
+            params=params
+    ) as response:
+        request_log.debug("Response status: %s", response.status_code)
 
-            if response.status_code >= 400:
-                error_text = await response.aread()
-                logger.error(f"Backend error response: {error_text}")
-                raise HTTPException(status_code=response.status_code, detail=error_text.decode())
+        if response.status_code >= 400:
+            error_text = await response.aread()
+            logger.error(f"Backend error response: {error_text}")
+            raise HTTPException(status_code=response.status_code, detail=error_text.decode())
 
-            # For streaming, we'll yield chunks
-            async for chunk in response.aiter_bytes():
-                yield chunk
+        # For streaming, we'll yield chunks
+        async for chunk in response.aiter_bytes():
+            yield chunk
 
 
 async def forward_request(
         path: str,
         method: str,
         headers: Dict[str, str],
-        body: Optional[bytes] = None,
+        body: Optional[Union[bytes, AsyncIterator[bytes]]] = None,
         params: Optional[Dict[str, Any]] = None
 ):
     url = f"{BACKEND_BASE_URL}{path}"
@@ -1105,38 +1256,40 @@ async def forward_request(
         if key_lower in ["authorization", "content-type", "accept", "x-api-key"]:
             forward_headers[key] = value
 
-    logger.debug(f"Forwarding request to: {url}")
-    logger.debug(f"Headers: {forward_headers}")
-    if body:
-        logger.debug(f"Body: {body[:500]}...")
-
-    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-        response = await client.request(
-            method=method,
-            url=url,
-            headers=forward_headers,
-            content=body,
-            params=params
-        )
+    request_log.debug("Forwarding request to: %s", url)
+    request_log.debug("Headers: %s", forward_headers)
+    if isinstance(body, bytes):
+        request_log.debug("Body: %s", preview(body, 500))
+
+    client = get_http_client()
+    response = await client.request(
+        method=method,
+        url=url,
+        headers=forward_headers,
+        content=body,
+        params=params
+    )
 
-        logger.debug(f"Response status: {response.status_code}")
+    request_log.debug("Response status: %s", response.status_code)
 
-        if response.status_code >= 400:
-            error_text = response.text
-            logger.error(f"Backend error response: {error_text}")
+    if response.status_code >= 400:
+        error_text = response.text
+        logger.error(f"Backend error response: {error_text}")
 
-        return response
+    return response
 
 
 @app.post("/v1/chat/completions")
 async def openai_chat_completions(request: Request):
-    body = await request.body()
     headers = dict(request.headers)
 
     try:
-        openai_req = safe_json_loads(body)
-
         if BACKEND_TYPE == "anthropic":
+            body = await read_request_body(request)
+            openai_req = safe_json_loads(body)
+            # 解析后原始请求体不再需要，尽早释放
+            del body
+            metrics.set_request_model(openai_req.get("model"))
             anthropic_req = convert_openai_to_anthropic(openai_req)
 
             if "authorization" in headers:
@@ -1146,100 +1299,57 @@ async def openai_chat_completions(request: Request):
             if openai_req.get("stream"):
                 # For streaming, we need to use httpx.stream properly
                 async def stream_generator():
-                    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-                        async with client.stream(
-                                "POST",
-                                f"{BACKEND_BASE_URL}/v1/messages",
-                                headers={k: v for k, v in headers.items()
-                                         if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
-                                content=json.dumps(anthropic_req).encode()
-                        ) as response:
-                            if response.status_code >= 400:
-                                error_text = await response.aread()
-                                logger.error(f"Backend error response: {error_text}")
-                                yield f"data: {{\"error\": \"{error_text.decode()}\"}}\n\n"
-                                return
-
-                            # Pass the response object to the converter
-                            async for chunk in stream_anthropic_to_openai(response):
-                                yield chunk
+                    client = get_http_client()
+                    async with client.stream(
+                            "POST",
+                            f"{BACKEND_BASE_URL}/v1/messages",
+                            headers={k: v for k, v in headers.items()
+                                     if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
+                            content=json_codec.aiter_dumps(anthropic_req)
+                    ) as response:
+                        if response.status_code >= 400:
+                            error_text = await response.aread()
+                            logger.error(f"Backend error response: {error_text}")
+                            yield error_frame(error_text)
+                            return
+
+                        # Pass the response object to the converter
+                        async for chunk in stream_anthropic_to_openai(response):
+                            yield chunk
 
                 return StreamingResponse(
-                    stream_generator(),
+                    buffered(stream_generator(), "anthropic_to_openai", request.receive,
+                             coalesce=coalescing_for(None)),
                     media_type="text/event-stream"
                 )
             else:
-                response = await forward_request(
+                response = await cancel_on_disconnect(request.receive, forward_request(
                     "/v1/messages",
                     "POST",
                     headers,
-                    json.dumps(anthropic_req).encode()
-                )
+                    json_codec.aiter_dumps(anthropic_req)
+                ), "anthropic_to_openai_non_stream")
 
-                response_text = response.text
-                logger.debug(f"Response from backend: {response_text[:500]}...")
+                request_log.debug("Response from backend: %s", preview(response.content, 500))
 
                 try:
-                    anthropic_resp = json.loads(response_text)
+                    anthropic_resp = json_codec.loads(response.content)
                 except json.JSONDecodeError as e:
                     logger.error(f"Failed to parse response as JSON: {e}")
-                    logger.error(f"Response text: {response_text}")
+                    logger.error(f"Response text: {response.text}")
                     raise
 
                 openai_resp = convert_anthropic_response_to_openai(anthropic_resp)
-                return JSONResponse(content=openai_resp)
+                return CodecJSONResponse(content=openai_resp)
         else:
-            if openai_req.get("stream"):
-                # For streaming with OpenAI backend, properly handle the stream
-                async def stream_generator():
-                    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-                        async with client.stream(
-                                request.method,
-                                f"{BACKEND_BASE_URL}{request.url.path}",
-                                headers={k: v for k, v in headers.items()
-                                         if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
-                                content=body
-                        ) as response:
-                            if response.status_code >= 400:
-                                error_text = await response.aread()
-                                logger.error(f"Backend error response: {error_text}")
-                                yield f"data: {{\"error\": \"{error_text.decode()}\"}}\n\n"
-                                return
-
-                            async for chunk in response.aiter_bytes():
-                                yield chunk
-
-                return StreamingResponse(
-                    stream_generator(),
-                    media_type="text/event-stream"
-                )
-            else:
-                response = await forward_request(
-                    request.url.path,
-                    request.method,
-                    headers,
-                    body
-                )
-                try:
-                    response_data = safe_json_loads(response.content)
-                    return JSONResponse(content=response_data)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse OpenAI backend response as JSON: {e}")
-                    logger.error(f"Backend response text: {response.text[:500]}...")
-                    return JSONResponse(
-                        content={
-                            "error": {
-                                "message": f"Backend response parsing failed: {str(e)}",
-                                "type": "backend_error",
-                                "code": None
-                            }
-                        },
-                        status_code=500
-                    )
+            # 格式一致，请求体边接收边透传
+            return await passthrough_request(request, headers, "openai")
 
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
     except Exception as e:
         logger.error(f"Error in chat completions: {str(e)}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={"error": {"message": str(e), "type": "proxy_error"}},
             status_code=500
         )
@@ -1247,13 +1357,16 @@ async def openai_chat_completions(request: Request):
 
 @app.post("/v1/messages")
 async def anthropic_messages(request: Request):
-    body = await request.body()
+    body = b""
     headers = dict(request.headers)
 
     try:
-        anthropic_req = safe_json_loads(body)
-
         if BACKEND_TYPE == "openai":
+            body = await read_request_body(request)
+            anthropic_req = safe_json_loads(body)
+            # 解析后原始请求体不再需要，尽早释放（之后的JSON错误与请求体无关）
+            body = b""
+            metrics.set_request_model(anthropic_req.get("model"))
             openai_req = convert_anthropic_to_openai(anthropic_req)
 
             if "x-api-key" in headers:
@@ -1263,96 +1376,51 @@ async def anthropic_messages(request: Request):
             if anthropic_req.get("stream"):
                 # For streaming, handle the response directly
                 async def stream_generator():
-                    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-                        async with client.stream(
-                                "POST",
-                                f"{BACKEND_BASE_URL}/v1/chat/completions",
-                                headers={k: v for k, v in headers.items()
-                                         if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
-                                content=json.dumps(openai_req).encode()
-                        ) as response:
-                            if response.status_code >= 400:
-                                error_text = await response.aread()
-                                logger.error(f"Backend error response: {error_text}")
-                                yield f"event: error\ndata: {{\"error\": \"{error_text.decode()}\"}}\n\n"
-                                return
-
-                            # Pass the response object to the converter
-                            async for chunk in stream_openai_to_anthropic(response):
-                                yield chunk
+                    client = get_http_client()
+                    async with client.stream(
+                            "POST",
+                            f"{BACKEND_BASE_URL}/v1/chat/completions",
+                            headers={k: v for k, v in headers.items()
+                                     if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
+                            content=json_codec.aiter_dumps(openai_req)
+                    ) as response:
+                        if response.status_code >= 400:
+                            error_text = await response.aread()
+                            logger.error(f"Backend error response: {error_text}")
+                            yield error_frame(error_text, "error")
+                            return
+
+                        # Pass the response object to the converter
+                        async for chunk in stream_openai_to_anthropic(response):
+                            yield chunk
 
                 return StreamingResponse(
-                    stream_generator(),
+                    buffered(stream_generator(), "openai_to_anthropic", request.receive,
+                             coalesce=coalescing_for(None)),
                     media_type="text/event-stream"
                 )
             else:
-                response = await forward_request(
+                response = await cancel_on_disconnect(request.receive, forward_request(
                     "/v1/chat/completions",
                     "POST",
                     headers,
-                    json.dumps(openai_req).encode()
-                )
+                    json_codec.aiter_dumps(openai_req)
+                ), "openai_to_anthropic_non_stream")
 
-                response_text = response.text
-                logger.debug(f"Response from backend: {response_text[:500]}...")
+                request_log.debug("Response from backend: %s", preview(response.content, 500))
 
                 try:
-                    openai_resp = json.loads(response_text)
+                    openai_resp = json_codec.loads(response.content)
                 except json.JSONDecodeError as e:
                     logger.error(f"Failed to parse response as JSON: {e}")
-                    logger.error(f"Response text: {response_text}")
+                    logger.error(f"Response text: {response.text}")
                     raise
 
                 anthropic_resp = convert_openai_response_to_anthropic(openai_resp)
-                return JSONResponse(content=anthropic_resp)
+                return CodecJSONResponse(content=anthropic_resp)
         else:
-            if anthropic_req.get("stream"):
-                # For streaming with Anthropic backend, properly handle the stream
-                async def stream_generator():
-                    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-                        async with client.stream(
-                                request.method,
-                                f"{BACKEND_BASE_URL}{request.url.path}",
-                                headers={k: v for k, v in headers.items()
-                                         if k.lower() in ["authorization", "content-type", "accept", "x-api-key"]},
-                                content=body
-                        ) as response:
-                            if response.status_code >= 400:
-                                error_text = await response.aread()
-                                logger.error(f"Backend error response: {error_text}")
-                                yield f"event: error\ndata: {{\"error\": \"{error_text.decode()}\"}}\n\n"
-                                return
-
-                            async for chunk in response.aiter_bytes():
-                                yield chunk
-
-                return StreamingResponse(
-                    stream_generator(),
-                    media_type="text/event-stream"
-                )
-            else:
-                response = await forward_request(
-                    request.url.path,
-                    request.method,
-                    headers,
-                    body
-                )
-                try:
-                    response_data = safe_json_loads(response.content)
-                    return JSONResponse(content=response_data)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse backend response as JSON: {e}")
-                    logger.error(f"Backend response text: {response.text[:500]}...")
-                    return JSONResponse(
-                        content={
-                            "type": "error",
-                            "error": {
-                                "type": "backend_error",
-                                "message": f"Backend response parsing failed: {str(e)}"
-                            }
-                        },
-                        status_code=500
-                    )
+            # 格式一致，请求体边接收边透传
+            return await passthrough_request(request, headers, "anthropic")
 
     except json.JSONDecodeError as e:
         logger.error(f"Error in messages - JSON解析失败: {str(e)}")
@@ -1414,7 +1482,7 @@ Content-Length: {headers.get('content-length', 'unknown')}
         except Exception as save_error:
             logger.error(f"保存错误 JSON 文件失败: {save_error}")
 
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "type": "error",
                 "error": {
@@ -1424,11 +1492,13 @@ Content-Length: {headers.get('content-length', 'unknown')}
             },
             status_code=400
         )
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
     except Exception as e:
         logger.error(f"Error in messages: {str(e)}")
         se = traceback.format_exception(e)
         print(se)
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "type": "error",
                 "error": {
@@ -1451,11 +1521,11 @@ async def list_models(request: Request):
     )
     try:
         response_data = safe_json_loads(response.content)
-        return JSONResponse(content=response_data)
+        return CodecJSONResponse(content=response_data)
     except json.JSONDecodeError as e:
         logger.error(f"Failed to parse models response as JSON: {e}")
         logger.error(f"Backend response text: {response.text[:500]}...")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "error": {
                     "message": f"Models endpoint response parsing failed: {str(e)}",
@@ -1478,7 +1548,7 @@ async def count_tokens(request: Request):
         if BACKEND_TYPE == "openai":
             # 对于OpenAI后端，我们自己计算token
             if not TIKTOKEN_AVAILABLE:
-                return JSONResponse(
+                return CodecJSONResponse(
                     content={
                         "type": "error",
                         "error": {
@@ -1496,7 +1566,7 @@ async def count_tokens(request: Request):
                 messages = openai_req["messages"]
                 model = req_data.get("model", "gpt-4")
             else:
-                return JSONResponse(
+                return CodecJSONResponse(
                     content={
                         "type": "error",
                         "error": {
@@ -1508,10 +1578,10 @@ async def count_tokens(request: Request):
                 )
 
             # 计算token数量
-            token_count = count_tokens_openai(messages, model)
+            token_count = await count_tokens_openai(messages, model)
 
             # 返回Anthropic格式的响应
-            return JSONResponse(content={
+            return CodecJSONResponse(content={
                 "input_tokens": token_count
             })
         else:
@@ -1524,11 +1594,11 @@ async def count_tokens(request: Request):
             )
             try:
                 response_data = safe_json_loads(response.content)
-                return JSONResponse(content=response_data)
+                return CodecJSONResponse(content=response_data)
             except json.JSONDecodeError as e:
                 logger.error(f"Failed to parse token counting response as JSON: {e}")
                 logger.error(f"Backend response text: {response.text[:500]}...")
-                return JSONResponse(
+                return CodecJSONResponse(
                     content={
                         "type": "error",
                         "error": {
@@ -1541,7 +1611,7 @@ async def count_tokens(request: Request):
 
     except Exception as e:
         logger.error(f"Token counting error: {str(e)}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "type": "error",
                 "error": {
@@ -1565,7 +1635,7 @@ async def count_tokens_openai_format(request: Request):
         req_data = safe_json_loads(body)
 
         if not TIKTOKEN_AVAILABLE:
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "error": {
                         "message": "tiktoken library not installed, cannot count tokens",
@@ -1578,7 +1648,7 @@ async def count_tokens_openai_format(request: Request):
 
         # 验证必需字段
         if "messages" not in req_data:
-            return JSONResponse(
+            return CodecJSONResponse(
                 content={
                     "error": {
                         "message": "Missing required field: messages",
@@ -1593,10 +1663,10 @@ async def count_tokens_openai_format(request: Request):
         model = req_data.get("model", "gpt-4")
 
         # 计算token数量
-        token_count = count_tokens_openai(messages, model)
+        token_count = await count_tokens_openai(messages, model)
 
         # 返回OpenAI格式的响应
-        return JSONResponse(content={
+        return CodecJSONResponse(content={
             "object": "token_count",
             "model": model,
             "usage": {
@@ -1608,7 +1678,7 @@ async def count_tokens_openai_format(request: Request):
 
     except Exception as e:
         logger.error(f"OpenAI token counting error: {str(e)}")
-        return JSONResponse(
+        return CodecJSONResponse(
             content={
                 "error": {
                     "message": f"Token counting failed: {str(e)}",
@@ -1622,7 +1692,15 @@ async def count_tokens_openai_format(request: Request):
 
 @app.get("/")
 async def health_check():
-    return {"status": "healthy", "backend_type": BACKEND_TYPE, "backend_url": BACKEND_BASE_URL}
+    return {
+        "status": "healthy",
+        "backend_type": BACKEND_TYPE,
+        "backend_url": BACKEND_BASE_URL,
+        "connection_pool": get_pool_stats(http_client),
+        "token_cache": token_counter.get_stats(),
+        "prefix_cache": conversion_cache.get_stats(),
+        "logging": log_pipeline.get_stats()
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+"""
+上游HTTP连接池管理
+
+每个worker进程在lifespan中创建一个共享的 httpx.AsyncClient，
+连接池大小、keepalive过期时间和单主机连接上限均可通过环境变量配置。
+HTTPS上游使用 ResumingSSLContext，新建连接时恢复同一主机之前的TLS会话。
+{prefix}HTTP2=1 时通过 MultiplexedTransport 使用HTTP/2（需要安装 h2），
+并发的流复用在少量连接上，ALPN协商失败时回退到HTTP/1.1。
+"""
+import asyncio
+import logging
+import os
+import ssl
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# create_async_client 创建的客户端 -> 它的传输层，统计时不需要读取 httpx.AsyncClient 的私有属性
+_client_transports: "weakref.WeakKeyDictionary[httpx.AsyncClient, httpx.AsyncBaseTransport]" = weakref.WeakKeyDictionary()
+
+
+class PoolConfig:
+    """连接池配置，从带前缀的环境变量读取"""
+
+    def __init__(self, prefix: str = "BACKEND_POOL_"):
+        self.prefix = prefix
+        self.max_connections = int(os.getenv(f"{prefix}MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv(f"{prefix}MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = float(os.getenv(f"{prefix}KEEPALIVE_EXPIRY", "30"))
+        # 单个主机的最大并发连接数，0 表示不单独限制（仅受 max_connections 约束）
+        self.max_per_host = int(os.getenv(f"{prefix}MAX_PER_HOST", "0"))
+        self.timeout = float(os.getenv(f"{prefix}TIMEOUT", "120"))
+        # HTTP/2（默认关闭）和每个HTTP/2连接承载的最大并发流数
+        self.http2 = os.getenv(f"{prefix}HTTP2", "0").lower() in ("1", "true", "yes")
+        self.http2_max_streams = int(os.getenv(f"{prefix}HTTP2_MAX_STREAMS", "100"))
+
+    def to_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive_connections,
+            "keepalive_expiry": self.keepalive_expiry,
+            "max_per_host": self.max_per_host,
+            "http2": self.http2,
+            "http2_max_streams": self.http2_max_streams
+        }
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    客户端SSL上下文：新连接带上同一主机最近一次连接的TLS会话，服务器接受时只需简短的恢复握手。
+
+    httpcore 建立TLS连接时不会传入 session，这里在 wrap_bio 中按主机名补上。
+    TLS 1.3 的会话票据在握手完成后才到达，所以会话取自该主机仍然存活的连接；
+    每个主机最近的一个连接保留强引用，它关闭后下一个新连接仍能取到它的会话。
+    """
+
+    def __new__(cls, protocol: int = ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        return super().__new__(cls, protocol, *args, **kwargs)
+
+    def __init__(self, protocol: int = ssl.PROTOCOL_TLS_CLIENT):
+        self._sessions_lock = threading.Lock()
+        # 主机名 -> 最近可用的会话 / 该主机的连接（弱引用，连接关闭后自动移除）
+        self._sessions: Dict[str, ssl.SSLSession] = {}
+        self._connections: Dict[str, "weakref.WeakSet[ssl.SSLObject]"] = {}
+        self._latest: Dict[str, ssl.SSLObject] = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if server_side or not server_hostname:
+            return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        with self._sessions_lock:
+            if session is None:
+                session = self._session_for(server_hostname)
+            ssl_object = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+            self._connections.setdefault(server_hostname, weakref.WeakSet()).add(ssl_object)
+            self._latest[server_hostname] = ssl_object
+        return ssl_object
+
+    def _session_for(self, hostname: str) -> Optional[ssl.SSLSession]:
+        latest = self._latest.get(hostname)
+        connections = list(self._connections.get(hostname, ()))
+        for ssl_object in ([latest] if latest is not None else []) + connections:
+            try:
+                session = ssl_object.session
+            except ValueError:
+                # 握手尚未完成的连接
+                continue
+            if session is not None and session.has_ticket:
+                self._sessions[hostname] = session
+                break
+        session = self._sessions.get(hostname)
+        if session is not None and session.time + session.timeout < time.time():
+            del self._sessions[hostname]
+            session = None
+        return session
+
+
+def create_client_ssl_context() -> ResumingSSLContext:
+    """与 ssl.create_default_context() 相同的校验配置（系统CA、校验主机名），支持TLS会话恢复"""
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """响应流关闭时释放主机信号量"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, semaphore: asyncio.Semaphore):
+        self._stream = stream
+        self._semaphore = semaphore
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._semaphore.release()
+
+
+class _StreamCountingStream(httpx.AsyncByteStream):
+    """响应流关闭时减少所在连接分片的活跃流计数"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, shard: "_Shard"):
+        self._stream = stream
+        self._shard = shard
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._shard.active -= 1
+
+
+class _Shard:
+    __slots__ = ("transport", "active")
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self.transport = transport
+        self.active = 0
+
+
+class MultiplexedTransport(httpx.AsyncBaseTransport):
+    """
+    HTTP/2传输：把并发请求分摊到多个连接分片上，每个分片最多 max_streams 个活跃流。
+
+    httpcore 的连接池总是把请求交给已有的HTTP/2连接，超过服务器 MAX_CONCURRENT_STREAMS 的请求
+    在该连接内部排队，而不会新建连接；这里每个分片是一个独立的连接池（实际只保持一条HTTP/2连接），
+    所有分片都满时才新建分片，分片数不超过 max_connections。
+    流量控制由 h2 按流处理：每个流的DATA在被读取后才确认（WINDOW_UPDATE），
+    下游读得慢的流只会暂停自己；限制每条连接的流数也限制了共享同一连接窗口的流数。
+
+    首个响应不是HTTP/2时（ALPN未协商出h2，或明文http）回退到HTTP/1.1：
+    之后所有请求都交给第一个分片，它按连接池配置建立多条HTTP/1.1连接（其余分片的空闲连接按keepalive过期）。
+    """
+
+    def __init__(self, config: PoolConfig, **transport_kwargs):
+        self._config = config
+        self._transport_kwargs = transport_kwargs
+        self._max_streams = max(1, config.http2_max_streams)
+        self._max_shards = max(1, config.max_connections)
+        self._shards: List[_Shard] = [self._new_shard()]
+        # None: 尚未收到响应；True: HTTP/2；False: 已回退到HTTP/1.1
+        self.negotiated_http2: Optional[bool] = None
+
+    def _new_shard(self) -> _Shard:
+        transport = httpx.AsyncHTTPTransport(limits=self._config.to_limits(), http1=True, http2=True,
+                                             **self._transport_kwargs)
+        return _Shard(transport)
+
+    def _select_shard(self) -> _Shard:
+        if self.negotiated_http2 is False:
+            return self._shards[0]
+        shard = min(self._shards, key=lambda s: s.active)
+        if shard.active >= self._max_streams and len(self._shards) < self._max_shards:
+            shard = self._new_shard()
+            self._shards.append(shard)
+        return shard
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        shard = self._select_shard()
+        shard.active += 1
+        try:
+            response = await shard.transport.handle_async_request(request)
+        except BaseException:
+            shard.active -= 1
+            raise
+
+        if self.negotiated_http2 is None:
+            self.negotiated_http2 = response.extensions.get("http_version") == b"HTTP/2"
+            if not self.negotiated_http2:
+                logger.warning(f"上游未协商HTTP/2（{request.url.host}），回退到HTTP/1.1")
+        response.stream = _StreamCountingStream(response.stream, shard)
+        return response
+
+    def pool_transports(self) -> List[httpx.AsyncHTTPTransport]:
+        return [shard.transport for shard in self._shards]
+
+    async def aclose(self) -> None:
+        for shard in self._shards:
+            await shard.transport.aclose()
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """为每个主机限制并发请求数的传输层包装"""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, max_per_host: int):
+        self._transport = transport
+        self._max_per_host = max_per_host
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.waiting = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host_key = f"{request.url.scheme}://{request.url.host}:{request.url.port}"
+        semaphore = self._semaphores.get(host_key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._max_per_host)
+            self._semaphores[host_key] = semaphore
+
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        response.stream = _ReleasingStream(response.stream, semaphore)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def create_async_client(config: Optional[PoolConfig] = None, **client_kwargs) -> httpx.AsyncClient:
+    """创建带连接池配置的共享客户端"""
+    config = config or PoolConfig()
+    transport_kwargs = {}
+    for key in ("verify", "http1", "http2"):
+        if key in client_kwargs:
+            transport_kwargs[key] = client_kwargs.pop(key)
+
+    http2 = transport_kwargs.pop("http2", config.http2)
+    if http2 and not http2_available():
+        logger.warning("未安装 h2（pip install httpx[http2]），使用HTTP/1.1")
+        http2 = False
+    config.http2 = http2
+
+    transport: httpx.AsyncBaseTransport
+    if http2:
+        transport_kwargs.pop("http1", None)
+        transport = MultiplexedTransport(config, **transport_kwargs)
+    else:
+        transport = httpx.AsyncHTTPTransport(limits=config.to_limits(), **transport_kwargs)
+    if config.max_per_host > 0:
+        transport = HostLimitedTransport(transport, config.max_per_host)
+
+    client_kwargs.setdefault("timeout", httpx.Timeout(config.timeout))
+    logger.info(f"创建共享HTTP客户端，连接池配置: {config.to_dict()}")
+    client = httpx.AsyncClient(transport=transport, **client_kwargs)
+    _client_transports[client] = transport
+    return client
+
+
+def get_pool_stats(client: Optional[httpx.AsyncClient]) -> Dict[str, int]:
+    """
+    获取连接池统计：使用中、空闲、等待中的连接/请求数，HTTP/2时还包括活跃的流数。
+    连接数来自 httpcore 连接池的内部状态（requirements.txt 中固定了 httpx/httpcore 的主版本），
+    升级后结构变化时返回空字典，而不是报错或给出错误的数字。
+    """
+    stats = {"in_use": 0, "idle": 0, "waiting": 0}
+    if client is None:
+        return stats
+
+    transport = _client_transports.get(client)
+    if transport is None:
+        # 不是 create_async_client 创建的客户端
+        return {}
+    if isinstance(transport, HostLimitedTransport):
+        stats["waiting"] += transport.waiting
+        transport = transport._transport
+
+    if isinstance(transport, MultiplexedTransport):
+        stats["http2_streams"] = sum(shard.active for shard in transport._shards)
+        transports = transport.pool_transports()
+    else:
+        transports = [transport]
+
+    try:
+        for pool_transport in transports:
+            pool = pool_transport._pool
+            for connection in pool.connections:
+                if connection.is_idle():
+                    stats["idle"] += 1
+                else:
+                    stats["in_use"] += 1
+            stats["waiting"] += sum(1 for request in pool._requests if request.is_queued())
+    except AttributeError as e:
+        logger.debug(f"读取连接池状态失败（httpx/httpcore 内部结构已变化）: {e}")
+        return {}
+
+    return stats
@@ -0,0 +1,186 @@
+"""
+可插拔的JSON编解码层
+
+启动时按 JSON_CODEC 环境变量（auto / orjson / msgspec / json）选择实现：
+auto 模式下优先使用 orjson，其次 msgspec，都未安装时回退到标准库 json。
+dumps 始终返回 bytes，可直接写入响应或SSE帧，省去 str -> bytes 的往返。
+
+输出格式与标准库 json.dumps 的默认设置不同，所有响应和SSE帧的字节都按这个格式：
+- 紧凑分隔符（"," 和 ":" 后没有空格）；
+- 非ASCII字符直接以UTF-8输出，不转义为 \\uXXXX（孤立代理字符除外）；
+- NaN 和 ±Infinity 输出为 null（json.dumps 会输出不合法的 NaN / Infinity）。
+各后端对非字符串键、超过64位的整数、孤立代理字符的处理不同，快速后端不支持时交给标准库，
+最终结果一致（见 test_json_codec.py）；浮点数的指数写法可能不同（1e16 / 1e+16），数值相同。
+"""
+import json
+import logging
+import math
+import os
+from typing import Any, AsyncIterator, Iterator, Union
+
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").lower()
+
+
+def _finite(obj: Any) -> Any:
+    """把 NaN / ±Infinity 替换为 None，与 orjson、msgspec 的输出一致"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    try:
+        text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+    except ValueError as e:
+        if "Out of range float" not in str(e):
+            raise
+        return _stdlib_dumps(_finite(obj))
+    try:
+        return text.encode("utf-8")
+    except UnicodeEncodeError:
+        # 含有孤立代理字符时无法编码为UTF-8，改用 \uXXXX 转义输出
+        return json.dumps(obj, separators=(",", ":"), allow_nan=False).encode("ascii")
+
+
+def _stdlib_encode_string(value: str) -> bytes:
+    return json.encoder.encode_basestring(value).encode("utf-8")
+
+
+def _stdlib_loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def _load_backend(name: str):
+    """返回 (名称, dumps, loads, 字符串编码)，不可用时返回 None"""
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError:
+            return None
+        return "orjson", orjson.dumps, orjson.loads, orjson.dumps
+
+    if name == "msgspec":
+        try:
+            import msgspec
+        except ImportError:
+            return None
+        encoder = msgspec.json.Encoder()
+        decoder = msgspec.json.Decoder()
+        return "msgspec", encoder.encode, decoder.decode, encoder.encode
+
+    if name == "json":
+        return "json", _stdlib_dumps, _stdlib_loads, _stdlib_encode_string
+
+    return None
+
+
+def _select_backend():
+    candidates = ["orjson", "msgspec", "json"] if JSON_CODEC == "auto" else [JSON_CODEC, "json"]
+    for name in candidates:
+        backend = _load_backend(name)
+        if backend is not None:
+            if JSON_CODEC not in ("auto", backend[0]):
+                logger.warning(f"JSON编解码器 {JSON_CODEC} 不可用，回退到 {backend[0]}")
+            return backend
+    return "json", _stdlib_dumps, _stdlib_loads, _stdlib_encode_string
+
+
+CODEC_NAME, _fast_dumps, _fast_loads, _fast_encode_string = _select_backend()
+logger.info(f"使用JSON编解码器: {CODEC_NAME}")
+
+
+def dumps(obj: Any) -> bytes:
+    """序列化为紧凑的UTF-8 JSON字节串"""
+    try:
+        return _fast_dumps(obj)
+    except Exception:
+        # 快速编码器不支持的输入（如超过64位的整数、非字符串键、孤立代理字符）交给标准库处理
+        return _stdlib_dumps(obj)
+
+
+def encode_string(value: str) -> bytes:
+    """把单个字符串编码为带引号的JSON字符串，转义规则与 dumps 内嵌字符串完全一致"""
+    try:
+        return _fast_encode_string(value)
+    except Exception:
+        return _stdlib_dumps(value)
+
+
+def dumps_str(obj: Any) -> str:
+    """序列化为JSON字符串，用于需要str的字段（如tool_call的arguments）"""
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """
+    解析JSON，失败时用标准库重新解析，
+    保证错误类型始终是 json.JSONDecodeError（带 pos/lineno 等诊断信息）
+    """
+    try:
+        return _fast_loads(data)
+    except Exception:
+        if CODEC_NAME == "json":
+            raise
+        return _stdlib_loads(data)
+
+
+# 增量编码时每次输出的目标块大小
+ENCODE_CHUNK_SIZE = 64 * 1024
+
+
+def iter_dumps(obj: Any, chunk_size: int = ENCODE_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    增量序列化，拼接结果与 dumps(obj) 相同。
+    顶层对象的列表字段（如 messages）按元素逐个编码，累积到 chunk_size 就输出一块，
+    大请求不会在内存中同时存在完整的编码结果。
+    """
+    if not isinstance(obj, dict) or not all(isinstance(key, str) for key in obj):
+        yield dumps(obj)
+        return
+
+    buffer = bytearray(b"{")
+    for i, (key, value) in enumerate(obj.items()):
+        if i:
+            buffer += b","
+        buffer += encode_string(key)
+        buffer += b":"
+        if isinstance(value, list) and value:
+            buffer += b"["
+            for j, item in enumerate(value):
+                if j:
+                    buffer += b","
+                buffer += dumps(item)
+                if len(buffer) >= chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+            buffer += b"]"
+        else:
+            buffer += dumps(value)
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b"}"
+    yield bytes(buffer)
+
+
+async def aiter_dumps(obj: Any, chunk_size: int = ENCODE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """iter_dumps 的异步版本，可直接作为 httpx.AsyncClient 的 content 流式上传"""
+    for chunk in iter_dumps(obj, chunk_size):
+        yield chunk
+
+
+class CodecJSONResponse(JSONResponse):
+    """使用当前编解码器直接渲染为bytes的JSONResponse"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,251 @@
+"""
+JSON顶层字段扫描器
+
+透传请求时只需要知道少数顶层字段（如 stream），不必把整个请求体解析成Python对象。
+扫描器逐块接收字节（feed），只在顶层逐字节处理，字符串和嵌套结构用 bytes.find / 正则跳过，
+内存占用与请求体大小无关，可以边接收边扫描。
+
+扫描器不是完整的JSON校验器：只保证顶层结构正确。结构错误、目标字段的值不是标量
+或过长时 result() 返回 None，调用方应回退到完整解析。重复键按最后一次出现为准，与 json.loads 一致。
+"""
+import json
+import re
+from typing import Any, Dict, Iterable, Optional
+
+# 从字符串内部匹配到结束引号（含）
+_STRING_REST = re.compile(rb'(?:[^"\\]++|\\.)*+"', re.DOTALL)
+# 嵌套结构内一次跳过非括号内容和不含转义的短字符串，停在括号或其他字符串的开头；
+# 长字符串（如base64图片）交给 bytes.find 处理，避免正则逐字符匹配
+_NESTED_SKIP = re.compile(rb'(?:[^"{}\[\]]++|"[^"\\]{0,4096}+")*+')
+_WHITESPACE = b" \t\r\n"
+# 顶层键和目标字段值的捕获上限
+_MAX_CAPTURE = 256
+
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+_OPEN_OBJECT = ord("{")
+_CLOSE_OBJECT = ord("}")
+_OPEN_ARRAY = ord("[")
+_COMMA = ord(",")
+_COLON = ord(":")
+
+
+class TopLevelScanner:
+    """增量扫描JSON对象的顶层字段，只提取 keys 中列出的标量值"""
+
+    def __init__(self, keys: Iterable[str] = ("stream",)):
+        self.wanted = frozenset(keys)
+        self.values: Dict[str, Any] = {}
+        self.bytes_scanned = 0
+
+        self._depth = 0
+        self._state = "start"  # start / key_or_end / key / colon / value / scalar / comma / done
+        self._in_string = False
+        self._escaped = False
+        self._capture: Optional[bytearray] = None  # 正在捕获的顶层键或目标值
+        self._capture_kind: Optional[str] = None  # "key" / "value"
+        self._capture_overflow = False
+        self._current_key: Optional[str] = None
+        self._unresolved = False  # 目标字段的值无法由扫描器确定
+        self._invalid = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done" or self._invalid
+
+    def feed(self, chunk: bytes) -> None:
+        if self._invalid:
+            return
+        self.bytes_scanned += len(chunk)
+        pos, end = 0, len(chunk)
+
+        while pos < end:
+            if self._in_string:
+                pos = self._scan_string(chunk, pos, end)
+                continue
+
+            if self._depth >= 2:
+                pos = _NESTED_SKIP.match(chunk, pos).end()
+                if pos >= end:
+                    return
+                c = chunk[pos]
+                pos += 1
+                if c == _QUOTE:
+                    self._in_string = True
+                elif c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 1:
+                        self._state = "comma"
+                continue
+
+            c = chunk[pos]
+            pos += 1
+            state = self._state
+
+            if state == "scalar":
+                if c == _COMMA or c == _CLOSE_OBJECT or c in _WHITESPACE:
+                    self._finish_scalar()
+                    if self._invalid:
+                        return
+                    state = self._state = "comma"
+                    if c in _WHITESPACE:
+                        continue
+                else:
+                    self._append_capture(chunk[pos - 1:pos])
+                    continue
+
+            if c in _WHITESPACE:
+                continue
+
+            if state == "start":
+                if c != _OPEN_OBJECT:
+                    self._invalid = True
+                    return
+                self._depth = 1
+                self._state = "key_or_end"
+            elif state == "key_or_end" or state == "key":
+                if c == _QUOTE:
+                    self._start_capture("key")
+                elif c == _CLOSE_OBJECT and state == "key_or_end":
+                    self._depth = 0
+                    self._state = "done"
+                else:
+                    self._invalid = True
+                    return
+            elif state == "colon":
+                if c != _COLON:
+                    self._invalid = True
+                    return
+                self._state = "value"
+            elif state == "value":
+                wanted = self._current_key in self.wanted
+                if c == _QUOTE:
+                    if wanted:
+                        self._start_capture("value")
+                    else:
+                        self._in_string = True
+                        self._capture = None
+                        self._state = "comma"
+                elif c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                    if wanted:
+                        self._unresolved = True
+                    self._depth = 2
+                else:
+                    self._capture = bytearray(chunk[pos - 1:pos]) if wanted else None
+                    self._capture_overflow = False
+                    self._state = "scalar"
+            elif state == "comma":
+                if c == _COMMA:
+                    self._state = "key"
+                elif c == _CLOSE_OBJECT:
+                    self._depth = 0
+                    self._state = "done"
+                else:
+                    self._invalid = True
+                    return
+            else:
+                # 顶层对象之后出现了非空白内容
+                self._invalid = True
+                return
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """扫描完成时返回找到的目标字段，无法确定时返回 None"""
+        if self._state == "scalar":
+            self._finish_scalar()
+            self._state = "comma"
+        if self._invalid or self._unresolved or self._state != "done":
+            return None
+        return dict(self.values)
+
+    def _start_capture(self, kind: str):
+        self._in_string = True
+        self._capture = bytearray(b'"')
+        self._capture_kind = kind
+        self._capture_overflow = False
+
+    def _append_capture(self, data: bytes):
+        if self._capture is None or self._capture_overflow:
+            return
+        if len(self._capture) + len(data) > _MAX_CAPTURE:
+            self._capture_overflow = True
+            return
+        self._capture += data
+
+    def _scan_string(self, chunk: bytes, pos: int, end: int) -> int:
+        """跳到字符串结束引号之后，返回新的位置；字符串未结束时返回 end"""
+        if self._escaped:
+            self._escaped = False
+            self._append_capture(chunk[pos:pos + 1])
+            pos += 1
+        start = pos
+        # 常见情况：没有转义字符，直接用 find 定位结束引号
+        quote = chunk.find(b'"', pos, end)
+        if chunk.find(b"\\", pos, end if quote < 0 else quote) < 0:
+            if quote >= 0:
+                return self._end_string(chunk, start, quote)
+            self._append_capture(chunk[start:end])
+            return end
+
+        match = _STRING_REST.match(chunk, pos, end)
+        if match is None:
+            # 本块内字符串没有结束，记录末尾反斜杠的奇偶以处理跨块转义
+            run = 0
+            while run < end - start and chunk[end - 1 - run] == _BACKSLASH:
+                run += 1
+            self._escaped = run % 2 == 1
+            self._append_capture(chunk[start:end])
+            return end
+
+        return self._end_string(chunk, start, match.end() - 1)
+
+    def _end_string(self, chunk: bytes, start: int, quote: int) -> int:
+        self._in_string = False
+        if self._capture is not None:
+            self._append_capture(chunk[start:quote + 1])
+            self._finish_string()
+        return quote + 1
+
+    def _finish_string(self):
+        raw, overflow, kind = self._capture, self._capture_overflow, self._capture_kind
+        self._capture = None
+        self._capture_kind = None
+        if kind == "key":
+            self._current_key = None if overflow else self._decode(raw)
+            self._state = "colon"
+        else:
+            if overflow:
+                self._unresolved = True
+            else:
+                self._store(self._decode(raw))
+            self._state = "comma"
+
+    def _finish_scalar(self):
+        raw, overflow = self._capture, self._capture_overflow
+        self._capture = None
+        if raw is None:
+            return
+        if overflow:
+            self._unresolved = True
+            return
+        self._store(self._decode(raw))
+
+    def _store(self, value: Any):
+        if not self._invalid:
+            self.values[self._current_key] = value
+
+    def _decode(self, raw: bytearray) -> Any:
+        try:
+            return json.loads(bytes(raw))
+        except ValueError:
+            self._invalid = True
+            return None
+
+
+def scan_top_level(body: bytes, keys: Iterable[str] = ("stream",)) -> Optional[Dict[str, Any]]:
+    """一次性扫描完整请求体"""
+    scanner = TopLevelScanner(keys)
+    scanner.feed(body)
+    return scanner.result()
+
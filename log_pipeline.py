@@ -0,0 +1,345 @@
+"""
+异步结构化日志
+
+事件循环线程只做三件事：过滤（采样）、格式化消息文本、放进有界队列；
+JSON序列化和写文件/终端都在 QueueListener 的后台线程中完成，磁盘I/O不再阻塞事件循环。
+
+- 队列满时直接丢弃新日志并计数（按级别），队列恢复后补发一条“丢弃了N条日志”的警告，
+  丢弃数同时导出到 /metrics 的 cb2api_log_dropped_total；
+- 每个HTTP请求分配一个 request_id 并决定是否采样（LOG_SAMPLE_RATE，默认 1.0 即全部采样）。
+  未采样的请求中 WARNING 以下的日志在过滤阶段就被丢掉，连消息格式化都不做，
+  热路径上的调试日志可以一直保留在代码里；WARNING 及以上始终输出；
+- 默认输出原来的纯文本格式；LOG_FORMAT=json 时每行一个JSON对象，包含 request_id，
+  python-json-logger 未安装时使用内置的格式化器；
+- 请求热路径使用 request_logger(__name__) 返回的门面：级别未开启或请求未采样时不创建日志记录，
+  参数用 %s 占位，请求体预览之类的值用 preview() / Lazy 包装，只有日志真正输出时才切片和转换。
+
+导入本模块不会修改任何日志配置，setup_logging() 由应用入口（各服务的 lifespan 和 __main__）调用。
+
+环境变量：LOG_LEVEL、LOG_FORMAT（text/json）、LOG_QUEUE_SIZE、LOG_SAMPLE_RATE。
+"""
+import atexit
+import contextvars
+import itertools
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, Optional
+
+import json_codec
+from metrics import Counter
+
+try:
+    from pythonjsonlogger.json import JsonFormatter
+    JSON_LOGGER_AVAILABLE = True
+except ImportError:
+    try:
+        from pythonjsonlogger.jsonlogger import JsonFormatter
+        JSON_LOGGER_AVAILABLE = True
+    except ImportError:
+        JSON_LOGGER_AVAILABLE = False
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+JSON_FIELDS = '%(asctime)s %(levelname)s %(name)s %(request_id)s %(message)s'
+
+LOG_DROPPED = Counter("cb2api_log_dropped_total", "日志队列已满被丢弃的日志数", ("level",))
+
+# 当前请求的 (request_id, 是否采样)，请求之外为 None
+_request_context: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar("log_request_context", default=None)
+_request_counter = itertools.count(1)
+_request_prefix = f"{os.getpid():x}"
+
+_listener: Optional[QueueListener] = None
+_handler: Optional["BoundedQueueHandler"] = None
+
+
+def new_request_id() -> str:
+    return f"{_request_prefix}-{next(_request_counter):x}"
+
+
+def current_request_id(default: Optional[str] = None) -> Optional[str]:
+    context = _request_context.get()
+    return context[0] if context is not None else default
+
+
+def is_sampled() -> bool:
+    """当前请求是否采样；请求之外总是 True。热路径上构造代价大的日志前可以先检查它"""
+    context = _request_context.get()
+    return context is None or context[1]
+
+
+def begin_request(request_id: Optional[str] = None, sample_rate: Optional[float] = None) -> contextvars.Token:
+    """为当前协程设置请求上下文，返回的 token 交给 end_request 恢复"""
+    rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    sampled = rate >= 1.0 or random.random() < rate
+    return _request_context.set((request_id or new_request_id(), sampled))
+
+
+def end_request(token: contextvars.Token) -> None:
+    _request_context.reset(token)
+
+
+class Lazy:
+    """延迟计算的日志参数：只有日志真正输出、格式化消息时才调用 func(*args)"""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable[..., Any], *args: Any):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+    __repr__ = __str__
+
+
+def _preview(value: Any, limit: int) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        # 只解码需要的前缀（UTF-8单个字符最多4字节）
+        text = bytes(value[:limit * 4]).decode("utf-8", errors="replace")
+        truncated = len(text) > limit or len(value) > limit * 4
+    else:
+        text = value if isinstance(value, str) else str(value)
+        truncated = len(text) > limit
+    return text[:limit] + "..." if truncated else text
+
+
+def preview(value: Any, limit: int = 200) -> Lazy:
+    """截断后的预览，超出 limit 时以 ... 结尾"""
+    return Lazy(_preview, value, limit)
+
+
+class RequestLogger:
+    """请求热路径的日志门面
+
+    和 logging.Logger 的用法相同（debug/info/warning/error/exception，%s 占位），区别是：
+    级别未开启、或当前请求未被采样且级别低于 WARNING 时直接返回，不创建 LogRecord，
+    参数中的 Lazy/preview 也不会被计算。
+    """
+
+    __slots__ = ("logger",)
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level) and (level >= logging.WARNING or is_sampled())
+
+    def _emit(self, level: int, msg: str, args: tuple, kwargs: Dict[str, Any]) -> None:
+        # stacklevel 让 funcName/lineno 指向调用方而不是门面
+        kwargs.setdefault("stacklevel", 3)
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        if self.isEnabledFor(logging.DEBUG):
+            self._emit(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        if self.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, msg, args, kwargs)
+
+    def warning(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._emit(logging.WARNING, msg, args, kwargs)
+
+    def error(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, msg, args, kwargs)
+
+    def exception(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        kwargs.setdefault("exc_info", True)
+        self.error(msg, *args, **kwargs)
+
+
+def request_logger(name: str) -> RequestLogger:
+    return RequestLogger(name)
+
+
+class RequestContextFilter(logging.Filter):
+    """补上 request_id 字段，并丢掉未采样请求中 WARNING 以下的日志"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _request_context.get()
+        if context is None:
+            record.request_id = "-"
+            return True
+        if not context[1] and record.levelno < logging.WARNING:
+            return False
+        record.request_id = context[0]
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    """非阻塞地把日志放进有界队列，队列满时丢弃并计数"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped: Dict[str, int] = {}
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在事件循环线程里把消息和异常格式化成文本（参数对象可能在之后被修改），
+        # JSON序列化留给后台线程
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self._unreported and not self.queue.full():
+            self._report_dropped(record)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+            self._unreported += 1
+            LOG_DROPPED.labels(record.levelname).inc()
+
+    def _report_dropped(self, record: logging.LogRecord) -> None:
+        count, self._unreported = self._unreported, 0
+        notice = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            f"日志队列已满，丢弃了 {count} 条日志", None, None
+        )
+        notice.request_id = getattr(record, "request_id", "-")
+        try:
+            self.queue.put_nowait(notice)
+        except queue.Full:
+            self._unreported += count
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "dropped": dict(self.dropped),
+        }
+
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class _BuiltinJsonFormatter(logging.Formatter):
+    """python-json-logger 未安装时使用的JSON格式化器"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "asctime": self.formatTime(record),
+            "levelname": record.levelname,
+            "name": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json_codec.dumps(entry).decode("utf-8")
+
+
+def create_formatter(fmt: str = LOG_FORMAT) -> logging.Formatter:
+    if fmt != "json":
+        return logging.Formatter(TEXT_FORMAT)
+    if JSON_LOGGER_AVAILABLE:
+        return JsonFormatter(JSON_FIELDS, json_ensure_ascii=False)
+    return _BuiltinJsonFormatter()
+
+
+def setup_logging(log_file: Optional[str] = None, level: str = LOG_LEVEL,
+                  fmt: str = LOG_FORMAT, queue_size: int = LOG_QUEUE_SIZE) -> BoundedQueueHandler:
+    """把根日志器接到异步队列上；重复调用（例如 server.py 同时导入 main 和 format_proxy）时只补充文件输出"""
+    global _listener, _handler
+    formatter = create_formatter(fmt)
+
+    if _handler is not None and _listener is not None:
+        # 已经配置过：新增的文件输出需要重启监听线程才能生效
+        existing = {getattr(h, "baseFilename", None) for h in _listener.handlers}
+        if log_file and os.path.abspath(log_file) not in existing:
+            file_handler = logging.FileHandler(log_file, encoding="utf-8")
+            file_handler.setFormatter(formatter)
+            handlers = _listener.handlers
+            _listener.stop()
+            _listener = QueueListener(_handler.queue, *handlers, file_handler, respect_handler_level=True)
+            _listener.start()
+        return _handler
+
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        outputs.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    _handler = BoundedQueueHandler(queue.Queue(maxsize=queue_size))
+    _handler.addFilter(RequestContextFilter())
+    _listener = QueueListener(_handler.queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    # uvicorn 命令行在导入应用前已经给自己的日志器装好了同步输出，改为交给根日志器的队列
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        for existing in list(uvicorn_logger.handlers):
+            uvicorn_logger.removeHandler(existing)
+        uvicorn_logger.propagate = True
+    return _handler
+
+
+def shutdown_logging() -> None:
+    """停止后台线程（会先写完队列里剩余的日志）"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_stats() -> Dict[str, Any]:
+    return _handler.get_stats() if _handler is not None else {}
+
+
+class RequestContextMiddleware:
+    """ASGI中间件：为每个HTTP请求设置 request_id 和采样决定，响应头带上 X-Request-ID"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        token = begin_request(request_id)
+        request_id = current_request_id()
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            end_request(token)
+
+
+def install(app) -> None:
+    app.add_middleware(RequestContextMiddleware)
@@ -1,5 +1,7 @@
 import asyncio
+import hashlib
 import json
+import os
 import time
 import re
 from contextlib import asynccontextmanager
@@ -11,23 +13,48 @@ import aiofiles
 import httpx
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 import logging
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("codebuddy_proxy.log"),
-        logging.StreamHandler()
-    ]
-)
+from sse_parser import aiter_sse_events
+import json_codec
+import log_pipeline
+from log_pipeline import preview
+import metrics
+from admission import AdmissionRejected, admission
+from completion_accumulator import CompletionAccumulator
+from disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, Receive, cancel_on_disconnect
+from http_pool import PoolConfig, create_async_client, create_client_ssl_context
+from api_keys import ApiKeyIndex, KeyInfo
+from prefix_cache import PrefixCache
+from stream_buffer import buffered, coalescing_for
+from shared_state import SHARED_STATE_SOCKET, SHARED_STATE_TIMEOUT, SharedStateClient
+
+# 日志在 lifespan / __main__ 中配置（异步队列，写文件和终端都在后台线程中进行）
+LOG_FILE = "codebuddy_proxy.log"
 logger = logging.getLogger(__name__)
+# 请求热路径上的日志：级别未开启或请求未采样时不格式化参数
+request_log = log_pipeline.request_logger(__name__)
+
+# 上游接口地址（可指向 benchmarks/mock_backend.py 等本地模拟后端）
+CODEBUDDY_API_URL = os.getenv("CODEBUDDY_API_URL", "https://www.codebuddy.ai/v2/chat/completions")
+
+# 客户端密钥文件，修改后由后台任务自动重载（检查间隔秒数，0 表示不监视）
+CLIENT_KEYS_FILE = "client.json"
+CLIENT_KEYS_RELOAD_INTERVAL = float(os.getenv("CLIENT_KEYS_RELOAD_INTERVAL", "2"))
+
+# 消息规范化的对话前缀缓存
+normalize_cache = PrefixCache("normalize_messages")
+
+# 每个worker共享一个到CodeBuddy的客户端，复用连接和TLS会话
+upstream_client: Optional[httpx.AsyncClient] = None
 
 class TokenStatus:
     def __init__(self, token: str):
         self.token = token
+        # 共享状态中以摘要作为键，access_token 不出现在sidecar和广播中
+        self.digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
         self.is_available = True
         self.reset_time = None  # UTC时间戳
         self.error_count = 0
@@ -40,10 +67,15 @@ class ConfigManager:
         self.available_tokens = []
         self.token_cycle = None
         self.models_map = {}
-        self.api_keys = []
+        self.api_keys = ApiKeyIndex()
+        self._api_keys_signature = None  # client.json 的 (mtime_ns, size)，用于判断是否需要重载
         self._lock = asyncio.Lock()
         self._last_check_time = 0  # 上次检查时间
         self._check_interval = 30  # 检查间隔（秒）
+        # 多worker模式下的共享状态（设置了 SHARED_STATE_SOCKET 时）
+        self.shared: Optional[SharedStateClient] = None
+        # 正在发送到sidecar的token状态（尽力而为，不阻塞请求）
+        self._shared_updates: set = set()
 
     async def load_configs(self):
         # 从 codebuddy_accounts.txt 读取 access_token
@@ -74,12 +106,87 @@ class ConfigManager:
                 raise ValueError("没有找到有效的 access_token")
 
         async with aiofiles.open("models.json", "r") as f:
-            self.models_map = json.loads(await f.read())
+            self.models_map = json_codec.loads(await f.read())
             logger.info(f"✅ 成功加载 {len(self.models_map)} 个模型映射")
 
-        async with aiofiles.open("client.json", "r") as f:
-            self.api_keys = json.loads(await f.read())
-            logger.info(f"✅ 成功加载 {len(self.api_keys)} 个API密钥")
+        await self.reload_api_keys()
+
+        if SHARED_STATE_SOCKET:
+            await self.connect_shared_state(SHARED_STATE_SOCKET)
+
+    async def connect_shared_state(self, socket_path: str):
+        """连接共享状态sidecar：密钥、模型映射和token限流状态在所有worker之间共享"""
+        self.shared = SharedStateClient(socket_path)
+        self.shared.on_change(self._on_shared_change)
+        await self.shared.connect()
+        # 第一个启动的worker把本地加载的配置写入共享状态，其余worker以共享状态为准
+        await self.shared.setnx("config:models_map", self.models_map)
+        await self.shared.setnx("config:api_keys", self.api_keys.to_entries())
+        logger.info(f"🔗 已连接共享状态 {socket_path}，可用token {len(self.available_tokens)}/{len(self.auth_tokens)}")
+
+    async def close(self):
+        if self._shared_updates:
+            await asyncio.wait(self._shared_updates, timeout=SHARED_STATE_TIMEOUT)
+        if self.shared is not None:
+            await self.shared.close()
+            self.shared = None
+
+    def _on_shared_change(self, key: str, value: Any):
+        """其他worker（或本worker）修改共享状态后同步到本地"""
+        if key.startswith("config:") and value is None:
+            # sidecar重启后快照里没有配置，保留本地已有的配置
+            return
+        if key == "config:models_map":
+            self.models_map = value
+        elif key == "config:api_keys":
+            try:
+                self.api_keys = ApiKeyIndex.from_config(value)
+            except ValueError as e:
+                logger.error(f"❌ 共享状态中的API密钥格式无效，保留本地密钥: {e}")
+        elif key.startswith("token:"):
+            digest = key[len("token:"):]
+            for token, status in self.token_statuses.items():
+                if status.digest == digest:
+                    self._merge_token_state(token, status, value)
+                    break
+
+    def _merge_token_state(self, token: str, status: TokenStatus, state: Optional[Dict[str, Any]]):
+        """合并共享状态中的token状态；共享状态里没有、本地还未到重置时间的限流不会被清除"""
+        if state is None and not status.is_available and status.reset_time and status.reset_time > time.time():
+            # sidecar重启后快照是空的，上游已经报告限流的token不能被其他worker立即重试，把本地状态写回
+            self._publish_token_state(token, {
+                "reset_time": status.reset_time,
+                "error_count": status.error_count,
+                "last_error_message": status.last_error_message,
+            })
+            return
+        self._apply_token_state(token, state)
+
+    def _apply_token_state(self, token: str, state: Optional[Dict[str, Any]]):
+        """把token的限流状态应用到本地，state 为 None 表示恢复可用"""
+        status = self.token_statuses.get(token)
+        if status is None:
+            return
+
+        if state:
+            status.is_available = False
+            status.reset_time = state.get("reset_time")
+            status.error_count = state.get("error_count", status.error_count)
+            status.last_error_message = state.get("last_error_message")
+            if token not in self.available_tokens:
+                return
+            self.available_tokens.remove(token)
+        else:
+            status.is_available = True
+            status.reset_time = None
+            status.error_count = 0
+            status.last_error_message = None
+            if token in self.available_tokens:
+                return
+            self.available_tokens.append(token)
+
+        # 重新创建cycle
+        self.token_cycle = cycle(self.available_tokens) if self.available_tokens else None
 
     async def get_next_token(self):
         """获取下一个可用的token"""
@@ -110,29 +217,48 @@ class ConfigManager:
         async with self._lock:
             if token in self.token_statuses:
                 status = self.token_statuses[token]
-                status.is_available = False
-                status.error_count += 1
-                status.last_error_message = error_message
 
                 # 解析重置时间
                 reset_time = self._parse_reset_time(error_message)
                 if reset_time:
-                    status.reset_time = reset_time
                     logger.warning(f"⚠️ Token已被标记为频率受限，重置时间: {datetime.fromtimestamp(reset_time, timezone.utc)}")
                 else:
                     # 如果无法解析重置时间，设置默认1小时后重试
-                    status.reset_time = time.time() + 3600
+                    reset_time = time.time() + 3600
                     logger.warning(f"⚠️ Token已被标记为频率受限，默认1小时后重试")
 
-                # 从可用token列表中移除
-                if token in self.available_tokens:
-                    self.available_tokens.remove(token)
-                    # 重新创建cycle
-                    if self.available_tokens:
-                        self.token_cycle = cycle(self.available_tokens)
-                        logger.info(f"🔄 剩余可用token数量: {len(self.available_tokens)}")
-                    else:
-                        logger.error("❌ 所有token都不可用!")
+                # 从可用token列表中移除，本地状态立即生效
+                state = {
+                    "reset_time": reset_time,
+                    "error_count": status.error_count + 1,
+                    "last_error_message": error_message,
+                }
+                self._apply_token_state(token, state)
+                if self.available_tokens:
+                    logger.info(f"🔄 剩余可用token数量: {len(self.available_tokens)}")
+                else:
+                    logger.error("❌ 所有token都不可用!")
+
+                # 释放锁之后再广播给其他worker
+                self._publish_token_state(token, state)
+
+    def _publish_token_state(self, token: str, state: Optional[Dict[str, Any]]):
+        """在后台把token状态发给sidecar；sidecar不可用时只影响其他worker，本地状态已经生效"""
+        if self.shared is None:
+            return
+        task = asyncio.create_task(self._send_token_state(token, state))
+        self._shared_updates.add(task)
+        task.add_done_callback(self._shared_updates.discard)
+
+    async def _send_token_state(self, token: str, state: Optional[Dict[str, Any]]):
+        key = f"token:{self.token_statuses[token].digest}"
+        try:
+            if state is None:
+                await asyncio.wait_for(self.shared.delete(key), SHARED_STATE_TIMEOUT)
+            else:
+                await asyncio.wait_for(self.shared.set(key, state), SHARED_STATE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, RuntimeError) as e:
+            logger.warning(f"⚠️ 同步token状态到共享状态失败，仅在本worker生效: {e!r}")
 
     def _parse_reset_time(self, error_message: str) -> Optional[float]:
         """解析错误消息中的重置时间"""
@@ -161,25 +287,20 @@ class ConfigManager:
     async def _check_and_restore_tokens(self):
         """检查并恢复已到重置时间的token"""
         current_time = time.time()
-        restored_count = 0
+        restored = []
 
         # 只检查不可用的token，避免遍历所有token
         for token, status in self.token_statuses.items():
             if not status.is_available and status.reset_time and current_time >= status.reset_time:
-                # 恢复token
-                status.is_available = True
-                status.reset_time = None
-                status.error_count = 0
-                status.last_error_message = None
+                restored.append(token)
 
-                if token not in self.available_tokens:
-                    self.available_tokens.append(token)
-                    restored_count += 1
+        for token in restored:
+            # 恢复token
+            self._apply_token_state(token, None)
+            self._publish_token_state(token, None)
 
-        if restored_count > 0:
-            # 重新创建cycle
-            self.token_cycle = cycle(self.available_tokens)
-            logger.info(f"🔄 恢复了 {restored_count} 个token，当前可用token数量: {len(self.available_tokens)}")
+        if restored:
+            logger.info(f"🔄 恢复了 {len(restored)} 个token，当前可用token数量: {len(self.available_tokens)}")
 
     def _has_tokens_ready_for_recovery(self) -> bool:
         """快速检查是否有token即将恢复（不需要锁）"""
@@ -189,8 +310,33 @@ class ConfigManager:
                 return True
         return False
 
+    async def reload_api_keys(self, path: str = CLIENT_KEYS_FILE) -> bool:
+        """client.json 有变化时重新加载密钥，返回是否重载
+
+        新索引完整解析后才替换 self.api_keys，处理中的请求已经拿到自己的 KeyInfo，不受影响；
+        文件格式错误时抛出异常，旧索引继续生效。
+        """
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._api_keys_signature:
+            return False
+        # 先记录签名，格式错误的文件不会在每次检查时重复报错，再次修改后才重试
+        self._api_keys_signature = signature
+
+        async with aiofiles.open(path, "r") as f:
+            index = ApiKeyIndex.from_config(json_codec.loads(await f.read()))
+        self.api_keys = index
+        logger.info(f"✅ 成功加载 {len(index)} 个API密钥")
+
+        if self.shared is not None:
+            await self.shared.set("config:api_keys", index.to_entries())
+        return True
+
+    def lookup_api_key(self, api_key: Optional[str]) -> Optional[KeyInfo]:
+        return self.api_keys.lookup(api_key)
+
     def validate_api_key(self, api_key):
-        return api_key in self.api_keys
+        return self.lookup_api_key(api_key) is not None
 
     def get_token_status_summary(self):
         """获取token状态摘要"""
@@ -225,10 +371,23 @@ class ChatCompletionRequest(BaseModel):
     tools: Optional[List[Dict[str, Any]]] = None
 
 
+async def read_request_body(request: Request) -> bytes:
+    """读取完整请求体；与 request.body() 不同，结果不会缓存在 Request 上，解析后可以及时释放"""
+    chunks = [chunk async for chunk in request.stream()]
+    return b"".join(chunks)
+
+
 def safe_json_loads(data: Union[bytes, str]) -> Dict[str, Any]:
     """
     安全的JSON解析函数，自动处理bytes/string类型转换和详细错误诊断
     """
+    # 快速路径：绝大多数请求体是合法JSON，直接交给编解码器解析bytes，失败再走下面的诊断流程
+    if isinstance(data, (bytes, str)):
+        try:
+            return json_codec.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass
+
     try:
         # 检测数据类型并进行适当转换
         if isinstance(data, bytes):
@@ -276,10 +435,9 @@ def safe_json_loads(data: Union[bytes, str]) -> Dict[str, Any]:
         logger.error(f"JSON解析错误 - 位置: 第{e.lineno}行第{e.colno}列 (字符{e.pos})")
         logger.error(f"错误消息: {e.msg}")
         if isinstance(data, (bytes, str)):
-            # 安全地显示前200个字符用于调试，避免敏感信息泄露
-            preview = str(data)[:200] if len(str(data)) > 200 else str(data)
-            logger.error(f"请求体预览: {preview}...")
-            logger.error(f"数据类型: {type(data)}, 长度: {len(data)}")
+            # 安全地显示前200个字符用于调试，避免敏感信息泄露（只转换需要的前缀）
+            request_log.error("请求体预览: %s", preview(data, 200))
+            request_log.error("数据类型: %s, 长度: %d", type(data), len(data))
 
             # 检查是否有多个JSON对象连接在一起
             data_str = data.decode('utf-8') if isinstance(data, bytes) else data
@@ -406,14 +564,28 @@ async def token_recovery_task():
             logger.error(f"❌ Token恢复任务异常: {e}")
 
 
+async def api_keys_watch_task():
+    """后台任务：client.json 修改后自动重载客户端密钥"""
+    while True:
+        await asyncio.sleep(CLIENT_KEYS_RELOAD_INTERVAL)
+        try:
+            await config_manager.reload_api_keys()
+        except Exception as e:
+            logger.error(f"❌ 重载 {CLIENT_KEYS_FILE} 失败，继续使用已加载的密钥: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global upstream_client
+    log_pipeline.setup_logging(LOG_FILE)
     logger.info("🚀 正在启动 CodeBuddy API 代理服务...")
     await config_manager.load_configs()
+    upstream_client = create_upstream_client()
 
     # 启动后台token恢复任务
     recovery_task = asyncio.create_task(token_recovery_task())
     logger.info("🔄 Token恢复后台任务已启动")
+    watch_task = asyncio.create_task(api_keys_watch_task()) if CLIENT_KEYS_RELOAD_INTERVAL > 0 else None
 
     logger.info("🎉 CodeBuddy API 代理服务启动完成!")
     try:
@@ -426,9 +598,20 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
         logger.info("🛑 Token恢复后台任务已停止")
+        if watch_task is not None:
+            watch_task.cancel()
+            try:
+                await watch_task
+            except asyncio.CancelledError:
+                pass
+        await upstream_client.aclose()
+        upstream_client = None
+        await config_manager.close()
 
 
 app = FastAPI(lifespan=lifespan)
+metrics.install(app, "codebuddy")
+log_pipeline.install(app)
 
 
 @app.get("/v1/models")
@@ -479,26 +662,166 @@ async def get_token_status():
     }
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: Request):
-    # 验证API密钥
-    auth_header = request.headers.get("Authorization")
+@app.get("/v1/admission/status")
+async def get_admission_status():
+    """按客户端密钥的并发、排队深度和排队耗时"""
+    return admission.get_stats()
+
+
+class UpstreamError(Exception):
+    """CodeBuddy上游阶段的错误，由调用方按各自接口的格式返回给客户端"""
+
+    def __init__(self, status_code: int, message: str, content: Optional[bytes] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.content = content
+
+
+def check_api_key(auth_header: Optional[str]) -> KeyInfo:
+    """验证API密钥并返回其元数据，失败时抛出 UpstreamError(401)"""
     if not auth_header:
-        return Response(
-            content=json.dumps({"error": "Missing Authorization header"}),
-            status_code=401,
-            media_type="application/json"
-        )
+        raise UpstreamError(401, "Missing Authorization header")
 
     api_key = auth_header.replace("Bearer ", "") if auth_header.startswith("Bearer ") else auth_header
-    if not config_manager.validate_api_key(api_key):
+    key = config_manager.lookup_api_key(api_key)
+    if key is None:
+        raise UpstreamError(401, "Invalid API key")
+    return key
+
+
+def admission_rejected_response(e: AdmissionRejected) -> Response:
+    """准入控制拒绝的请求：OpenAI格式的429"""
+    return Response(
+        content=json_codec.dumps({
+            "error": {"message": e.message, "type": "rate_limit_exceeded", "param": None, "code": "rate_limit_exceeded"}
+        }),
+        status_code=429,
+        media_type="application/json",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def prepare_codebuddy_body(body: Dict[str, Any], key: Optional[KeyInfo] = None) -> str:
+    """把OpenAI格式请求就地改写为CodeBuddy请求（模型映射、消息转换），返回客户端请求的模型ID"""
+    # 从请求中获取模型ID并映射到CodeBuddy内部模型名称
+    model_id = body.get("model")
+    if model_id not in config_manager.models_map:
+        raise UpstreamError(404, f"Model {model_id} not found")
+    if key is not None and not key.allows_model(model_id):
+        raise UpstreamError(403, f"API key '{key.label}' is not allowed to use model {model_id}")
+    metrics.set_request_model(model_id)
+
+    # 替换模型ID
+    body["model"] = config_manager.models_map[model_id]
+
+    # 替换messages中的system prompt
+    messages = body.get("messages", [])
+    request_id = log_pipeline.current_request_id(f"req-{int(time.time() * 1000)}")
+
+    # 修复工具调用序列、转换system消息并插入占位system消息
+    body["messages"] = normalize_messages(messages, request_id)
+    return model_id
+
+
+def create_upstream_ssl_context() -> ssl.SSLContext:
+    """创建访问CodeBuddy的SSL上下文（TLS 1.3，支持会话恢复），只在启动时创建一次"""
+    ssl_context = create_client_ssl_context()
+    # 检查系统是否支持TLS 1.3
+    if hasattr(ssl, "TLSVersion") and hasattr(ssl.TLSVersion, "TLSv1_3"):
+        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_3
+        ssl_context.maximum_version = ssl.TLSVersion.TLSv1_3
+    else:
+        # 如果系统不支持TLS 1.3，使用最高可用版本
+        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return ssl_context
+
+
+def create_upstream_client() -> httpx.AsyncClient:
+    """
+    创建访问CodeBuddy的共享客户端（连接池由 UPSTREAM_POOL_* 环境变量配置）。
+    默认使用HTTP/1.1；UPSTREAM_POOL_HTTP2=1 时启用HTTP/2多路复用，服务器不支持时自动回退。
+    """
+    return create_async_client(
+        PoolConfig("UPSTREAM_POOL_"),
+        verify=create_upstream_ssl_context(),
+        timeout=600,
+        event_hooks={"request": [metrics.upstream_connect_hook("codebuddy")]}
+    )
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    """获取共享的上游客户端，未经lifespan初始化时按需创建"""
+    global upstream_client
+    if upstream_client is None:
+        upstream_client = create_upstream_client()
+    return upstream_client
+
+
+@asynccontextmanager
+async def codebuddy_stream(body: Dict[str, Any]):
+    """
+    向CodeBuddy发送（已经过 prepare_codebuddy_body 处理的）请求，返回流式的 httpx.Response。
+    上游返回非200时读取错误内容、处理频率限制后抛出 UpstreamError。
+    """
+    # 获取下一个可用的认证令牌
+    try:
+        auth_token = await config_manager.get_next_token()
+    except ValueError as e:
+        raise UpstreamError(503, str(e))
+
+    # 构建请求头
+    headers = get_codebuddy_headers(auth_token)
+
+    async with get_upstream_client().stream(
+            "POST",
+            CODEBUDDY_API_URL,
+            content=json_codec.dumps(body),
+            headers=headers,
+            timeout=600
+    ) as response:
+        # 检查响应状态
+        if response.status_code != 200:
+            error_content = await response.aread()
+            error_text = error_content.decode('utf-8', errors='ignore')
+
+            # 检查是否是频率限制错误
+            if "usage exceeds frequency limit" in error_text:
+                logger.warning(f"⚠️ 检测到频率限制错误: {error_text}")
+                await config_manager.mark_token_rate_limited(auth_token, error_text)
+
+            raise UpstreamError(response.status_code, error_text, error_content)
+
+        yield response
+
+
+async def collect_completion(response: httpx.Response, model_id: str) -> Dict[str, Any]:
+    """把上游的OpenAI流式响应聚合为非流式的 chat.completion（模型使用客户端请求的模型ID）"""
+    accumulator = CompletionAccumulator()
+    async for event in aiter_sse_events(response.aiter_bytes()):
+        if event.data == b"[DONE]":
+            break
+        try:
+            chunk = json_codec.loads(event.data)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+        accumulator.add_chunk(chunk)
+    return accumulator.build(model_id)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    # 验证API密钥
+    try:
+        key = check_api_key(request.headers.get("Authorization"))
+    except UpstreamError as e:
         return Response(
-            content=json.dumps({"error": "Invalid API key"}),
-            status_code=401,
+            content=json_codec.dumps({"error": e.message}),
+            status_code=e.status_code,
             media_type="application/json"
         )
 
-    raw_body = await request.body()
+    raw_body = await read_request_body(request)
     try:
         body = safe_json_loads(raw_body)
     except json.JSONDecodeError as e:
@@ -523,355 +846,204 @@ async def chat_completions(request: Request):
                 logger.error(f"调试信息提取失败: {debug_error}")
 
         return Response(
-            content=json.dumps({"error": f"无效的JSON格式: {str(e)}"}),
+            content=json_codec.dumps({"error": f"无效的JSON格式: {str(e)}"}),
             status_code=400,
             media_type="application/json"
         )
 
-    # 从请求中获取模型ID并映射到CodeBuddy内部模型名称
-    model_id = body.get("model")
-    if model_id not in config_manager.models_map:
-        return Response(
-            content=json.dumps({"error": f"Model {model_id} not found"}),
-            status_code=404,
-            media_type="application/json"
-        )
+    # 解析完成后原始请求体不再需要，尽早释放
+    del raw_body
 
-    # 替换模型ID
-    body["model"] = config_manager.models_map[model_id]
+    return await handle_chat_completion(body, key, request.receive)
 
-    # 替换messages中的system prompt
-    messages = body.get("messages", [])
-    request_id = f"req-{int(time.time() * 1000)}"
-
-    # 转换消息
-    transformed_messages = transform_messages(messages, request_id)
-    transformed_messages.insert(0, {"role": "system", "content": '.'})
-    body["messages"] = transformed_messages
-    # system = None
-    # for m in messages:
-    #     if m["role"] == "system":
-    #         system = m["content"]
-    #         break
-    # if system is None:
-    # body["messages"] = messages
 
-    # 获取下一个可用的认证令牌
-    auth_token = await config_manager.get_next_token()
+async def handle_chat_completion(body: Dict[str, Any], key: Optional[KeyInfo] = None,
+                                 receive: Optional[Receive] = None) -> Response:
+    """
+    处理已解析的OpenAI格式请求（同进程网关 server.py 也直接调用这里）。
+    传入ASGI receive 时监听客户端断开，断开后立即取消上游请求。
+    """
+    try:
+        model_id = prepare_codebuddy_body(body, key)
+    except UpstreamError as e:
+        return Response(
+            content=json_codec.dumps({"error": e.message}),
+            status_code=e.status_code,
+            media_type="application/json"
+        )
 
-    # 构建请求头
-    headers = get_codebuddy_headers(auth_token)
+    # 按客户端密钥排队，拿到名额后才占用上游连接；名额在响应结束（流式为流结束）时归还
+    ticket = None
+    if key is not None:
+        try:
+            ticket = await admission.acquire(key)
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
 
     # 确定是否为流式请求
     is_stream = body.get("stream", False)
 
-    url = "https://www.codebuddy.ai/v2/chat/completions"
-
-    # 创建自定义SSL上下文，指定TLS 1.3
-    ssl_context = ssl.create_default_context()
-    # 检查系统是否支持TLS 1.3
-    if hasattr(ssl, "TLSVersion") and hasattr(ssl.TLSVersion, "TLSv1_3"):
-        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_3
-        ssl_context.maximum_version = ssl.TLSVersion.TLSv1_3
-    else:
-        # 如果系统不支持TLS 1.3，使用最高可用版本
-        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-
-    # 创建httpx客户端，使用自定义SSL上下文
-    http_client = httpx.AsyncClient(
-        http2=False,  # 禁用HTTP/2，因为服务器可能不支持
-        verify=ssl_context,
-        timeout=600
-    )
-
     if is_stream:
         async def stream_response_generator():
-            async with http_client as client:
-                async with client.stream(
-                        "POST",
-                        url,
-                        json=body,
-                        headers=headers,
-                        timeout=600
-                ) as response:
-                    # 检查响应状态
-                    if response.status_code != 200:
-                        error_content = await response.aread()
-                        error_text = error_content.decode('utf-8', errors='ignore')
-
-                        # 检查是否是频率限制错误
-                        if "usage exceeds frequency limit" in error_text:
-                            logger.warning(f"⚠️ 流式请求检测到频率限制错误: {error_text}")
-                            await config_manager.mark_token_rate_limited(auth_token, error_text)
-
-                        # 返回错误信息
-                        yield f"data: {json.dumps({'error': error_text})}\n\n".encode()
-                        return
-
+            try:
+                async with codebuddy_stream(body) as response:
                     async for chunk in response.aiter_bytes():
                         yield chunk
+            except UpstreamError as e:
+                # 返回错误信息
+                yield b"data: " + json_codec.dumps({'error': e.message}) + b"\n\n"
+            finally:
+                if ticket is not None:
+                    ticket.release()
 
         return StreamingResponse(
-            stream_response_generator(),
-            media_type="text/event-stream"
+            buffered(stream_response_generator(), "codebuddy", receive, coalesce=coalescing_for(key)),
+            media_type="text/event-stream",
+            # 客户端断开时生成器可能不会运行到 finally，由后台任务兜底归还名额
+            background=BackgroundTask(ticket.release) if ticket is not None else None
         )
     else:
         body["stream"] = True
-        async with httpx.AsyncClient() as client:
-            response_id = None
-            response_model = body["model"]
-            content_parts = []
-            tool_calls = []
-            finish_reason = None
-            usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            response_status = 200
-
-            async with client.stream(
-                    "POST",
-                    url,
-                    json=body,
-                    headers=headers,
-                    timeout=600
-            ) as response:
-                response_status = response.status_code
-                if response_status != 200:
-                    error_content = await response.read()
-                    error_text = error_content.decode('utf-8', errors='ignore')
-
-                    # 检查是否是频率限制错误
-                    if "usage exceeds frequency limit" in error_text:
-                        logger.warning(f"⚠️ 检测到频率限制错误: {error_text}")
-                        await config_manager.mark_token_rate_limited(auth_token, error_text)
-
-                    return Response(
-                        content=error_content,
-                        status_code=response_status,
-                        media_type="application/json"
-                    )
-
-                async for line in response.aiter_lines():
-                    if not line or not line.startswith("data: "):
-                        continue
-
-                    if line == "data: [DONE]":
-                        break
-
-                    try:
-                        data = json.loads(line[6:])  # Remove "data: " prefix
-
-                        # Extract response ID from first chunk
-                        if response_id is None:
-                            response_id = data.get("id")
-
-                        # Process choices
-                        for choice in data.get("choices", []):
-                            delta = choice.get("delta", {})
-
-                            # Collect content
-                            if "content" in delta and delta["content"]:
-                                content_parts.append(delta["content"])
-
-                            # Collect tool calls
-                            if "tool_calls" in delta and delta["tool_calls"]:
-                                for tool_call in delta["tool_calls"]:
-                                    # Find existing tool call to update or add new one
-                                    if tool_call.get("index") is not None:
-                                        idx = tool_call.get("index")
-                                        while len(tool_calls) <= idx:
-                                            tool_calls.append(
-                                                {"type": "function", "function": {"name": "", "arguments": ""}})
-
-                                        # Update function name if present
-                                        if "function" in tool_call:
-                                            if "name" in tool_call["function"] and tool_call["function"]["name"]:
-                                                tool_calls[idx]["function"]["name"] = tool_call["function"]["name"]
-
-                                            # Append to arguments if present
-                                            if "arguments" in tool_call["function"] and tool_call["function"][
-                                                "arguments"] is not None:
-                                                tool_calls[idx]["function"]["arguments"] += tool_call["function"][
-                                                    "arguments"]
-
-                                        # Add ID and type if present
-                                        if "id" in tool_call:
-                                            tool_calls[idx]["id"] = tool_call["id"]
-                                        if "type" in tool_call:
-                                            tool_calls[idx]["type"] = tool_call["type"]
-
-                            # Get finish reason from last chunk
-                            if "finish_reason" in choice and choice["finish_reason"]:
-                                finish_reason = choice["finish_reason"]
-
-                        # Update usage stats from the last chunk
-                        if "usage" in data:
-                            usage = data["usage"]
-                    except json.JSONDecodeError:
-                        continue
-
-            # Construct final response in OpenAI format
-            final_response = {
-                "id": response_id or f"chatcmpl-{int(time.time() * 1000)}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model_id,  # Use original model ID requested by client
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": "".join(content_parts) if not tool_calls else None,
-                            "tool_calls": tool_calls if tool_calls else None
-                        },
-                        "finish_reason": finish_reason or "stop"
-                    }
-                ],
-                "usage": usage
-            }
-
-            # Remove None values for cleaner JSON
-            if final_response["choices"][0]["message"]["content"] is None:
-                del final_response["choices"][0]["message"]["content"]
-            if final_response["choices"][0]["message"]["tool_calls"] is None:
-                del final_response["choices"][0]["message"]["tool_calls"]
 
+        async def complete() -> Dict[str, Any]:
+            async with codebuddy_stream(body) as response:
+                return await collect_completion(response, model_id)
+
+        try:
+            final_response = await cancel_on_disconnect(receive, complete(), "codebuddy_non_stream")
+        except UpstreamError as e:
             return Response(
-                content=json.dumps(final_response),
-                status_code=200,
+                content=e.content if e.content is not None else json_codec.dumps({"error": e.message}),
+                status_code=e.status_code,
                 media_type="application/json"
             )
+        except ClientDisconnected:
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+        finally:
+            if ticket is not None:
+                ticket.release()
 
+        return Response(
+            content=json_codec.dumps(final_response),
+            status_code=200,
+            media_type="application/json"
+        )
 
-def fix_tool_call_sequence(messages: List[Dict], request_id: str) -> List[Dict]:
-    """修复工具调用中断导致的消息序列问题"""
-    if not messages:
-        return messages
-
-    fixed_messages = []
-    i = 0
-
-    while i < len(messages):
-        current_msg = messages[i]
-
-        # 检查是否是assistant的tool_calls消息
-        if (current_msg.get("role") == "assistant" and
-            current_msg.get("tool_calls")):
-
-            # 收集所有工具调用ID
-            expected_tool_ids = {tc.get("id") for tc in current_msg.get("tool_calls", []) if tc.get("id")}
-
-            # 添加tool_calls消息
-            fixed_messages.append(current_msg)
-            i += 1
 
-            # 查找对应的tool_result消息
-            tool_results = []
+def normalize_messages(messages: List[Dict], request_id: str) -> List[Dict]:
+    """
+    一次遍历完成CodeBuddy需要的消息规范化：
+    - 修复工具调用中断：assistant的tool_calls之后插入的用户消息移到对应的tool_result之后
+    - 把system角色转换为user角色（只复制这些消息，其余消息原样复用）
+    - 在最前面插入占位的system消息
+    同一段对话已处理过的前缀从 normalize_cache 中取出，只处理新增的消息。
+    """
+    match = normalize_cache.match(messages)
+    normalized = match.restore() or [{"role": "system", "content": "."}]
+    if match.start:
+        request_log.debug("[%s] 复用缓存的前 %d 条消息", request_id, match.start)
+    # 最近一个不在工具调用收集中的位置：messages[:clean_index] 的结果 normalized[:clean_length] 不会再变
+    clean_index = match.start
+    clean_length = len(normalized)
+    system_to_user_count = 0
+    moved_count = 0
+    # 逐条消息的调试日志：每个请求只判断一次级别
+    debug = request_log.isEnabledFor(logging.DEBUG)
+
+    # 正在收集的工具调用：预期的ID、找到的ID、tool_result数量和暂存的插入消息
+    expected_tool_ids = None
+    found_tool_ids = set()
+    tool_result_count = 0
+    potential_interrupts = []
+
+    for index in range(match.start, len(messages)):
+        message = messages[index]
+        role = message.get("role")
+
+        if expected_tool_ids is not None:
+            # 如果是tool_result消息
+            if role == "tool" and message.get("tool_call_id"):
+                tool_call_id = message.get("tool_call_id")
+                # 验证tool_call_id是否匹配
+                if tool_call_id in expected_tool_ids:
+                    found_tool_ids.add(tool_call_id)
+                    if debug:
+                        request_log.debug("[%s] 找到匹配的tool_result: %s", request_id, tool_call_id)
+                else:
+                    # 仍然添加，但记录警告
+                    request_log.warning("[%s] 发现不匹配的tool_result ID: %s", request_id, tool_call_id)
+                normalized.append(message)
+                tool_result_count += 1
+                continue
+
+            # 如果是用户消息，暂存（无论是中断还是其他原因）
+            if role == "user":
+                potential_interrupts.append(message)
+                if debug:
+                    request_log.debug("[%s] 检测到插入的用户消息，暂存", request_id)
+                continue
+
+            # 遇到其他消息，结束收集，当前消息继续按普通消息处理
+            _finish_tool_calls(normalized, expected_tool_ids, found_tool_ids, tool_result_count, potential_interrupts, request_id)
+            moved_count += len(potential_interrupts)
+            expected_tool_ids = None
+
+        clean_index = index
+        clean_length = len(normalized)
+        if role == "assistant" and message.get("tool_calls"):
+            # 收集所有工具调用ID，开始查找对应的tool_result消息
+            expected_tool_ids = {tc.get("id") for tc in message.get("tool_calls", []) if tc.get("id")}
             found_tool_ids = set()
+            tool_result_count = 0
             potential_interrupts = []
-
-            # 收集后续消息直到找到所有tool_result或遇到新的assistant消息
-            while i < len(messages):
-                next_msg = messages[i]
-
-                # 如果是tool_result消息
-                if (next_msg.get("role") == "tool" and
-                    next_msg.get("tool_call_id")):
-                    tool_call_id = next_msg.get("tool_call_id")
-
-                    # 验证tool_call_id是否匹配
-                    if tool_call_id in expected_tool_ids:
-                        tool_results.append(next_msg)
-                        found_tool_ids.add(tool_call_id)
-                        logger.debug(f"[{request_id}] 找到匹配的tool_result: {tool_call_id}")
-                    else:
-                        logger.warning(f"[{request_id}] 发现不匹配的tool_result ID: {tool_call_id}")
-                        # 仍然添加，但记录警告
-                        tool_results.append(next_msg)
-
-                    i += 1
-
-                # 如果是用户消息，暂存（无论是中断还是其他原因）
-                elif next_msg.get("role") == "user":
-                    potential_interrupts.append(next_msg)
-                    logger.debug(f"[{request_id}] 检测到插入的用户消息，暂存")
-                    i += 1
-                    continue
-
-                # 如果遇到新的assistant消息，停止收集
-                elif next_msg.get("role") == "assistant":
-                    break
-                else:
-                    # 其他类型消息，停止收集
-                    break
-
-            # 处理插入的消息：无论是中断还是其他原因，都需要重新排列
-            if potential_interrupts:
-                logger.info(f"[{request_id}] 检测到 {len(potential_interrupts)} 个插入消息，将其移到tool_result之后")
-
-                # 验证工具调用完整性
-                missing_tools = expected_tool_ids - found_tool_ids
-                if missing_tools:
-                    logger.warning(f"[{request_id}] 缺少工具调用结果: {missing_tools}")
-
-                    # 如果缺少工具结果，可能需要特殊处理
-                    # 但仍然要保持消息序列的正确性
-                    pass
-
-            # 添加所有找到的tool_result消息
-            fixed_messages.extend(tool_results)
-
-            # 将插入的消息放在tool_result之后（保持API规范的同时不丢失消息）
-            fixed_messages.extend(potential_interrupts)
-
-            if tool_results:
-                logger.info(f"[{request_id}] 修复工具调用序列：找到 {len(tool_results)} 个tool_result，预期 {len(expected_tool_ids)} 个")
-            if potential_interrupts:
-                logger.info(f"[{request_id}] 将 {len(potential_interrupts)} 个插入消息移到tool_result之后")
+            normalized.append(message)
+        elif role == "system":
+            system_to_user_count += 1
+            if debug:
+                request_log.debug("[%s] 将第 %d 条消息从 system 转换为 user", request_id, len(normalized))
+                # 记录转换的内容（只显示前100个字符）
+                request_log.debug("[%s] 转换内容预览: %s", request_id, preview(message.get("content", ""), 100))
+            normalized.append({**message, "role": "user"})
         else:
-            # 普通消息，直接添加
-            fixed_messages.append(current_msg)
-            i += 1
-
-    return fixed_messages
-
-
+            normalized.append(message)
 
+    if expected_tool_ids is None:
+        clean_index = len(messages)
+        clean_length = len(normalized)
+    else:
+        _finish_tool_calls(normalized, expected_tool_ids, found_tool_ids, tool_result_count, potential_interrupts, request_id)
+        moved_count += len(potential_interrupts)
+    match.commit(clean_index, normalized[:clean_length])
 
-def transform_messages(messages: List[Dict], request_id: str) -> List[Dict]:
-    """转换消息，将所有system角色转换为user角色"""
-    # 首先修复工具调用序列
-    messages = fix_tool_call_sequence(messages, request_id)
-
-    transformed_messages = []
-    system_to_user_count = 0
-
-    for i, message in enumerate(messages):
-        transformed_message = message.copy()
-
-        if message.get("role") == "system":
-            transformed_message["role"] = "user"
-            system_to_user_count += 1
-            logger.info(f"[{request_id}] 将第 {i + 1} 条消息从 system 转换为 user")
+    # 长对话中每组工具调用的细节只在DEBUG级别输出，INFO级别每个请求一行汇总
+    if moved_count > 0:
+        request_log.info("[%s] 修复工具调用序列：将 %d 个插入消息移到tool_result之后", request_id, moved_count)
+    if system_to_user_count > 0:
+        request_log.info("[%s] 总共转换了 %d 条 system 消息为 user 消息", request_id, system_to_user_count)
+    elif not match.start:
+        request_log.info("[%s] 没有发现需要转换的 system 消息", request_id)
 
-            # 记录转换的内容（只显示前100个字符）
-            content = message.get("content", "")
-            if isinstance(content, str):
-                content_preview = content[:100] + "..." if len(content) > 100 else content
-            else:
-                content_preview = str(content)[:100] + "..." if len(str(content)) > 100 else str(content)
-            logger.debug(f"[{request_id}] 转换内容预览: {content_preview}")
+    return normalized
 
-        transformed_messages.append(transformed_message)
 
-    if system_to_user_count > 0:
-        logger.info(f"[{request_id}] 总共转换了 {system_to_user_count} 条 system 消息为 user 消息")
-    else:
-        logger.info(f"[{request_id}] 没有发现需要转换的 system 消息")
+def _finish_tool_calls(normalized: List[Dict], expected_tool_ids: set, found_tool_ids: set,
+                       tool_result_count: int, potential_interrupts: List[Dict], request_id: str) -> None:
+    """一组工具调用收集结束：把插入的消息放在tool_result之后（保持API规范的同时不丢失消息）"""
+    if potential_interrupts:
+        request_log.debug("[%s] 检测到 %d 个插入消息，将其移到tool_result之后", request_id, len(potential_interrupts))
+        # 验证工具调用完整性
+        missing_tools = expected_tool_ids - found_tool_ids
+        if missing_tools:
+            request_log.warning("[%s] 缺少工具调用结果: %s", request_id, missing_tools)
+        normalized.extend(potential_interrupts)
 
-    return transformed_messages
+    if tool_result_count:
+        request_log.debug("[%s] 修复工具调用序列：找到 %d 个tool_result，预期 %d 个", request_id, tool_result_count, len(expected_tool_ids))
 
 if __name__ == "__main__":
     import uvicorn
 
+    log_pipeline.setup_logging(LOG_FILE)
     logger.info("🔧 正在启动 uvicorn 服务器...")
     logger.info("📡 服务将在 http://0.0.0.0:8000 上运行")
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,366 @@
+"""
+进程内的轻量指标
+
+只在事件循环线程中更新，不加锁；健康检查端点直接输出 to_dict() 的结果，
+/metrics 端点按 Prometheus 文本格式输出本模块中注册的所有指标。
+
+记录一次请求只需要几次 perf_counter 和字典查找，流式响应每个数据块多一次 bytes.count，
+可以在生产环境常开；设置 METRICS_ENABLED=0 时不安装中间件（/metrics 仍然可用）。
+"""
+import abc
+import bisect
+import contextvars
+import functools
+import math
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "False")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认桶边界（秒），覆盖从亚毫秒到数秒的耗时
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """固定桶的累积直方图"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        # +Inf 桶总是单独统计，传入的 inf 边界忽略，避免输出重复的 le="+Inf"
+        self.buckets = tuple(sorted(bound for bound in buckets if bound != math.inf))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """按桶上界估算分位数，落在 +Inf 桶时返回最大的有限边界"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict[str, Any]:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class _Family(abc.ABC):
+    """带标签的指标族，labels(...) 返回（并缓存）对应标签组合的子指标"""
+
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """创建一个标签组合对应的子指标"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        for values, child in self._children.items():
+            lines.extend(self._render_child(dict(zip(self.labelnames, values)), child))
+        return lines
+
+    def _render_child(self, labels: Dict[str, str], child) -> List[str]:
+        return [f"{self.name}{format_labels(labels)} {format_value(child.value)}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Family):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Family):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+
+class HistogramFamily(_Family):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return Histogram(self.buckets)
+
+    def _render_child(self, labels: Dict[str, str], child) -> List[str]:
+        return render_histogram(self.name, labels, child)
+
+
+REGISTRY: List[_Family] = []
+# 输出时额外调用的采集函数（例如准入控制按密钥的队列状态），返回若干行文本
+COLLECTORS: List[Callable[[], Iterable[str]]] = []
+
+
+def format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_value(value: float) -> str:
+    """按 Prometheus 文本格式输出数值，非有限值写成 +Inf / -Inf / NaN"""
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render_histogram(name: str, labels: Dict[str, Any], histogram: Histogram) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative}")
+    lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+    lines.append(f"{name}_sum{format_labels(labels)} {format_value(round(histogram.sum, 6))}")
+    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+    return lines
+
+
+def render() -> str:
+    lines: List[str] = []
+    for family in REGISTRY:
+        lines.extend(family.render())
+    for collector in COLLECTORS:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Prometheus 抓取端点"""
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
+# 代理热路径上的指标（main.py、format_proxy.py、server.py 共用，同进程网关中也只注册一次）
+STREAM_EVENT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 请求耗时包括流式响应的整个生成过程，桶边界延伸到数分钟
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+REQUESTS_TOTAL = Counter("cb2api_requests_total", "按端点、模型、状态码和后端统计的请求数",
+                         ("endpoint", "model", "status", "backend"))
+REQUEST_DURATION = HistogramFamily("cb2api_request_duration_seconds", "请求总耗时（流式响应到流结束）",
+                                   ("endpoint", "backend"), REQUEST_BUCKETS)
+TIME_TO_FIRST_BYTE = HistogramFamily("cb2api_time_to_first_byte_seconds", "从收到请求到发出第一个响应体字节的耗时",
+                                     ("endpoint", "backend"), REQUEST_BUCKETS)
+UPSTREAM_CONNECT = HistogramFamily("cb2api_upstream_connect_seconds", "新建上游连接耗时（TCP + TLS握手）",
+                                   ("backend",))
+UPSTREAM_TLS_HANDSHAKES = Counter("cb2api_upstream_tls_handshakes_total", "新建上游连接的TLS握手次数（resumed=true 为会话恢复）",
+                                  ("backend", "resumed"))
+UPSTREAM_CONNECTIONS = Counter("cb2api_upstream_connections_total", "新建的上游连接数（protocol 为ALPN协商的协议）",
+                               ("backend", "protocol"))
+CONVERSION_DURATION = HistogramFamily("cb2api_conversion_seconds", "格式转换函数耗时", ("function",))
+SSE_EVENTS = HistogramFamily("cb2api_sse_events_per_stream", "每个流式响应发出的SSE事件数",
+                             ("endpoint", "backend"), STREAM_EVENT_BUCKETS)
+INFLIGHT_STREAMS = Gauge("cb2api_inflight_streams", "正在进行的流式响应数", ("endpoint", "backend"))
+STREAM_BUFFER_BYTES = Gauge("cb2api_stream_buffer_bytes", "流式响应缓冲中等待客户端取走的字节数", ("stream",))
+STREAM_BUFFER_STALLS = Counter("cb2api_stream_buffer_stalls_total", "缓冲区满、暂停读取上游的次数", ("stream",))
+STREAM_BUFFER_STALL_SECONDS = Counter("cb2api_stream_buffer_stall_seconds_total", "暂停读取上游的总时长", ("stream",))
+STALLED_STREAMS = Counter("cb2api_stalled_streams_total", "至少暂停过一次读取上游的流式响应数", ("stream",))
+STREAM_WRITES = Counter("cb2api_stream_writes_total", "流式响应写给客户端的次数（每次一个ASGI send）", ("stream",))
+STREAM_COALESCED_DELTAS = Counter("cb2api_stream_coalesced_deltas_total", "合并到前一个增量帧中、没有单独发送的增量帧数",
+                                  ("stream",))
+# route 为流式响应缓冲的名称、非流式请求的 <名称>_non_stream，或透传等待响应头的 passthrough_headers
+UPSTREAM_DURATION = HistogramFamily("cb2api_upstream_duration_seconds", "上游请求从发出到读完响应的耗时（客户端断开的除外）",
+                                    ("route",), REQUEST_BUCKETS)
+CLIENT_DISCONNECTS = Counter("cb2api_client_disconnects_total", "客户端在响应完成前断开、立即取消上游请求的次数", ("route",))
+UPSTREAM_SECONDS_SAVED = Counter("cb2api_upstream_seconds_saved_total",
+                                 "客户端断开后立即取消上游请求节省的上游占用时间（按同类请求的平均耗时估算）", ("route",))
+
+# 模型标签来自客户端请求，限制不同取值的数量，避免任意字符串撑爆指标
+MAX_MODEL_LABELS = 100
+_model_labels = set()
+_request_labels: contextvars.ContextVar[Optional[Dict[str, str]]] = contextvars.ContextVar("metrics_request_labels", default=None)
+
+
+def set_request_model(model: Any) -> None:
+    """处理函数解析出模型后调用，用作当前请求计数的 model 标签"""
+    labels = _request_labels.get()
+    if labels is None or not isinstance(model, str):
+        return
+    if model not in _model_labels:
+        if len(_model_labels) >= MAX_MODEL_LABELS or len(model) > 100:
+            model = "other"
+        else:
+            _model_labels.add(model)
+    labels["model"] = model
+
+
+def timed(histogram: HistogramFamily, label: str):
+    """记录同步函数耗时的装饰器"""
+    child = histogram.labels(label)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def upstream_connect_hook(backend: str):
+    """httpx 请求事件钩子：通过 httpcore 的 trace 扩展记录新建连接的耗时、协议和TLS握手次数（复用连接时不记录）"""
+    histogram = UPSTREAM_CONNECT.labels(backend)
+    handshakes = {True: UPSTREAM_TLS_HANDSHAKES.labels(backend, "true"),
+                  False: UPSTREAM_TLS_HANDSHAKES.labels(backend, "false")}
+
+    async def on_request(request) -> None:
+        started = 0.0
+        tls = request.url.scheme == "https"
+
+        async def trace(event: str, info: Dict[str, Any]) -> None:
+            nonlocal started
+            if event == "connection.connect_tcp.started":
+                started = time.perf_counter()
+            elif started and event == ("connection.start_tls.complete" if tls else "connection.connect_tcp.complete"):
+                histogram.observe(time.perf_counter() - started)
+                started = 0.0
+                protocol = "http/1.1"
+                if tls:
+                    stream = info.get("return_value")
+                    ssl_object = stream.get_extra_info("ssl_object") if stream is not None else None
+                    handshakes[bool(ssl_object is not None and ssl_object.session_reused)].inc()
+                    if ssl_object is not None:
+                        protocol = ssl_object.selected_alpn_protocol() or protocol
+                UPSTREAM_CONNECTIONS.labels(backend, protocol).inc()
+
+        request.extensions["trace"] = trace
+
+    return on_request
+
+
+class MetricsMiddleware:
+    """ASGI中间件：按路由记录请求数、耗时、首字节时间，以及流式响应的并发数和SSE事件数"""
+
+    def __init__(self, app, backend: str):
+        self.app = app
+        self.backend = backend
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        labels = {"model": ""}
+        token = _request_labels.set(labels)
+        status = 500
+        first_byte = None
+        streaming = False
+        events = 0
+        last_newline = False
+        endpoint = "other"
+
+        async def wrapped_send(message):
+            nonlocal status, first_byte, streaming, events, last_newline, endpoint
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                route = scope.get("route")
+                endpoint = getattr(route, "path", "other")
+                for name, value in message.get("headers", ()):
+                    if name == b"content-type" and value.startswith(b"text/event-stream"):
+                        streaming = True
+                        INFLIGHT_STREAMS.labels(endpoint, self.backend).inc()
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body:
+                    if first_byte is None:
+                        first_byte = time.perf_counter()
+                    if streaming:
+                        # 事件以空行结束；跨数据块的 "\n" + "\n" 也算一个
+                        events += body.count(b"\n\n") + (last_newline and body[:1] == b"\n")
+                        last_newline = body[-1:] == b"\n"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            _request_labels.reset(token)
+            finished = time.perf_counter()
+            if scope.get("route") is not None:
+                endpoint = getattr(scope["route"], "path", endpoint)
+            if endpoint != "/metrics":
+                REQUESTS_TOTAL.labels(endpoint, labels["model"], str(status), self.backend).inc()
+                REQUEST_DURATION.labels(endpoint, self.backend).observe(finished - started)
+                if first_byte is not None:
+                    TIME_TO_FIRST_BYTE.labels(endpoint, self.backend).observe(first_byte - started)
+                if streaming:
+                    INFLIGHT_STREAMS.labels(endpoint, self.backend).dec()
+                    SSE_EVENTS.labels(endpoint, self.backend).observe(events)
+
+
+def install(app, backend: str) -> None:
+    """给应用加上 /metrics 端点和记录中间件"""
+    app.add_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware, backend=backend)
@@ -0,0 +1,253 @@
+"""
+对话前缀缓存
+
+Agent客户端每一轮都会重新发送同一段不断增长的对话，消息格式转换如果每次都从头处理，
+代价随对话长度线性增长。这里缓存转换后的对话前缀，新请求只需要转换命中前缀之后新增的消息。
+
+缓存以 (首条消息的哈希, 前缀长度) 为键，条目保存前缀消息序列化后的字节（不含结尾的 "]"）。
+查找时把请求的整个消息列表序列化一次，命中要求它以条目的字节开头且恰好在消息边界处结束。
+按字节比较而不是用 == 比较对象：== 下 1、1.0 和 true 相等，会让写法不同的请求拿到另一种写法的转换结果。
+命中后只有新增的消息需要转换，但确认命中本身仍要序列化整个历史：每个请求（命中或未命中）
+的开销都随历史长度线性增长，缓存节省的是转换的常数因子，而不是把单轮开销降到只与新增消息有关。
+一次序列化整个列表和一次内存比较都在C中完成，比逐条序列化再计算滚动哈希便宜得多
+（那样的开销比转换本身还高）；benchmarks/bench_prefix_cache.py 中长历史下约有1.7倍加速。
+
+用法:
+    match = cache.match(messages)
+    converted = match.restore()  # 命中前缀的转换结果副本（未命中为None），之后只处理 messages[match.start:]
+    ...
+    match.commit(length, converted[:n])  # 保存 messages[:length] 的转换结果
+
+缓存条目保存转换结果的只读副本（FrozenDict / FrozenList，仍是 dict / list 的子类，可以直接序列化），
+命中时多个请求共享这些对象而不复制；就地修改会抛出 TypeError，需要改写时先复制（如 {**message, ...}）。
+
+环境变量:
+    PREFIX_CACHE_ENABLED   设为0关闭前缀缓存（默认1）
+    PREFIX_CACHE_SIZE      每个缓存的条目上限（默认512）
+    PREFIX_CACHE_MAX_MB    每个缓存的内存上限，按前缀消息序列化后的大小估算（默认64）
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import json_codec
+import metrics
+from metrics import format_labels
+
+CACHES: List["PrefixCache"] = []
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("缓存的消息是只读的，修改前先复制")
+
+
+class FrozenDict(dict):
+    """缓存中共享的只读 dict"""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # 默认的 pickle 会逐项调用 __setitem__（进程池编码token时需要pickle）
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """缓存中共享的只读 list"""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+def freeze(value: Any) -> Any:
+    """返回JSON值的只读副本，已经冻结的部分直接复用"""
+    kind = type(value)
+    if kind is dict:
+        return FrozenDict({key: freeze(item) for key, item in value.items()})
+    if kind is list:
+        return FrozenList([freeze(item) for item in value])
+    return value
+
+# (首条消息哈希, 前缀长度)
+CacheKey = Tuple[bytes, int]
+
+
+class _Entry:
+    __slots__ = ("length", "data", "value")
+
+    def __init__(self, length: int, data: bytes, value: Tuple[Any, ...]):
+        self.length = length
+        # json_codec.dumps(messages[:length]) 去掉结尾的 "]"
+        self.data = data
+        self.value = value
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def matches(self, serialized: bytes) -> bool:
+        """serialized（整个消息列表的序列化结果）是否以这个前缀开头，且前缀之后正好是消息边界"""
+        end = len(self.data)
+        # 数字等值没有结束符，"1" 也是 "12" 的前缀，需要确认下一个字节是分隔符
+        return serialized.startswith(self.data) and serialized[end:end + 1] in (b",", b"]")
+
+
+class PrefixMatch:
+    """一次查找的结果：命中的前缀长度和缓存的转换结果，commit 时保存新的前缀"""
+
+    __slots__ = ("cache", "messages", "anchor", "serialized", "start", "value", "_hit")
+
+    def __init__(self, cache: "PrefixCache", messages: Sequence[Any], anchor: Optional[bytes] = None,
+                 serialized: Optional[bytes] = None, entry: Optional[_Entry] = None):
+        self.cache = cache
+        self.messages = messages
+        self.anchor = anchor
+        self.serialized = serialized
+        self.start = entry.length if entry is not None else 0
+        self.value = entry.value if entry is not None else None
+        self._hit = (anchor, self.start) if entry is not None else None
+
+    def restore(self) -> Optional[List[Any]]:
+        """命中前缀转换结果的可追加副本"""
+        return list(self.value) if self.value is not None else None
+
+    def commit(self, length: int, converted: Sequence[Any]) -> None:
+        """保存前 length 条消息的转换结果；它扩展了命中的前缀时替换原条目"""
+        if self.anchor is None or length <= self.start or length > len(self.messages):
+            return
+        serialized = self.serialized
+        if length == len(self.messages):
+            data = serialized[:-1]
+        else:
+            # 只序列化前缀之后的消息，从整个列表的序列化结果中截出前缀："[" + 前缀 + "," + 之后 + "]"
+            data = serialized[:len(serialized) - len(json_codec.dumps(self.messages[length:]))]
+            if serialized[len(data):len(data) + 1] != b",":
+                # 分开序列化的结果与整体不一致（编码器回退等），直接序列化前缀
+                data = json_codec.dumps(self.messages[:length])[:-1]
+        entry = _Entry(length, data, tuple(freeze(message) for message in converted))
+        self.cache.store((self.anchor, length), entry, replaces=self._hit)
+
+
+class PrefixCache:
+    """对话前缀的LRU缓存，按条目数和估算内存淘汰"""
+
+    def __init__(self, name: str, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = os.getenv("PREFIX_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+        if max_entries is None:
+            max_entries = int(os.getenv("PREFIX_CACHE_SIZE", "512"))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("PREFIX_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        self.name = name
+        self.enabled = enabled and max_entries > 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        # 首条消息哈希 -> 已缓存的前缀长度
+        self._lengths: Dict[bytes, Set[int]] = {}
+
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_messages = 0
+        self.converted_messages = 0
+        CACHES.append(self)
+
+    def match(self, messages: Sequence[Any]) -> PrefixMatch:
+        """查找与 messages 开头相同的最长缓存前缀"""
+        if not self.enabled or not messages:
+            self.converted_messages += len(messages)
+            return PrefixMatch(self, messages)
+
+        anchor = hashlib.blake2b(json_codec.dumps(messages[0]), digest_size=16).digest()
+        serialized = json_codec.dumps(messages)
+        for length in sorted(self._lengths.get(anchor, ()), reverse=True):
+            if length > len(messages):
+                continue
+            key = (anchor, length)
+            entry = self._cache[key]
+            if entry.matches(serialized):
+                self._cache.move_to_end(key)
+                self.hits += 1
+                self.reused_messages += length
+                self.converted_messages += len(messages) - length
+                return PrefixMatch(self, messages, anchor, serialized, entry)
+
+        self.misses += 1
+        self.converted_messages += len(messages)
+        return PrefixMatch(self, messages, anchor, serialized)
+
+    def store(self, key: CacheKey, entry: _Entry, replaces: Optional[CacheKey] = None) -> None:
+        if not self.enabled or entry.size > self.max_bytes:
+            return
+        # 同一段对话的新前缀包含了旧前缀，旧条目不再需要
+        if replaces is not None:
+            self._remove(replaces)
+        self._remove(key)
+        self._cache[key] = entry
+        self._lengths.setdefault(key[0], set()).add(key[1])
+        self.cached_bytes += entry.size
+        while len(self._cache) > self.max_entries or self.cached_bytes > self.max_bytes:
+            self._remove(next(iter(self._cache)))
+            self.evictions += 1
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            return
+        self.cached_bytes -= entry.size
+        lengths = self._lengths[key[0]]
+        lengths.discard(key[1])
+        if not lengths:
+            del self._lengths[key[0]]
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._lengths.clear()
+        self.cached_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._cache),
+            "max_entries": self.max_entries,
+            "cached_bytes": self.cached_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "reused_messages": self.reused_messages,
+            "converted_messages": self.converted_messages,
+        }
+
+
+def collect() -> List[str]:
+    """输出所有前缀缓存的命中、淘汰和内存占用（Prometheus文本格式）"""
+    families = (
+        ("cb2api_prefix_cache_hits_total", "counter", "命中缓存前缀的请求数", "hits"),
+        ("cb2api_prefix_cache_misses_total", "counter", "未命中缓存前缀的请求数", "misses"),
+        ("cb2api_prefix_cache_evictions_total", "counter", "因条目数或内存上限淘汰的前缀数", "evictions"),
+        ("cb2api_prefix_cache_reused_messages_total", "counter", "从缓存前缀复用、无需转换的消息数", "reused_messages"),
+        ("cb2api_prefix_cache_converted_messages_total", "counter", "实际转换的消息数", "converted_messages"),
+        ("cb2api_prefix_cache_bytes", "gauge", "缓存前缀的估算内存（序列化后字节数）", "cached_bytes"),
+    )
+    lines = []
+    for name, kind, help_text, field in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache in CACHES:
+            lines.append(f"{name}{format_labels({'cache': cache.name})} {getattr(cache, field)}")
+    return lines
+
+
+metrics.COLLECTORS.append(collect)
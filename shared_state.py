@@ -0,0 +1,314 @@
+"""
+多worker共享状态
+
+uvicorn --workers N 时每个worker都有自己的内存，客户端密钥、模型映射和token限流状态各自为政。
+这里提供一个通过unix socket访问的共享状态旁路进程（sidecar）：
+
+    python shared_state.py --socket /tmp/cb2api-state.sock
+
+worker设置 SHARED_STATE_SOCKET 后，启动时连接sidecar：
+- 订阅连接先拿到全量快照，之后sidecar把每次修改实时推送过来，worker在本地维护一份镜像，
+  读操作（校验密钥、查模型、选token）不需要任何往返；
+- 写操作（标记token限流、恢复、重载配置）发到sidecar，由它广播给所有worker，通常在毫秒内生效。
+  token状态先在本地生效，再在后台发给sidecar（SHARED_STATE_TIMEOUT 秒超时），sidecar不可用时只记录日志。
+
+协议是每行一个JSON对象：请求 {"id", "op", ...}，响应 {"id", "value"} 或 {"id", "error"}；
+订阅连接上的推送为 {"event": "set" / "delete", "key", "value"}。
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_SOCKET = os.getenv("SHARED_STATE_SOCKET", "")
+# worker在请求路径上写共享状态的超时秒数，超时只记录日志
+SHARED_STATE_TIMEOUT = float(os.getenv("SHARED_STATE_TIMEOUT", "1"))
+# 单行消息上限（快照可能包含所有客户端密钥）
+MAX_LINE = 64 * 1024 * 1024
+# 订阅者未读取的推送超过该字节数时断开它，订阅者重连后从快照恢复
+MAX_SUBSCRIBER_BUFFER = int(os.getenv("SHARED_STATE_MAX_SUBSCRIBER_BUFFER", str(16 * 1024 * 1024)))
+
+
+class SharedStateServer:
+    """sidecar：保存键值状态并把修改广播给所有订阅者"""
+
+    def __init__(self, socket_path: str, max_subscriber_buffer: int = MAX_SUBSCRIBER_BUFFER):
+        self.socket_path = socket_path
+        self.max_subscriber_buffer = max_subscriber_buffer
+        self.data: Dict[str, Any] = {}
+        self.subscribers: Set[asyncio.StreamWriter] = set()
+        self.connections: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path, limit=MAX_LINE)
+        logger.info(f"共享状态服务已启动: {self.socket_path}")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self.connections):
+            writer.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = None
+                try:
+                    message = json_codec.loads(line)
+                    response = {"id": message.get("id"), "value": self._apply(message, writer)}
+                except Exception as e:
+                    response = {"id": message.get("id") if isinstance(message, dict) else None, "error": str(e)}
+                writer.write(json_codec.dumps(response) + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+
+    def _apply(self, message: Dict[str, Any], writer: asyncio.StreamWriter) -> Any:
+        op = message.get("op")
+        key = message.get("key")
+
+        if op == "get":
+            return self.data.get(key)
+        if op == "snapshot":
+            return self.data
+        if op == "subscribe":
+            # 快照和后续推送在同一个连接上，中间不会漏掉修改
+            self.subscribers.add(writer)
+            return self.data
+        if op == "set":
+            self._set(key, message.get("value"))
+            return True
+        if op == "setnx":
+            if key in self.data:
+                return False
+            self._set(key, message.get("value"))
+            return True
+        if op == "delete":
+            if key in self.data:
+                del self.data[key]
+                self._publish({"event": "delete", "key": key, "value": None})
+                return True
+            return False
+        if op == "incr":
+            value = self.data.get(key, 0) + message.get("amount", 1)
+            self._set(key, value)
+            return value
+        raise ValueError(f"未知操作: {op}")
+
+    def _set(self, key: str, value: Any):
+        self.data[key] = value
+        self._publish({"event": "set", "key": key, "value": value})
+
+    def _publish(self, event: Dict[str, Any]):
+        line = json_codec.dumps(event) + b"\n"
+        for writer in list(self.subscribers):
+            if writer.is_closing():
+                self.subscribers.discard(writer)
+                continue
+            if writer.transport.get_write_buffer_size() + len(line) > self.max_subscriber_buffer:
+                # 推送不等待 drain，读取过慢的订阅者会让缓冲无限增长
+                logger.warning("共享状态订阅者读取过慢，断开连接")
+                self.subscribers.discard(writer)
+                writer.transport.abort()
+                continue
+            writer.write(line)
+
+
+class SharedStateClient:
+    """worker端：一个请求连接 + 一个订阅连接，本地保存状态镜像"""
+
+    def __init__(self, socket_path: str, reconnect_delay: float = 0.5):
+        self.socket_path = socket_path
+        self.reconnect_delay = reconnect_delay
+        self.local: Dict[str, Any] = {}
+        self.connected = False
+        self._listeners: List[Callable[[str, Any], None]] = []
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._tasks: List[asyncio.Task] = []
+        self._closed = False
+
+    def on_change(self, listener: Callable[[str, Any], None]):
+        """注册修改回调 listener(key, value)，删除时 value 为 None"""
+        self._listeners.append(listener)
+
+    async def connect(self):
+        """建立连接并拿到全量快照；之后订阅断开时会自动重连"""
+        await self._connect_requests()
+        sub_reader, sub_writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_LINE)
+        snapshot = await self._subscribe(sub_reader, sub_writer)
+        self._apply_snapshot(snapshot)
+        self._tasks.append(asyncio.create_task(self._listen(sub_reader, sub_writer)))
+        self.connected = True
+
+    async def close(self):
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks.clear()
+        if self._writer is not None:
+            self._writer.close()
+        self.connected = False
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取本地镜像（不访问sidecar）"""
+        return self.local.get(key, default)
+
+    def items(self, prefix: str = ""):
+        return [(k, v) for k, v in self.local.items() if k.startswith(prefix)]
+
+    async def set(self, key: str, value: Any) -> bool:
+        return await self.request("set", key=key, value=value)
+
+    async def setnx(self, key: str, value: Any) -> bool:
+        return await self.request("setnx", key=key, value=value)
+
+    async def delete(self, key: str) -> bool:
+        return await self.request("delete", key=key)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self.request("incr", key=key, amount=amount)
+
+    async def request(self, op: str, **fields) -> Any:
+        if self._writer is None or self._writer.is_closing():
+            await self._connect_requests()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(json_codec.dumps({"id": request_id, "op": op, **fields}) + b"\n")
+        try:
+            await self._writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _connect_requests(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_LINE)
+        self._tasks.append(asyncio.create_task(self._read_responses(self._reader, self._writer)))
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # 响应按id匹配，允许多个协程在同一连接上并发请求
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json_codec.loads(line)
+                future = self._pending.get(response.get("id"))
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(response["error"]))
+                else:
+                    future.set_result(response.get("value"))
+        finally:
+            # 关闭写端，下一次请求时重新连接
+            writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("共享状态连接已断开"))
+
+    async def _subscribe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Dict[str, Any]:
+        writer.write(json_codec.dumps({"id": 0, "op": "subscribe"}) + b"\n")
+        await writer.drain()
+        response = json_codec.loads(await reader.readline())
+        return response.get("value") or {}
+
+    async def _listen(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while not self._closed:
+            try:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("订阅连接已关闭")
+                event = json_codec.loads(line)
+                if event.get("event") == "set":
+                    self.local[event["key"]] = event["value"]
+                    self._notify(event["key"], event["value"])
+                elif event.get("event") == "delete":
+                    self.local.pop(event["key"], None)
+                    self._notify(event["key"], None)
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            except Exception as e:
+                writer.close()
+                self.connected = False
+                logger.error(f"共享状态订阅中断: {e}，{self.reconnect_delay}s 后重连")
+                reader, writer = await self._reconnect_subscription()
+
+    async def _reconnect_subscription(self):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_LINE)
+                snapshot = await self._subscribe(reader, writer)
+            except (OSError, ValueError) as e:
+                logger.debug(f"重连共享状态失败: {e}")
+                continue
+            self._apply_snapshot(snapshot)
+            self.connected = True
+            logger.info("共享状态订阅已恢复")
+            return reader, writer
+
+    def _apply_snapshot(self, snapshot: Dict[str, Any]):
+        removed = [key for key in self.local if key not in snapshot]
+        self.local = dict(snapshot)
+        for key in removed:
+            self._notify(key, None)
+        for key, value in snapshot.items():
+            self._notify(key, value)
+
+    def _notify(self, key: str, value: Any):
+        for listener in self._listeners:
+            try:
+                listener(key, value)
+            except Exception as e:
+                logger.error(f"共享状态回调失败 {key}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多worker共享状态服务")
+    parser.add_argument("--socket", default=SHARED_STATE_SOCKET or "/tmp/cb2api-state.sock", help="unix socket路径")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    try:
+        asyncio.run(SharedStateServer(args.socket).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Anthropic SSE帧模板
+
+每种事件的JSON在启动时用当前编解码器预先序列化一次，拆成固定的字节前缀/后缀，
+发送时只需对变化的字段（text、partial_json、index等）做JSON转义再拼接。
+输出与 sse_frame(event, 完整payload) 逐字节一致。
+同一内容块的相邻增量帧可以用 split_delta / merge_delta 直接在字节上合并（见 stream_buffer.py）。
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import json_codec
+
+# 按index缓存的模板数量上限，超过后不再缓存（正常流中的内容块远少于此）
+_MAX_CACHED_INDEX = 256
+
+
+def sse_frame(event_type: str, payload: Dict[str, Any]) -> bytes:
+    """构建带事件名的SSE帧，直接输出bytes"""
+    return b"event: " + event_type.encode() + b"\ndata: " + json_codec.dumps(payload) + b"\n\n"
+
+
+def slot(name: str) -> str:
+    """模板中的占位符"""
+    return f"__sse_slot_{name}__"
+
+
+def _render_value(value: Any) -> bytes:
+    if isinstance(value, str):
+        return json_codec.encode_string(value)
+    return json_codec.dumps(value)
+
+
+class FrameTemplate:
+    """预序列化的SSE帧模板，slots 按顺序对应 render() 的参数"""
+
+    def __init__(self, event_type: str, payload: Dict[str, Any], slots: Sequence[str]):
+        self.event_type = event_type
+        self.payload = payload
+        self.slots = tuple(slots)
+
+        frame = sse_frame(event_type, payload)
+        segments: List[bytes] = []
+        for name in self.slots:
+            marker = json_codec.encode_string(slot(name))
+            head, found, frame = frame.partition(marker)
+            if not found:
+                raise ValueError(f"模板 {event_type} 中缺少占位符 {name}")
+            segments.append(head)
+        segments.append(frame)
+        self._segments: Tuple[bytes, ...] = tuple(segments)
+
+        if len(self._segments) == 2:
+            self._head, self._tail = self._segments
+
+    def render(self, *values: Any) -> bytes:
+        if len(values) == 1 and len(self._segments) == 2:
+            return self._head + _render_value(values[0]) + self._tail
+        parts = [self._segments[0]]
+        for value, segment in zip(values, self._segments[1:]):
+            parts.append(_render_value(value))
+            parts.append(segment)
+        return b"".join(parts)
+
+    def partial(self, **fixed: Any) -> "FrameTemplate":
+        """固定部分占位符，返回剩余占位符的新模板"""
+        payload = _substitute(self.payload, {slot(k): v for k, v in fixed.items()})
+        return FrameTemplate(self.event_type, payload, [s for s in self.slots if s not in fixed])
+
+
+def _substitute(obj: Any, values: Dict[str, Any]) -> Any:
+    if isinstance(obj, dict):
+        return {k: _substitute(v, values) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_substitute(v, values) for v in obj]
+    if isinstance(obj, str) and obj in values:
+        return values[obj]
+    return obj
+
+
+TEXT_DELTA = FrameTemplate(
+    "content_block_delta",
+    {'type': 'content_block_delta', 'index': slot("index"), 'delta': {'type': 'text_delta', 'text': slot("text")}},
+    ["index", "text"]
+)
+
+INPUT_JSON_DELTA = FrameTemplate(
+    "content_block_delta",
+    {'type': 'content_block_delta', 'index': slot("index"),
+     'delta': {'type': 'input_json_delta', 'partial_json': slot("partial_json")}},
+    ["index", "partial_json"]
+)
+
+TEXT_BLOCK_START = FrameTemplate(
+    "content_block_start",
+    {'type': 'content_block_start', 'index': slot("index"), 'content_block': {'type': 'text', 'text': ''}},
+    ["index"]
+)
+
+TOOL_USE_BLOCK_START = FrameTemplate(
+    "content_block_start",
+    {'type': 'content_block_start', 'index': slot("index"),
+     'content_block': {'type': 'tool_use', 'id': slot("id"), 'name': slot("name"), 'input': {}}},
+    ["index", "id", "name"]
+)
+
+BLOCK_STOP = FrameTemplate(
+    "content_block_stop",
+    {'type': 'content_block_stop', 'index': slot("index")},
+    ["index"]
+)
+
+MESSAGE_DELTA = FrameTemplate(
+    "message_delta",
+    {'type': 'message_delta', 'delta': {'stop_reason': slot("stop_reason"), 'stop_sequence': None},
+     'usage': slot("usage")},
+    ["stop_reason", "usage"]
+)
+
+PING = sse_frame("ping", {'type': 'ping'})
+MESSAGE_STOP = sse_frame("message_stop", {'type': 'message_stop'})
+
+_text_delta_by_index: Dict[int, FrameTemplate] = {}
+_input_json_delta_by_index: Dict[int, FrameTemplate] = {}
+_text_block_start_by_index: Dict[int, bytes] = {}
+_block_stop_by_index: Dict[int, bytes] = {}
+
+
+def _template_for_index(cache: Dict[int, FrameTemplate], template: FrameTemplate, index: int) -> FrameTemplate:
+    bound = cache.get(index)
+    if bound is None:
+        bound = template.partial(index=index)
+        if len(cache) < _MAX_CACHED_INDEX:
+            cache[index] = bound
+    return bound
+
+
+def _frame_for_index(cache: Dict[int, bytes], template: FrameTemplate, index: int) -> bytes:
+    frame = cache.get(index)
+    if frame is None:
+        frame = template.render(index)
+        if len(cache) < _MAX_CACHED_INDEX:
+            cache[index] = frame
+    return frame
+
+
+def text_delta(index: int, text: str) -> bytes:
+    return _template_for_index(_text_delta_by_index, TEXT_DELTA, index).render(text)
+
+
+def input_json_delta(index: int, partial_json: str) -> bytes:
+    return _template_for_index(_input_json_delta_by_index, INPUT_JSON_DELTA, index).render(partial_json)
+
+
+def text_block_start(index: int) -> bytes:
+    return _frame_for_index(_text_block_start_by_index, TEXT_BLOCK_START, index)
+
+
+def tool_use_block_start(index: int, tool_id: str, name: str) -> bytes:
+    return TOOL_USE_BLOCK_START.render(index, tool_id, name)
+
+
+def block_stop(index: int) -> bytes:
+    return _frame_for_index(_block_stop_by_index, BLOCK_STOP, index)
+
+
+def message_delta(stop_reason: str, usage: Dict[str, Any]) -> bytes:
+    return MESSAGE_DELTA.render(stop_reason, usage)
+
+
+_DELTA_TEMPLATES = (TEXT_DELTA, INPUT_JSON_DELTA)
+
+
+def split_delta(frame: bytes) -> Optional[Tuple[bytes, bytes, bytes]]:
+    """
+    把单个 text_delta / input_json_delta 帧拆成 (前缀, JSON字符串字面量, 后缀)，其他帧返回 None。
+    前缀包含事件类型和index，前缀相同的两个帧可以用 merge_delta 合并为一帧。
+    """
+    for template in _DELTA_TEMPLATES:
+        head, middle, tail = template._segments
+        if not (frame.startswith(head) and frame.endswith(tail)):
+            continue
+        pos = frame.find(middle, len(head))
+        if pos < 0 or not frame[len(head):pos].isdigit():
+            continue
+        start = pos + len(middle)
+        end = len(frame) - len(tail)
+        # 字面量必须完整，且整个chunk只有一帧（多帧拼在一起时中间会出现空行）
+        if end - start >= 2 and frame[start] == 0x22 and frame[end - 1] == 0x22 \
+                and frame.find(b"\n\n", start) == len(frame) - 2:
+            return frame[:start], frame[start:end], tail
+    return None
+
+
+def merge_delta(literal: bytes, following: bytes) -> bytes:
+    """拼接两个JSON字符串字面量："ab" + "cd" -> "abcd"（转义序列各自完整，可以直接拼接）"""
+    return literal[:-1] + following[1:]
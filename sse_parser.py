@@ -0,0 +1,174 @@
+"""
+增量式SSE事件解析器
+
+直接在 bytearray 上按字节解析 text/event-stream，支持多行 data、event、id、retry 字段，
+兼容 LF / CRLF / CR 行结束符，事件可以跨任意chunk边界拆分，已消费的数据不会被重复拷贝。
+"""
+from typing import AsyncIterable, AsyncIterator, List, Optional
+
+
+class SSEEvent:
+    """一个完整的SSE事件，data 保持为 bytes，便于直接交给JSON解析器"""
+
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(self, event: Optional[str] = None, data: bytes = b"",
+                 id: Optional[str] = None, retry: Optional[int] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+    @property
+    def text(self) -> str:
+        return self.data.decode("utf-8", errors="replace")
+
+    def encode(self) -> bytes:
+        """按标准格式重新序列化事件"""
+        parts = []
+        if self.id is not None:
+            parts.append(b"id: " + self.id.encode("utf-8") + b"\n")
+        if self.event is not None:
+            parts.append(b"event: " + self.event.encode("utf-8") + b"\n")
+        if self.retry is not None:
+            parts.append(b"retry: " + str(self.retry).encode("ascii") + b"\n")
+        for line in self.data.split(b"\n"):
+            parts.append(b"data: " + line + b"\n")
+        parts.append(b"\n")
+        return b"".join(parts)
+
+    def __repr__(self) -> str:
+        return f"SSEEvent(event={self.event!r}, data={self.data[:80]!r}, id={self.id!r}, retry={self.retry!r})"
+
+
+class SSEParser:
+    """
+    增量SSE解析器
+
+    用法: 每收到一个chunk调用 feed()，返回本次能够组装出的完整事件；
+    上游结束后调用 flush() 取出没有以空行结尾的最后一个事件。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 缓冲区中已确认不含行结束符的前缀长度，下次 feed 从这里继续查找，长行分多块到达时不会重复扫描
+        self._scan_pos = 0
+        self._data_lines: List[bytes] = []
+        self._event: Optional[str] = None
+        self._id: Optional[str] = None
+        self._retry: Optional[int] = None
+        self._has_fields = False
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        if chunk:
+            self._buffer += chunk
+        return self._drain(final=False)
+
+    def flush(self) -> List[SSEEvent]:
+        """上游结束时调用，处理剩余的不完整行和未分发的事件"""
+        events = self._drain(final=True)
+        if self._buffer:
+            self._process_line(memoryview(bytes(self._buffer)), events)
+            self._buffer.clear()
+        self._scan_pos = 0
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _drain(self, final: bool) -> List[SSEEvent]:
+        events: List[SSEEvent] = []
+        buffer = self._buffer
+        view = memoryview(buffer)
+        pos = 0
+        scan = self._scan_pos
+        size = len(buffer)
+
+        try:
+            while pos < size:
+                lf = buffer.find(b"\n", scan)
+                cr = buffer.find(b"\r", scan, lf if lf >= 0 else size)
+
+                if cr >= 0:
+                    # CR 结尾：如果紧跟LF则按CRLF处理；CR在缓冲末尾时需要等待下一个chunk确认
+                    if cr + 1 == size and not final:
+                        scan = cr
+                        break
+                    end = cr
+                    next_pos = cr + 2 if cr + 1 == lf else cr + 1
+                elif lf >= 0:
+                    end = lf
+                    next_pos = lf + 1
+                else:
+                    scan = size
+                    break
+
+                self._process_line(view[pos:end], events)
+                pos = scan = next_pos
+        finally:
+            view.release()
+
+        self._scan_pos = scan - pos
+        if pos:
+            # bytearray 删除前缀只移动起始偏移，不会复制剩余数据
+            del buffer[:pos]
+        return events
+
+    def _process_line(self, line: memoryview, events: List[SSEEvent]) -> None:
+        if not line:
+            event = self._dispatch()
+            if event is not None:
+                events.append(event)
+            return
+
+        if line[0] == 0x3A:  # ':' 注释行
+            return
+
+        raw = line.tobytes()
+        colon = raw.find(b":")
+        if colon >= 0:
+            field = raw[:colon]
+            value = raw[colon + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+        else:
+            field = raw
+            value = b""
+
+        if field == b"data":
+            self._data_lines.append(value)
+            self._has_fields = True
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+            self._has_fields = True
+        elif field == b"id":
+            if b"\x00" not in value:
+                self._id = value.decode("utf-8", errors="replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self._retry = int(value)
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._has_fields:
+            return None
+
+        event = None
+        if self._data_lines:
+            data = self._data_lines[0] if len(self._data_lines) == 1 else b"\n".join(self._data_lines)
+            event = SSEEvent(event=self._event, data=data, id=self._id, retry=self._retry)
+
+        self._data_lines = []
+        self._event = None
+        self._has_fields = False
+        # id 和 retry 按规范在事件之间保持
+        return event
+
+
+async def aiter_sse_events(byte_stream: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    """将字节流转换为SSE事件流"""
+    parser = SSEParser()
+    async for chunk in byte_stream:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
@@ -0,0 +1,255 @@
+"""
+流式响应的有界缓冲
+
+StreamingResponse 的生成器原本读一块上游数据、等客户端写完再读下一块，
+能读多少只取决于 uvicorn 传输层缓冲的隐式上限，慢客户端积压多少数据也无从观察。
+这里在上游读取和客户端写入之间放一个显式的有界缓冲：
+后台任务读取上游（包括格式转换）放入缓冲，缓冲字节数达到高水位时暂停读取，
+客户端取走数据后继续。客户端落后时，积压的多个数据块合并为一次写入。
+传入ASGI receive 时同时监听客户端断开（见 disconnect.py），断开后立即取消上游读取。
+
+可选的增量合并：上游常常一次只输出一两个字符，每个增量都是单独的SSE帧和单独的一次写入。
+开启后缓冲中的数据最多等待一个合并窗口再写出，期间同一内容块相邻的 text_delta / input_json_delta
+帧直接在字节上合并为一帧（见 sse_frames.split_delta）。遇到其他帧（内容块开始/结束、message_delta等）、
+缓冲达到字节预算或上游结束时立即写出，事件顺序不变。窗口和预算可以按客户端密钥配置（见 api_keys.py）。
+
+环境变量:
+    STREAM_BUFFER_HIGH_WATER_KB   每个流的缓冲高水位（默认64），设为0时不使用缓冲（也不合并），直接迭代生成器
+    SSE_COALESCE_MS               默认的合并窗口毫秒数（默认0，不合并）
+    SSE_COALESCE_BYTES            默认的合并字节预算（默认1024）
+
+暂停次数、暂停时长和暂停过的流数记录在 cb2api_stream_buffer_* / cb2api_stalled_streams_total 指标中，
+写入次数和被合并的增量帧数记录在 cb2api_stream_writes_total / cb2api_stream_coalesced_deltas_total 中。
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Deque, Optional, Tuple, Union
+
+import metrics
+from api_keys import KeyInfo
+from disconnect import Receive, record_completed, record_disconnect, stop_task, wait_for_disconnect
+from sse_frames import merge_delta, split_delta
+
+STREAM_BUFFER_HIGH_WATER = int(float(os.getenv("STREAM_BUFFER_HIGH_WATER_KB", "64")) * 1024)
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "1024"))
+
+
+class Coalescing:
+    """增量合并参数：窗口（秒）和字节预算"""
+
+    __slots__ = ("window", "max_bytes")
+
+    def __init__(self, window: float, max_bytes: int):
+        self.window = window
+        self.max_bytes = max_bytes
+
+
+def coalescing_for(key: Optional[KeyInfo]) -> Optional[Coalescing]:
+    """客户端密钥的合并参数，密钥没有配置的项使用环境变量默认值；窗口为0时返回 None（不合并）"""
+    window_ms = SSE_COALESCE_MS
+    max_bytes = SSE_COALESCE_BYTES
+    if key is not None:
+        if key.coalesce_ms is not None:
+            window_ms = key.coalesce_ms
+        if key.coalesce_bytes is not None:
+            max_bytes = key.coalesce_bytes
+    if window_ms <= 0:
+        return None
+    return Coalescing(window_ms / 1000.0, max_bytes)
+
+
+class StreamBuffer:
+    """一个流式响应的有界缓冲，迭代时启动读取 source 的后台任务"""
+
+    def __init__(self, source: AsyncIterable[Union[bytes, str]], high_water: int, name: str,
+                 receive: Optional[Receive] = None, coalesce: Optional[Coalescing] = None):
+        self._source = source
+        self._receive = receive
+        self.high_water = high_water
+        self.name = name
+        self._coalesce = coalesce
+        # 缓冲中最后一帧是增量帧时的 (前缀, 字符串字面量, 后缀)，后续同前缀的增量合并进去
+        self._last_delta: Optional[Tuple[bytes, bytes, bytes]] = None
+        # 合并窗口到期、遇到块边界或达到字节预算：客户端应立即取走数据
+        self._flush = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._chunks: Deque[bytes] = deque()
+        self._size = 0
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started = 0.0
+
+        self.peak_bytes = 0
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.writes = 0
+        self.coalesced = 0
+        self._buffered_bytes = metrics.STREAM_BUFFER_BYTES.labels(name)
+        self._writes = metrics.STREAM_WRITES.labels(name)
+        self._coalesced = metrics.STREAM_COALESCED_DELTAS.labels(name)
+
+    async def _fill(self) -> None:
+        try:
+            async for chunk in self._source:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if not chunk:
+                    continue
+                if self._coalesce is None:
+                    self._chunks.append(chunk)
+                    self._size += len(chunk)
+                    self._buffered_bytes.inc(len(chunk))
+                    self._readable.set()
+                else:
+                    self._append_coalesced(chunk)
+                if self._size >= self.high_water:
+                    await self._stall()
+            record_completed(self.name, time.perf_counter() - self._started)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._readable.set()
+            # 在暂停时被取消的生成器停在 yield 处，需要显式关闭才会运行它的 finally
+            aclose = getattr(self._source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def _append_coalesced(self, chunk: bytes) -> None:
+        was_empty = not self._chunks
+        delta = split_delta(chunk)
+        last = self._last_delta
+        if delta is not None and last is not None and last[0] == delta[0]:
+            # 与缓冲中最后一帧属于同一内容块的同类增量：合并为一帧
+            literal = merge_delta(last[1], delta[1])
+            merged = last[0] + literal + last[2]
+            grown = len(merged) - len(self._chunks[-1])
+            self._chunks[-1] = merged
+            self._last_delta = (last[0], literal, last[2])
+            self.coalesced += 1
+            self._coalesced.inc()
+        else:
+            self._chunks.append(chunk)
+            self._last_delta = delta
+            grown = len(chunk)
+            if delta is None:
+                # 块边界等非增量帧不等待合并窗口
+                self._flush = True
+        self._size += grown
+        self._buffered_bytes.inc(grown)
+        if self._size >= self._coalesce.max_bytes:
+            self._flush = True
+        # 只在需要客户端立即取走、或缓冲从空变为非空（开始计时合并窗口）时唤醒客户端
+        if self._flush or was_empty:
+            self._readable.set()
+
+    def _expire(self) -> None:
+        """合并窗口到期"""
+        self._timer = None
+        self._flush = True
+        self._readable.set()
+
+    def _hold(self) -> bool:
+        """缓冲中已有数据时，是否还要在合并窗口内等待更多增量"""
+        if self._coalesce is None or self._flush or self._done:
+            return False
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._coalesce.window, self._expire)
+        return True
+
+    async def _stall(self) -> None:
+        """缓冲区满：等客户端取走数据后再继续读取上游"""
+        if self.peak_bytes < self._size:
+            self.peak_bytes = self._size
+        if not self.stalls:
+            metrics.STALLED_STREAMS.labels(self.name).inc()
+        self.stalls += 1
+        metrics.STREAM_BUFFER_STALLS.labels(self.name).inc()
+        started = time.perf_counter()
+        self._writable.clear()
+        try:
+            await self._writable.wait()
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stalled_seconds += elapsed
+            metrics.STREAM_BUFFER_STALL_SECONDS.labels(self.name).inc(elapsed)
+
+    def _abandon(self) -> None:
+        """客户端在上游读完之前断开：立即取消上游读取"""
+        # 断开监听和响应结束都会调用，只取消、记录一次
+        if self._task is not None and not self._task.done() and not self._task.cancelling():
+            record_disconnect(self.name, time.perf_counter() - self._started)
+            self._task.cancel()
+
+    async def _watch(self) -> None:
+        try:
+            await wait_for_disconnect(self._receive)
+        except Exception:
+            # receive() 出错也说明连接已经不可用
+            pass
+        self._abandon()
+
+    async def _drain(self) -> AsyncIterator[bytes]:
+        self._started = time.perf_counter()
+        self._task = asyncio.create_task(self._fill())
+        watcher = asyncio.create_task(self._watch()) if self._receive is not None else None
+        try:
+            while True:
+                if self._chunks and self._hold():
+                    self._readable.clear()
+                    await self._readable.wait()
+                elif self._chunks:
+                    if self._timer is not None:
+                        self._timer.cancel()
+                        self._timer = None
+                    self._flush = False
+                    self._last_delta = None
+                    if self.peak_bytes < self._size:
+                        self.peak_bytes = self._size
+                    # 取走缓冲中的全部数据，积压多块时合并为一次写入
+                    data = self._chunks.popleft() if len(self._chunks) == 1 else b"".join(self._chunks)
+                    self._chunks.clear()
+                    self._size = 0
+                    self._buffered_bytes.dec(len(data))
+                    self._writable.set()
+                    self.writes += 1
+                    self._writes.inc()
+                    yield data
+                elif self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                else:
+                    self._readable.clear()
+                    await self._readable.wait()
+        finally:
+            # 响应结束或客户端断开：停止读取上游并释放缓冲
+            if watcher is not None:
+                watcher.cancel()
+            if self._timer is not None:
+                self._timer.cancel()
+            self._abandon()
+            await stop_task(self._task)
+            self._buffered_bytes.dec(self._size)
+            self._chunks.clear()
+            self._size = 0
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._drain()
+
+
+def buffered(source: AsyncIterable[Union[bytes, str]], name: str, receive: Optional[Receive] = None,
+             high_water: Optional[int] = None,
+             coalesce: Optional[Coalescing] = None) -> AsyncIterable[Union[bytes, str]]:
+    """给 StreamingResponse 的生成器加上有界缓冲、断开检测和可选的增量合并；高水位为0时原样返回"""
+    if high_water is None:
+        high_water = STREAM_BUFFER_HIGH_WATER
+    if high_water <= 0:
+        return source
+    return StreamBuffer(source, high_water, name, receive, coalesce)
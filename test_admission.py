@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+测试按客户端密钥的准入控制
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from admission import AdmissionController, AdmissionRejected
+from api_keys import ApiKeyIndex
+
+
+def make_keys(*entries):
+    index = ApiKeyIndex.from_config(list(entries))
+    return {info.label: info for info in index}
+
+
+def test_per_key_limit_and_queue():
+    """测试单个密钥的并发上限、队列上限和排队超时"""
+    async def scenario():
+        keys = make_keys({"key": "a", "label": "a", "max_concurrency": 2})
+        controller = AdmissionController(max_concurrency=0, key_concurrency=0, queue_size=1, queue_timeout=0.05)
+        t1 = await controller.acquire(keys["a"])
+        t2 = await controller.acquire(keys["a"])
+
+        waiter = asyncio.create_task(controller.acquire(keys["a"]))
+        await asyncio.sleep(0)
+        assert controller.get_stats()["keys"]["a"]["queue_depth"] == 1
+        try:
+            await controller.acquire(keys["a"])
+        except AdmissionRejected as e:
+            assert "queued" in e.message and e.retry_after >= 1
+        else:
+            raise AssertionError("队列已满时应拒绝")
+
+        t1.release()
+        t1.release()  # 重复释放不影响计数
+        t3 = await waiter
+        assert controller.active == 2
+
+        try:
+            await controller.acquire(keys["a"])
+        except AdmissionRejected:
+            pass
+        else:
+            raise AssertionError("排队超时应拒绝")
+
+        for ticket in (t2, t3):
+            ticket.release()
+        stats = controller.get_stats()
+        assert controller.active == 0 and controller.waiting == 0
+        assert stats["keys"]["a"]["rejected"] == 1 and stats["keys"]["a"]["timed_out"] == 1
+        assert stats["keys"]["a"]["wait_seconds"]["count"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_noisy_key_does_not_starve_others():
+    """测试总名额被占满时，按权重在密钥之间轮流放行"""
+    async def scenario():
+        keys = make_keys(
+            {"key": "noisy", "label": "noisy"},
+            {"key": "quiet", "label": "quiet"},
+            {"key": "heavy", "label": "heavy", "weight": 2},
+        )
+        controller = AdmissionController(max_concurrency=1, key_concurrency=0, queue_size=100, queue_timeout=5)
+        holder = await controller.acquire(keys["noisy"])
+        order = []
+
+        async def request(label):
+            ticket = await controller.acquire(keys[label])
+            order.append(label)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        tasks = [asyncio.create_task(request("noisy")) for _ in range(20)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(request("quiet")) for _ in range(3)]
+        tasks += [asyncio.create_task(request("heavy")) for _ in range(6)]
+        await asyncio.sleep(0)
+        holder.release()
+        await asyncio.gather(*tasks)
+
+        # 后到的密钥不用等 noisy 的20个请求全部完成
+        first = order[:12]
+        assert first.count("quiet") == 3 and first.count("heavy") == 6
+        assert controller.active == 0 and controller.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    """测试排队中的请求被取消（客户端断开）后离开队列，不占用名额"""
+    async def scenario():
+        keys = make_keys({"key": "a", "label": "a", "max_concurrency": 1})
+        controller = AdmissionController(max_concurrency=0, key_concurrency=0, queue_size=10, queue_timeout=5)
+        ticket = await controller.acquire(keys["a"])
+        waiter = asyncio.create_task(controller.acquire(keys["a"]))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+        assert controller.waiting == 0
+        ticket.release()
+        assert controller.active == 0
+        (await controller.acquire(keys["a"])).release()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_per_key_limit_and_queue()
+    test_noisy_key_does_not_starve_others()
+    test_cancelled_waiter_leaves_queue()
+    print("✅ 准入控制测试全部通过")
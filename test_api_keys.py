@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+测试客户端密钥索引和 client.json 热重载
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from api_keys import ApiKeyIndex, hash_api_key
+from main import ConfigManager, UpstreamError, prepare_codebuddy_body
+
+
+def test_index_formats():
+    """测试字符串、带元数据和只有摘要的条目"""
+    index = ApiKeyIndex.from_config([
+        "sk-plain",
+        {"key": "sk-team", "label": "team", "max_concurrency": 4, "models": ["claude-4.0"]},
+        {"key_sha256": hash_api_key("sk-hashed").upper(), "label": "ci"},
+    ])
+    assert len(index) == 3
+
+    plain = index.lookup("sk-plain")
+    assert plain.max_concurrency == 0 and plain.allows_model("anything")
+    assert plain.label == hash_api_key("sk-plain")[:8]
+
+    team = index.lookup("sk-team")
+    assert team.label == "team" and team.max_concurrency == 4
+    assert team.allows_model("claude-4.0") and not team.allows_model("gpt-5")
+
+    assert index.lookup("sk-hashed").label == "ci"
+    assert index.lookup("sk-unknown") is None and index.lookup(None) is None
+
+    # 导出的条目不含明文，且可以原样解析回来
+    entries = index.to_entries()
+    assert "sk-plain" not in json.dumps(entries) and "sk-team" not in json.dumps(entries)
+    restored = ApiKeyIndex.from_config(entries)
+    assert restored.lookup("sk-team").models == team.models
+
+
+def test_coalesce_settings():
+    """测试按密钥配置的增量合并参数，未配置的项使用默认值"""
+    from stream_buffer import SSE_COALESCE_BYTES, coalescing_for
+
+    index = ApiKeyIndex.from_config([
+        "sk-default",
+        {"key": "sk-batch", "coalesce_ms": 20, "coalesce_bytes": 4096},
+        {"key": "sk-window", "coalesce_ms": 15},
+        {"key": "sk-off", "coalesce_ms": 0, "coalesce_bytes": 512},
+    ])
+    batch = coalescing_for(index.lookup("sk-batch"))
+    assert batch.window == 0.02 and batch.max_bytes == 4096
+    window = coalescing_for(index.lookup("sk-window"))
+    assert window.window == 0.015 and window.max_bytes == SSE_COALESCE_BYTES
+    assert coalescing_for(index.lookup("sk-off")) is None
+
+    restored = ApiKeyIndex.from_config(index.to_entries())
+    assert restored.lookup("sk-batch").coalesce_bytes == 4096
+    assert restored.lookup("sk-default").coalesce_ms is None
+
+    for bad in ({"keys": []}, [1], [{"label": "x"}], [{"key_sha256": "abc"}], [{"key": "k", "models": "m"}],
+                [{"key": "k", "coalesce_ms": -1}], [{"key": "k", "coalesce_bytes": 0}]):
+        try:
+            ApiKeyIndex.from_config(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"应拒绝无效配置: {bad}")
+
+
+def test_hot_reload():
+    """测试文件修改后重载，格式错误时保留旧索引，处理中的请求不受影响"""
+    async def scenario(path):
+        manager = ConfigManager()
+        with open(path, "w") as f:
+            json.dump(["sk-old"], f)
+        assert await manager.reload_api_keys(path) is True
+        assert await manager.reload_api_keys(path) is False
+
+        in_flight = manager.lookup_api_key("sk-old")
+        with open(path, "w") as f:
+            json.dump([{"key": "sk-new", "label": "new"}], f)
+        os.utime(path, ns=(1, 1))
+        assert await manager.reload_api_keys(path) is True
+        assert manager.validate_api_key("sk-new") and not manager.validate_api_key("sk-old")
+        assert in_flight.label == hash_api_key("sk-old")[:8]
+
+        with open(path, "w") as f:
+            f.write("[\"sk-broken\"")
+        os.utime(path, ns=(2, 2))
+        try:
+            await manager.reload_api_keys(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("格式错误的文件应抛出异常")
+        assert manager.validate_api_key("sk-new")
+        # 同一个错误文件不会重复解析
+        assert await manager.reload_api_keys(path) is False
+
+    with tempfile.TemporaryDirectory() as workdir:
+        asyncio.run(scenario(os.path.join(workdir, "client.json")))
+
+
+def test_model_allow_list():
+    """测试按密钥限制可用模型"""
+    import main
+    main.config_manager.models_map = {"claude-4.0": "claude-4.0", "gpt-5": "gpt-5"}
+    key = ApiKeyIndex.from_config([{"key": "sk-a", "models": ["claude-4.0"]}]).lookup("sk-a")
+
+    body = {"model": "claude-4.0", "messages": [{"role": "user", "content": "hi"}]}
+    assert prepare_codebuddy_body(body, key) == "claude-4.0"
+    try:
+        prepare_codebuddy_body({"model": "gpt-5", "messages": []}, key)
+    except UpstreamError as e:
+        assert e.status_code == 403
+    else:
+        raise AssertionError("不在允许列表中的模型应返回403")
+
+
+if __name__ == "__main__":
+    test_index_formats()
+    test_coalesce_settings()
+    test_hot_reload()
+    test_model_allow_list()
+    print("✅ 客户端密钥测试全部通过")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+测试流式响应聚合：工具调用参数拼接、不连续的index、多个choice
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+import json_codec
+from completion_accumulator import CompletionAccumulator
+
+
+def chunk(choices=None, **extra):
+    return {"id": "chatcmpl-1", "object": "chat.completion.chunk", "choices": choices or [], **extra}
+
+
+def test_text_and_usage():
+    """测试文本拼接、第一个chunk的ID和最后的usage"""
+    accumulator = CompletionAccumulator()
+    for piece in ["你", "好", "", None]:
+        accumulator.add_chunk(chunk([{"index": 0, "delta": {"content": piece}}]))
+    accumulator.add_chunk(chunk([{"index": 0, "delta": {}, "finish_reason": "length"}]))
+    accumulator.add_chunk({"id": "other", "choices": [], "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}})
+    accumulator.add_chunk({"choices": [], "usage": None})
+
+    result = accumulator.build("client-model")
+    assert result["id"] == "chatcmpl-1" and result["model"] == "client-model"
+    assert result["object"] == "chat.completion"
+    assert result["choices"] == [
+        {"index": 0, "message": {"role": "assistant", "content": "你好"}, "finish_reason": "length"}
+    ]
+    assert result["usage"]["total_tokens"] == 5
+
+    empty = CompletionAccumulator().build("m")
+    assert empty["choices"][0]["message"] == {"role": "assistant", "content": ""}
+    assert empty["choices"][0]["finish_reason"] == "stop"
+    assert empty["id"].startswith("chatcmpl-")
+
+
+def test_sparse_tool_calls_and_multiple_choices():
+    """测试不连续的工具调用index不补空项，多个choice分别聚合"""
+    accumulator = CompletionAccumulator()
+    accumulator.add_chunk(chunk([
+        {"index": 0, "delta": {"content": "先查一下"}},
+        {"index": 1, "delta": {"content": "第二个回答"}},
+    ]))
+    accumulator.add_chunk(chunk([{"index": 0, "delta": {"tool_calls": [
+        {"index": 3, "id": "call_b", "type": "function", "function": {"name": "search", "arguments": ""}},
+        {"index": 1, "id": "call_a", "function": {"name": "read", "arguments": '{"pa'}},
+    ]}}]))
+    for piece in ['th": ', '"a.py"}']:
+        accumulator.add_chunk(chunk([{"index": 0, "delta": {"tool_calls": [{"index": 1, "function": {"arguments": piece}}]}}]))
+    accumulator.add_chunk(chunk([{"index": 0, "delta": {"tool_calls": [{"index": 3, "function": {"arguments": "{}"}}]}}]))
+    accumulator.add_chunk(chunk([
+        {"index": 0, "delta": {}, "finish_reason": "tool_calls"},
+        {"index": 1, "delta": {}, "finish_reason": "stop"},
+    ]))
+
+    choices = accumulator.build("m")["choices"]
+    assert [c["index"] for c in choices] == [0, 1]
+    assert choices[0]["finish_reason"] == "tool_calls"
+    assert "content" not in choices[0]["message"]
+    assert choices[0]["message"]["tool_calls"] == [
+        {"id": "call_a", "type": "function", "function": {"name": "read", "arguments": '{"path": "a.py"}'}},
+        {"id": "call_b", "type": "function", "function": {"name": "search", "arguments": "{}"}},
+    ]
+    assert choices[1]["message"] == {"role": "assistant", "content": "第二个回答"}
+
+
+def test_collect_completion_from_sse():
+    """测试 main.collect_completion 从SSE字节流聚合，跳过无法解析的事件"""
+    import main
+
+    events = [
+        chunk([{"index": 0, "delta": {"role": "assistant", "content": "hel"}}]),
+        chunk([{"index": 0, "delta": {"content": "lo"}, "finish_reason": "stop"}]),
+    ]
+    body = b"data: {not json\n\n" + b"".join(b"data: " + json_codec.dumps(e) + b"\n\n" for e in events)
+    body +=b"data: [DONE]\n\ndata: " + json_codec.dumps(chunk([{"index": 0, "delta": {"content": "!"}}])) + b"\n\n"
+    response = httpx.Response(200, content=body)
+
+    result = asyncio.run(main.collect_completion(response, "client-model"))
+    assert result["choices"][0]["message"]["content"] == "hello"
+    assert result["choices"][0]["finish_reason"] == "stop"
+
+
+if __name__ == "__main__":
+    test_text_and_usage()
+    test_sparse_tool_calls_and_multiple_choices()
+    test_collect_completion_from_sse()
+    print("✅ 流式响应聚合测试全部通过")
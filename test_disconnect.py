@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+测试客户端断开检测：取消上游请求、清理不被打断、断开次数和节省时间的统计
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import metrics
+from disconnect import ClientDisconnected, cancel_on_disconnect, stop_task
+from stream_buffer import StreamBuffer
+
+
+def make_receive(disconnect_after: float):
+    """模拟请求体已读完的ASGI receive：disconnect_after 秒后返回 http.disconnect"""
+    async def receive():
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+    return receive
+
+
+def test_cancel_on_disconnect():
+    """测试上游先完成时返回结果，客户端先断开时取消上游并按平均耗时估算节省时间"""
+    cancelled = []
+
+    async def upstream(seconds):
+        try:
+            await asyncio.sleep(seconds)
+            return "done"
+        except asyncio.CancelledError:
+            cancelled.append(seconds)
+            raise
+
+    async def scenario():
+        assert await cancel_on_disconnect(None, upstream(0.01), "test_disconnect") == "done"
+        assert await cancel_on_disconnect(make_receive(10), upstream(0.1), "test_disconnect") == "done"
+        try:
+            await cancel_on_disconnect(make_receive(0.02), upstream(10), "test_disconnect")
+            assert False, "应该抛出 ClientDisconnected"
+        except ClientDisconnected:
+            pass
+
+    asyncio.run(scenario())
+    assert cancelled == [10]
+    assert metrics.UPSTREAM_DURATION.labels("test_disconnect").count == 1
+    assert metrics.CLIENT_DISCONNECTS.labels("test_disconnect").value == 1
+    # 平均耗时约0.1秒，断开时已经过约0.02秒
+    saved = metrics.UPSTREAM_SECONDS_SAVED.labels("test_disconnect").value
+    assert 0.03 < saved < 0.1
+
+
+def test_cleanup_survives_repeated_cancel():
+    """测试外层任务被反复取消（anyio 取消作用域的行为）时，上游任务的清理仍能完成"""
+    closed = []
+
+    async def upstream():
+        try:
+            await asyncio.sleep(10)
+        finally:
+            # 模拟关闭上游响应、归还连接
+            await asyncio.sleep(0.05)
+            closed.append(True)
+
+    async def outer(task):
+        await stop_task(task)
+
+    async def scenario():
+        task = asyncio.create_task(upstream())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(outer(task))
+        for _ in range(5):
+            await asyncio.sleep(0.005)
+            waiter.cancel()
+        await asyncio.wait((task,))
+        return task.cancelled()
+
+    assert asyncio.run(scenario())
+    assert closed == [True]
+
+
+def test_stream_buffer_cancels_on_disconnect():
+    """测试流式响应在客户端断开时立即停止读取上游，即使客户端写入还没有失败"""
+    closed = asyncio.Event()
+
+    async def source():
+        try:
+            while True:
+                yield b"z" * 10
+                await asyncio.sleep(0.005)
+        finally:
+            closed.set()
+
+    async def scenario():
+        stream = aiter(StreamBuffer(source(), 1000, "test_disconnect_stream", make_receive(0.03)))
+        assert await anext(stream)
+        # 客户端不再读取，上游读取仍应在断开后被取消
+        await asyncio.wait_for(closed.wait(), 1)
+        await stream.aclose()
+
+    asyncio.run(scenario())
+    assert metrics.CLIENT_DISCONNECTS.labels("test_disconnect_stream").value == 1
+    assert metrics.UPSTREAM_DURATION.labels("test_disconnect_stream").count == 0
+    assert metrics.STREAM_BUFFER_BYTES.labels("test_disconnect_stream").value == 0
+
+
+if __name__ == "__main__":
+    test_cancel_on_disconnect()
+    test_cleanup_survives_repeated_cancel()
+    test_stream_buffer_cancels_on_disconnect()
+    print("✅ 客户端断开检测测试全部通过")
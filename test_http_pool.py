@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+测试上游客户端的TLS会话恢复、握手计数，以及HTTP/2多路复用和回退
+"""
+
+import asyncio
+import os
+import ssl
+import sys
+from unittest import mock
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import h2.config
+import h2.connection
+import h2.events
+import httpx
+
+import metrics
+from http_pool import (MultiplexedTransport, PoolConfig, ResumingSSLContext, create_async_client,
+                       create_client_ssl_context, get_pool_stats)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures")
+
+
+async def serve_tls(handler, alpn=None):
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(os.path.join(FIXTURES, "tls_localhost.crt"), os.path.join(FIXTURES, "tls_localhost.key"))
+    if alpn:
+        server_context.set_alpn_protocols(alpn)
+    server = await asyncio.start_server(handler, "127.0.0.1", 0, ssl=server_context)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def respond_and_close(reader, writer):
+    """每个请求后关闭连接，迫使客户端为下一个请求新建连接"""
+    await reader.readuntil(b"\r\n\r\n")
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+    await writer.drain()
+    writer.close()
+
+
+def h2_handler(release: asyncio.Event, max_streams: int):
+    """最小的HTTP/2服务器：每个请求等到 release 后返回 ok"""
+    async def handler(reader, writer):
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_streams})
+        writer.write(conn.data_to_send())
+
+        async def respond(stream_id):
+            await release.wait()
+            conn.send_headers(stream_id, [(":status", "200"), ("content-length", "2")])
+            conn.send_data(stream_id, b"ok", end_stream=True)
+            writer.write(conn.data_to_send())
+
+        tasks = []
+        while data := await reader.read(65536):
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    tasks.append(asyncio.create_task(respond(event.stream_id)))
+            writer.write(conn.data_to_send())
+        writer.close()
+
+    return handler
+
+
+def test_default_context_verifies():
+    """测试默认上下文与 ssl.create_default_context() 一样校验证书和主机名"""
+    context = create_client_ssl_context()
+    assert isinstance(context, ResumingSSLContext)
+    assert context.verify_mode == ssl.CERT_REQUIRED and context.check_hostname
+
+
+def test_new_connections_resume_session():
+    """测试连接关闭后新建的连接恢复TLS会话，握手次数按是否恢复计数"""
+    async def scenario():
+        server, port = await serve_tls(respond_and_close)
+        context = ResumingSSLContext()
+        context.load_verify_locations(os.path.join(FIXTURES, "tls_localhost.crt"))
+        client = create_async_client(
+            PoolConfig("TEST_TLS_POOL_"),
+            verify=context,
+            event_hooks={"request": [metrics.upstream_connect_hook("test-tls")]}
+        )
+        try:
+            bodies = [(await client.get(f"https://localhost:{port}/")).text for _ in range(3)]
+        finally:
+            await client.aclose()
+            server.close()
+            await server.wait_closed()
+        return bodies
+
+    bodies = asyncio.run(scenario())
+    assert bodies == ["ok"] * 3
+    full = metrics.UPSTREAM_TLS_HANDSHAKES.labels("test-tls", "false").value
+    resumed = metrics.UPSTREAM_TLS_HANDSHAKES.labels("test-tls", "true").value
+    assert full == 1 and resumed == 2, (full, resumed)
+    assert metrics.UPSTREAM_CONNECT.labels("test-tls").count == 3
+
+
+def make_client(backend: str, max_streams: int = 100):
+    config = PoolConfig("TEST_H2_POOL_")
+    config.http2 = True
+    config.http2_max_streams = max_streams
+    context = ResumingSSLContext()
+    context.load_verify_locations(os.path.join(FIXTURES, "tls_localhost.crt"))
+    return create_async_client(config, verify=context, event_hooks={"request": [metrics.upstream_connect_hook(backend)]})
+
+
+def test_http2_spreads_streams_across_connections():
+    """测试并发流超过每连接上限时新建HTTP/2连接，而不是在同一连接内排队"""
+    async def scenario():
+        release = asyncio.Event()
+        server, port = await serve_tls(h2_handler(release, max_streams=2), alpn=["h2", "http/1.1"])
+        client = make_client("test-h2", max_streams=2)
+        assert isinstance(client._transport, MultiplexedTransport)
+        try:
+            tasks = [asyncio.create_task(client.get(f"https://localhost:{port}/")) for _ in range(5)]
+            await asyncio.sleep(0.3)
+            waiting = get_pool_stats(client)
+            release.set()
+            responses = await asyncio.gather(*tasks)
+        finally:
+            await client.aclose()
+            server.close()
+        return responses, waiting, client._transport
+
+    responses, waiting, transport = asyncio.run(scenario())
+    assert [r.text for r in responses] == ["ok"] * 5
+    assert all(r.http_version == "HTTP/2" for r in responses)
+    assert transport.negotiated_http2 is True
+    assert waiting["http2_streams"] == 5 and waiting["in_use"] == 3
+    assert metrics.UPSTREAM_CONNECTIONS.labels("test-h2", "h2").value == 3
+
+
+def test_http2_falls_back_without_alpn():
+    """测试服务器只支持HTTP/1.1时回退，之后的请求都走HTTP/1.1连接池"""
+    async def scenario():
+        server, port = await serve_tls(respond_and_close, alpn=["http/1.1"])
+        client = make_client("test-h2-fallback", max_streams=1)
+        try:
+            responses = [await client.get(f"https://localhost:{port}/") for _ in range(3)]
+        finally:
+            await client.aclose()
+            server.close()
+        return responses, client._transport
+
+    responses, transport = asyncio.run(scenario())
+    assert [(r.text, r.http_version) for r in responses] == [("ok", "HTTP/1.1")] * 3
+    assert transport.negotiated_http2 is False and len(transport._shards) == 1
+    assert metrics.UPSTREAM_CONNECTIONS.labels("test-h2-fallback", "http/1.1").value == 3
+
+
+def test_pool_stats_guard():
+    """测试连接池统计：httpx/httpcore 内部结构变化或不是共享客户端时返回空字典"""
+    async def scenario():
+        config = PoolConfig("TEST_STATS_POOL_")
+        config.max_per_host = 2
+        client = create_async_client(config)
+        other = httpx.AsyncClient()
+        try:
+            stats = [get_pool_stats(None), get_pool_stats(client), get_pool_stats(other)]
+            pool_transport = client._transport._transport
+            with mock.patch.object(pool_transport, "_pool", object()):
+                stats.append(get_pool_stats(client))
+            return stats
+        finally:
+            await client.aclose()
+            await other.aclose()
+
+    empty = {"in_use": 0, "idle": 0, "waiting": 0}
+    assert asyncio.run(scenario()) == [empty, empty, {}, {}]
+
+
+if __name__ == "__main__":
+    test_default_context_verifies()
+    test_new_connections_resume_session()
+    test_http2_spreads_streams_across_connections()
+    test_http2_falls_back_without_alpn()
+    test_pool_stats_guard()
+    print("✅ 连接池TLS测试全部通过")
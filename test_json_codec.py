@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+测试JSON编解码层
+"""
+
+import asyncio
+import json
+import math
+import random
+import sys
+import os
+from unittest import mock
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_codec
+
+
+def test_iter_dumps_matches_dumps():
+    """测试增量编码的拼接结果与 dumps 逐字节一致"""
+    rng = random.Random(3)
+    for _ in range(200):
+        request = {
+            "model": "claude",
+            "messages": [{"role": "user", "content": "x\"中\\" * rng.randint(0, 5000)}
+                         for _ in range(rng.randint(0, 20))],
+            "tools": [],
+            "stream": rng.choice([True, False, None]),
+        }
+        chunk_size = rng.choice([1, 1024, json_codec.ENCODE_CHUNK_SIZE])
+        chunks = list(json_codec.iter_dumps(request, chunk_size))
+        assert b"".join(chunks) == json_codec.dumps(request)
+        # 除最后一块外，每块都达到了目标大小
+        assert all(len(chunk) >= chunk_size for chunk in chunks[:-1])
+
+    for value in [[1, 2], "text", None, {1: "non-string key"}, {}]:
+        assert b"".join(json_codec.iter_dumps(value)) == json_codec.dumps(value)
+
+
+def test_aiter_dumps():
+    """测试异步增量编码"""
+    request = {"messages": [{"content": "a" * 100000}, {"content": "b" * 100000}]}
+
+    async def collect():
+        return [chunk async for chunk in json_codec.aiter_dumps(request)]
+
+    chunks = asyncio.run(collect())
+    assert len(chunks) > 1
+    assert b"".join(chunks) == json_codec.dumps(request)
+
+
+def each_backend():
+    """依次把 json_codec 切换到每个已安装的后端"""
+    for name in ("orjson", "msgspec", "json"):
+        backend = json_codec._load_backend(name)
+        if backend is None:
+            continue
+        codec_name, dumps, loads, encode_string = backend
+        with mock.patch.multiple(json_codec, CODEC_NAME=codec_name, _fast_dumps=dumps,
+                                 _fast_loads=loads, _fast_encode_string=encode_string):
+            yield codec_name
+
+
+def test_backends_agree_on_dumps():
+    """测试各后端（包括回退到标准库的情况）输出一致：非字符串键、NaN、大整数、非ASCII"""
+    exact = [
+        {"text": "你好 é 😀", "ctrl": "\x00\x1f\"\\\n"},
+        {1: "a", 2.5: "b", None: "c"}, {True: "d"},
+        [2 ** 64, -2 ** 63 - 1, 2 ** 63 - 1],
+        [float("nan"), float("inf"), -float("inf"), {"x": float("nan")}],
+        ["\ud800孤立代理"],
+        (1, [True, None]),
+    ]
+    outputs = {}
+    for name in each_backend():
+        outputs[name] = [json_codec.dumps(value) for value in exact]
+        assert json_codec.encode_string("中\"\n") == '"中\\"\\n"'.encode("utf-8")
+        # 浮点数的指数写法可能不同，解析后的值相同
+        floats = [1e16, 1e-7, 0.1, -0.0, 123456789.123]
+        assert json.loads(json_codec.dumps(floats)) == floats
+    assert outputs["json"] == [
+        '{"text":"你好 é 😀","ctrl":"\\u0000\\u001f\\"\\\\\\n"}'.encode("utf-8"),
+        b'{"1":"a","2.5":"b","null":"c"}', b'{"true":"d"}',
+        b"[18446744073709551616,-9223372036854775809,9223372036854775807]",
+        b'[null,null,null,{"x":null}]',
+        b'["\\ud800\\u5b64\\u7acb\\u4ee3\\u7406"]',
+        b"[1,[true,null]]",
+    ]
+    for name, output in outputs.items():
+        assert output == outputs["json"], name
+
+
+def test_backends_agree_on_loads():
+    """测试各后端解析结果一致，非法JSON统一抛出 json.JSONDecodeError"""
+    data = '{"text": "你好", "big": 18446744073709551616, "nan": NaN, "list": [1.5, -0.0]}'.encode("utf-8")
+    for name in each_backend():
+        for source in (data, data.decode("utf-8"), bytearray(data), memoryview(data)):
+            value = json_codec.loads(source)
+            assert value["text"] == "你好" and value["big"] == 2 ** 64 and value["list"] == [1.5, -0.0], name
+            assert math.isnan(value["nan"])
+        try:
+            json_codec.loads(b'{"a": tru}')
+            assert False, name
+        except json.JSONDecodeError as e:
+            assert e.pos == 6
+
+
+if __name__ == "__main__":
+    test_iter_dumps_matches_dumps()
+    test_aiter_dumps()
+    test_backends_agree_on_dumps()
+    test_backends_agree_on_loads()
+    print("✅ JSON编解码测试全部通过")
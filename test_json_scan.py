@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+测试JSON顶层字段扫描器
+"""
+
+import base64
+import json
+import random
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from json_scan import TopLevelScanner, scan_top_level
+
+
+def scan_in_chunks(body: bytes, cuts):
+    scanner = TopLevelScanner(("stream", "model"))
+    for a, b in zip([0] + cuts, cuts + [len(body)]):
+        scanner.feed(body[a:b])
+    return scanner.result()
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randint(0, 7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.choice([True, False, None])
+    if kind == 1:
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 2:
+        return rng.random() * 1000
+    if kind in (3, 4):
+        alphabet = 'ab"\\/{}[],: \n\t中文🚀\u0000'
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+    if kind == 5:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {random_value(rng, 4) if rng.random() < 0.8 else "stream": random_value(rng, depth + 1)
+            for _ in range(rng.randint(0, 4))}
+
+
+def test_matches_json_loads():
+    """测试随机请求体在任意分块下与 json.loads 的结果一致"""
+    rng = random.Random(42)
+    for _ in range(500):
+        request = {str(k): random_value(rng) for k in range(rng.randint(0, 5))}
+        if rng.random() < 0.7:
+            request["stream"] = rng.choice([True, False, None, 0, 1, "yes", ""])
+        if rng.random() < 0.5:
+            request["model"] = "claude-" + str(rng.randint(0, 9))
+        body = json.dumps(request, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2])).encode()
+
+        expected = {k: request[k] for k in ("stream", "model") if k in request}
+        assert scan_in_chunks(body, []) == expected, body
+        cuts = sorted(rng.sample(range(1, len(body)), min(len(body) - 1, rng.randint(1, 10)))) if len(body) > 1 else []
+        assert scan_in_chunks(body, cuts) == expected, (body, cuts)
+        assert scan_in_chunks(body, list(range(1, len(body)))) == expected, body
+
+
+def test_escapes_across_chunk_boundaries():
+    """测试转义字符跨块时字符串边界判断正确"""
+    body = b'{"messages": [{"content": "a\\\\"}, {"content": "b\\"}\\\\\\""}], "stream": true}'
+    assert json.loads(body)["stream"] is True
+    for i in range(1, len(body)):
+        assert scan_in_chunks(body, [i]) == {"stream": True}
+
+
+def test_duplicate_keys_last_wins():
+    """测试重复键以最后一次出现为准"""
+    assert scan_top_level(b'{"stream": true, "x": 1, "stream": false}') == {"stream": False}
+    assert scan_top_level(b'{"str\\u0065am": true}') == {"stream": True}
+
+
+def test_undetermined_cases():
+    """测试扫描器无法确定时返回 None，由调用方回退到完整解析"""
+    for body in [b"", b"[]", b'{"stream": tru}', b'{"stream": true', b'{"stream": {"a": 1}}',
+                 b'{"a" 1}', b'{"stream": true} trailing', b'{"stream": "' + b"x" * 1000 + b'"}']:
+        assert scan_top_level(body) is None, body
+    assert scan_top_level(b" {} ") == {}
+    assert scan_top_level(b'{"model": "x"}') == {}
+
+
+def test_large_base64_body():
+    """测试大体积多模态请求体只扫描不解析"""
+    image = base64.b64encode(os.urandom(3 * 1024 * 1024)).decode()
+    body = json.dumps({
+        "model": "claude",
+        "messages": [{"role": "user", "content": [{"type": "image", "source": {"data": image}}]}],
+        "stream": True,
+    }).encode()
+    scanner = TopLevelScanner()
+    for i in range(0, len(body), 65536):
+        scanner.feed(body[i:i + 65536])
+    assert scanner.result() == {"stream": True}
+    assert scanner.bytes_scanned == len(body)
+
+
+if __name__ == "__main__":
+    test_matches_json_loads()
+    test_escapes_across_chunk_boundaries()
+    test_duplicate_keys_last_wins()
+    test_undetermined_cases()
+    test_large_base64_body()
+    print("✅ JSON顶层字段扫描器测试全部通过")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+测试异步结构化日志：有界队列的丢弃计数、按请求采样和JSON输出
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from logging.handlers import QueueListener
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from fastapi import FastAPI
+
+import log_pipeline
+from log_pipeline import BoundedQueueHandler, Lazy, RequestContextFilter, begin_request, create_formatter, end_request, preview
+
+
+def make_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def test_full_queue_drops_and_reports():
+    """测试队列满时不阻塞、按级别计数，有空位后补发丢弃提示"""
+    handler = BoundedQueueHandler(queue.Queue(maxsize=2))
+    handler.addFilter(RequestContextFilter())
+    logger = make_logger("test.drop", handler)
+
+    started = time.perf_counter()
+    for i in range(5):
+        logger.info("message %d", i)
+    logger.error("boom")
+    assert time.perf_counter() - started < 0.1
+    assert handler.dropped == {"INFO": 3, "ERROR": 1}
+    assert log_pipeline.LOG_DROPPED.labels("INFO").value >= 3
+
+    handler.queue.get_nowait()
+    handler.queue.get_nowait()
+    logger.info("after")
+    messages = [handler.queue.get_nowait().getMessage() for _ in range(2)]
+    assert messages == ["日志队列已满，丢弃了 4 条日志", "after"]
+
+
+def test_sampling_and_request_id():
+    """测试未采样请求只保留 WARNING 及以上，日志带上 request_id"""
+    handler = BoundedQueueHandler(queue.Queue())
+    handler.addFilter(RequestContextFilter())
+    logger = make_logger("test.sample", handler)
+
+    def run(sample_rate):
+        token = begin_request("req-1", sample_rate=sample_rate)
+        try:
+            logger.debug("hot path %s", "detail")
+            logger.warning("always kept")
+        finally:
+            end_request(token)
+
+    run(0.0)
+    run(1.0)
+    logger.info("outside request")
+    records = []
+    while not handler.queue.empty():
+        records.append(handler.queue.get_nowait())
+    assert [(r.getMessage(), r.request_id) for r in records] == [
+        ("always kept", "req-1"),
+        ("hot path detail", "req-1"),
+        ("always kept", "req-1"),
+        ("outside request", "-"),
+    ]
+
+
+def test_json_output_in_background_thread():
+    """测试JSON在后台线程中生成，慢输出不阻塞写日志的线程"""
+    stream = io.StringIO()
+    release = threading.Event()
+
+    class SlowStream(logging.StreamHandler):
+        def emit(self, record):
+            release.wait(1)
+            super().emit(record)
+
+    output = SlowStream(stream)
+    output.setFormatter(create_formatter("json"))
+    handler = BoundedQueueHandler(queue.Queue(maxsize=100))
+    handler.addFilter(RequestContextFilter())
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    logger = make_logger("test.json", handler)
+
+    token = begin_request("req-json", sample_rate=1.0)
+    try:
+        started = time.perf_counter()
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            logger.exception("失败: %s", {"k": 1})
+        assert time.perf_counter() - started < 0.05
+    finally:
+        end_request(token)
+    release.set()
+    listener.stop()
+
+    entry = json.loads(stream.getvalue().strip())
+    assert entry["message"] == "失败: {'k': 1}"
+    assert entry["request_id"] == "req-json" and entry["levelname"] == "ERROR"
+    assert "ValueError: bad" in entry["exc_info"]
+
+
+def test_middleware_sets_request_id():
+    """测试中间件设置请求上下文并返回 X-Request-ID"""
+    app = FastAPI()
+    seen = []
+
+    @app.get("/ping")
+    async def ping():
+        seen.append(log_pipeline.current_request_id())
+        return {"ok": True}
+
+    log_pipeline.install(app)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = await client.get("/ping")
+            second = await client.get("/ping", headers={"X-Request-ID": "from-client"})
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.headers["x-request-id"] == seen[0] and seen[0]
+    assert second.headers["x-request-id"] == "from-client" == seen[1]
+    assert log_pipeline.current_request_id() is None
+
+
+def test_lazy_request_logger():
+    """测试门面在级别关闭或请求未采样时不计算参数，输出时 funcName 指向调用方"""
+    assert str(preview("a" * 10, 5)) == "aaaaa..."
+    assert str(preview("短", 5)) == "短"
+    assert str(preview("中文内容".encode("utf-8"), 2)) == "中文..."
+    assert str(preview(b"abc", 5)) == "abc"
+    assert str(preview([1, 2, 3], 4)) == "[1, ..."
+
+    calls = []
+
+    def expensive():
+        calls.append(1)
+        return "value"
+
+    handler = BoundedQueueHandler(queue.Queue())
+    handler.addFilter(RequestContextFilter())
+    make_logger("test.lazy", handler).setLevel(logging.INFO)
+    request_log = log_pipeline.request_logger("test.lazy")
+
+    request_log.debug("disabled %s", Lazy(expensive))
+    token = begin_request("req-lazy", sample_rate=0.0)
+    try:
+        request_log.info("unsampled %s", Lazy(expensive))
+        request_log.warning("kept %s", Lazy(expensive))
+    finally:
+        end_request(token)
+    assert handler.queue.qsize() == 1
+
+    token = begin_request("req-lazy", sample_rate=1.0)
+    try:
+        request_log.info("sampled %s", Lazy(expensive))
+    finally:
+        end_request(token)
+    records = [handler.queue.get_nowait() for _ in range(2)]
+    assert [r.getMessage() for r in records] == ["kept value", "sampled value"]
+    assert len(calls) == 2
+    assert records[1].funcName == "test_lazy_request_logger"
+
+
+def test_import_leaves_logging_alone():
+    """测试导入应用模块不会修改日志配置，默认输出原来的纯文本格式"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    script = (
+        "import logging, os, sys\n"
+        f"sys.path.insert(0, {root!r})\n"
+        "handler = logging.StreamHandler()\n"
+        "logging.getLogger().addHandler(handler)\n"
+        "logging.getLogger('uvicorn').addHandler(handler)\n"
+        "import main, format_proxy, server, api_keys\n"
+        "assert logging.getLogger().handlers == [handler]\n"
+        "assert logging.getLogger('uvicorn').handlers == [handler]\n"
+        "assert not os.path.exists('codebuddy_proxy.log')\n"
+        "assert main.log_pipeline.LOG_FORMAT == 'text'\n"
+    )
+    env = {k: v for k, v in os.environ.items() if k != "LOG_FORMAT"}
+    with tempfile.TemporaryDirectory() as workdir:
+        result = subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "纯文本", None, None)
+    line = create_formatter("text").format(record)
+    assert line.endswith(" - test - INFO - 纯文本")
+    assert log_pipeline.TEXT_FORMAT == "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+if __name__ == "__main__":
+    test_full_queue_drops_and_reports()
+    test_sampling_and_request_id()
+    test_json_output_in_background_thread()
+    test_middleware_sets_request_id()
+    test_lazy_request_logger()
+    test_import_leaves_logging_alone()
+    print("✅ 日志管道测试全部通过")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+测试单遍消息规范化：随机生成的对话与原 fix_tool_call_sequence + transform_messages 的输出一致
+"""
+
+import copy
+import os
+import random
+import sys
+from typing import Dict, List
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import normalize_messages
+
+
+def reference_fix_tool_call_sequence(messages: List[Dict]) -> List[Dict]:
+    """原 main.fix_tool_call_sequence（去掉日志），作为对照实现"""
+    if not messages:
+        return messages
+
+    fixed_messages = []
+    i = 0
+    while i < len(messages):
+        current_msg = messages[i]
+        if current_msg.get("role") == "assistant" and current_msg.get("tool_calls"):
+            fixed_messages.append(current_msg)
+            i += 1
+            tool_results = []
+            potential_interrupts = []
+            while i < len(messages):
+                next_msg = messages[i]
+                if next_msg.get("role") == "tool" and next_msg.get("tool_call_id"):
+                    tool_results.append(next_msg)
+                    i += 1
+                elif next_msg.get("role") == "user":
+                    potential_interrupts.append(next_msg)
+                    i += 1
+                else:
+                    break
+            fixed_messages.extend(tool_results)
+            fixed_messages.extend(potential_interrupts)
+        else:
+            fixed_messages.append(current_msg)
+            i += 1
+    return fixed_messages
+
+
+def reference_normalize(messages: List[Dict]) -> List[Dict]:
+    """原 transform_messages + 插入占位system消息"""
+    transformed_messages = []
+    for message in reference_fix_tool_call_sequence(messages):
+        transformed_message = message.copy()
+        if message.get("role") == "system":
+            transformed_message["role"] = "user"
+        transformed_messages.append(transformed_message)
+    transformed_messages.insert(0, {"role": "system", "content": '.'})
+    return transformed_messages
+
+
+def random_transcript(rng: random.Random, length: int) -> List[Dict]:
+    """随机对话：工具调用、匹配/不匹配/缺失的tool_result、插入的用户消息、system消息和各种边界情况"""
+    messages = []
+    pending_ids = []
+    for n in range(length):
+        kind = rng.choice(["system", "user", "assistant", "tool_calls", "tool", "tool", "orphan_tool", "odd"])
+        if kind == "system":
+            content = rng.choice(["规则", [{"type": "text", "text": "块"}], ""])
+            messages.append({"role": "system", "content": content, "n": n})
+        elif kind == "user":
+            messages.append({"role": "user", "content": f"用户 {n}"})
+        elif kind == "assistant":
+            messages.append({"role": "assistant", "content": f"回复 {n}"})
+        elif kind == "tool_calls":
+            pending_ids = [f"call_{n}_{k}" for k in range(rng.randint(1, 3))]
+            tool_calls = [{"id": call_id, "type": "function"} for call_id in pending_ids]
+            if rng.random() < 0.2:
+                tool_calls.append({"type": "function"})
+            messages.append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+        elif kind == "tool":
+            call_id = pending_ids.pop(0) if pending_ids and rng.random() < 0.8 else f"unknown_{n}"
+            messages.append({"role": "tool", "tool_call_id": call_id, "content": f"结果 {n}"})
+        elif kind == "orphan_tool":
+            messages.append({"role": "tool", "content": "没有tool_call_id"})
+        else:
+            messages.append(rng.choice([
+                {"role": "assistant", "tool_calls": []},
+                {"role": "developer", "content": "其他角色"},
+                {"content": "没有role"},
+            ]))
+    return messages
+
+
+def test_matches_reference_on_random_transcripts():
+    """测试随机对话上的输出与原实现逐条相等，且不修改输入"""
+    rng = random.Random(18)
+    for case in range(500):
+        messages = random_transcript(rng, rng.randint(0, 40))
+        original = copy.deepcopy(messages)
+        result = normalize_messages(messages, f"case-{case}")
+        assert result == reference_normalize(original), f"case {case}: {original}"
+        assert messages == original
+
+
+def test_untouched_messages_are_not_copied():
+    """测试只有system消息被复制，其余消息原样复用"""
+    rng = random.Random(2000)
+    messages = random_transcript(rng, 2000)
+    main.normalize_cache.clear()
+    result = normalize_messages(messages, "identity")
+    assert len(result) == len(messages) + 1
+    inputs = {id(message) for message in messages}
+    for message in result[1:]:
+        if message.get("n") is not None:
+            assert id(message) not in inputs and message["role"] == "user"
+        else:
+            assert id(message) in inputs
+
+
+def test_interrupts_moved_after_tool_results():
+    """测试插入的用户消息移到tool_result之后，遇到system消息时结束收集"""
+    call = {"role": "assistant", "tool_calls": [{"id": "a"}, {"id": "b"}]}
+    interrupt = {"role": "user", "content": "等等"}
+    result_a = {"role": "tool", "tool_call_id": "a", "content": "1"}
+    result_b = {"role": "tool", "tool_call_id": "b", "content": "2"}
+    system = {"role": "system", "content": "规则"}
+    result = normalize_messages([call, result_a, interrupt, system, result_b], "order")
+    assert result == [
+        {"role": "system", "content": "."},
+        call, result_a, interrupt,
+        {"role": "user", "content": "规则"},
+        result_b,
+    ]
+    assert normalize_messages([], "empty") == [{"role": "system", "content": "."}]
+
+
+if __name__ == "__main__":
+    test_matches_reference_on_random_transcripts()
+    test_untouched_messages_are_not_copied()
+    test_interrupts_moved_after_tool_results()
+    print("✅ 消息规范化测试全部通过")
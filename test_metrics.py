@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+测试 Prometheus 指标端点和记录中间件
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+import metrics
+from metrics import Counter, Gauge, HistogramFamily, format_value, render, timed
+
+
+def make_app(backend: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat(body: dict):
+        metrics.set_request_model(body.get("model"))
+        if body.get("stream"):
+            async def events():
+                yield b"data: 1\n\ndata: 2\n"
+                yield b"\ndata: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+        return {"ok": True}
+
+    metrics.install(app, backend)
+    return app
+
+
+async def request_all(app: FastAPI, calls):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return [await client.request(method, path, json=body) for method, path, body in calls]
+
+
+def sample(text: str, prefix: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(prefix + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"未找到指标 {prefix}")
+
+
+def test_middleware_records_requests():
+    """测试请求计数、耗时、首字节时间、SSE事件数和进行中的流"""
+    app = make_app("test-backend")
+    responses = asyncio.run(request_all(app, [
+        ("POST", "/v1/chat/completions", {"model": "m1"}),
+        ("POST", "/v1/chat/completions", {"model": "m1", "stream": True}),
+        ("GET", "/no/such/path", None),
+        ("GET", "/metrics", None),
+    ]))
+    assert [r.status_code for r in responses] == [200, 200, 404, 200]
+    assert responses[3].headers["content-type"].startswith("text/plain")
+
+    text = render()
+    assert sample(text, 'cb2api_requests_total{endpoint="/v1/chat/completions",model="m1",status="200",backend="test-backend"}') == 2
+    assert sample(text, 'cb2api_requests_total{endpoint="other",model="",status="404",backend="test-backend"}') == 1
+    assert sample(text, 'cb2api_request_duration_seconds_count{endpoint="/v1/chat/completions",backend="test-backend"}') == 2
+    assert sample(text, 'cb2api_time_to_first_byte_seconds_count{endpoint="/v1/chat/completions",backend="test-backend"}') == 2
+    # 三个事件，其中一个的空行跨两个数据块
+    assert sample(text, 'cb2api_sse_events_per_stream_sum{endpoint="/v1/chat/completions",backend="test-backend"}') == 3
+    assert sample(text, 'cb2api_inflight_streams{endpoint="/v1/chat/completions",backend="test-backend"}') == 0
+    # /metrics 自身不计数
+    assert 'endpoint="/metrics"' not in text
+
+
+def test_text_format():
+    """测试标签转义和直方图的累积桶"""
+    counter = Counter("test_format_total", "格式测试", ("name",))
+    counter.labels('a"b\\c\nd').inc(2)
+    histogram = HistogramFamily("test_format_seconds", "格式测试", ("op",), buckets=(0.1, 1.0))
+    child = histogram.labels("x")
+    for value in (0.05, 0.5, 5.0):
+        child.observe(value)
+
+    text = render()
+    assert 'test_format_total{name="a\\"b\\\\c\\nd"} 2' in text
+    assert 'test_format_seconds_bucket{op="x",le="0.1"} 1' in text
+    assert 'test_format_seconds_bucket{op="x",le="1"} 2' in text
+    assert 'test_format_seconds_bucket{op="x",le="+Inf"} 3' in text
+    assert 'test_format_seconds_count{op="x"} 3' in text
+
+
+def test_non_finite_values():
+    """测试 inf/nan 按 Prometheus 文本格式输出，直方图传入 inf 边界时不重复输出 +Inf 桶"""
+    assert format_value(float("inf")) == "+Inf"
+    assert format_value(float("-inf")) == "-Inf"
+    assert format_value(float("nan")) == "NaN"
+    assert format_value(3.0) == "3"
+    assert format_value(0.25) == "0.25"
+
+    gauge = Gauge("test_non_finite_ratio", "非有限值测试", ("case",))
+    gauge.labels("pos").set(float("inf"))
+    gauge.labels("neg").set(float("-inf"))
+    gauge.labels("nan").set(float("nan"))
+    histogram = HistogramFamily("test_non_finite_seconds", "非有限值测试", buckets=(1.0, float("inf")))
+    histogram.labels().observe(2.0)
+
+    text = render()
+    assert 'test_non_finite_ratio{case="pos"} +Inf' in text
+    assert 'test_non_finite_ratio{case="neg"} -Inf' in text
+    assert 'test_non_finite_ratio{case="nan"} NaN' in text
+    assert text.count('test_non_finite_seconds_bucket{le="+Inf"}') == 1
+    assert 'test_non_finite_seconds_bucket{le="+Inf"} 1' in text
+
+
+def test_timed_and_connect_hook():
+    """测试转换函数计时装饰器和上游连接耗时钩子"""
+    histogram = HistogramFamily("test_timed_seconds", "计时测试", ("function",))
+
+    @timed(histogram, "double")
+    def double(x):
+        return x * 2
+
+    assert double(2) == 4 and double.__name__ == "double"
+    assert histogram.labels("double").count == 1
+
+    async def scenario():
+        hook = metrics.upstream_connect_hook("test-upstream")
+        for url in ("https://example.com/", "http://example.com/"):
+            request = httpx.Request("GET", url)
+            await hook(request)
+            trace = request.extensions["trace"]
+            await trace("connection.connect_tcp.started", {})
+            await trace("connection.connect_tcp.complete", {})
+            await trace("connection.start_tls.started", {})
+            await trace("connection.start_tls.complete", {})
+            await trace("http11.send_request_headers.started", {})
+        # 复用连接时没有 connect 事件
+        request = httpx.Request("GET", "https://example.com/")
+        await hook(request)
+        await request.extensions["trace"]("http11.send_request_headers.started", {})
+
+    asyncio.run(scenario())
+    assert metrics.UPSTREAM_CONNECT.labels("test-upstream").count == 2
+
+
+def test_model_label_cardinality():
+    """测试模型标签数量有上限"""
+    labels = {"model": ""}
+    token = metrics._request_labels.set(labels)
+    try:
+        metrics.set_request_model("x" * 200)
+        assert labels["model"] == "other"
+        saved = set(metrics._model_labels)
+        metrics._model_labels.update(f"filler-{i}" for i in range(metrics.MAX_MODEL_LABELS))
+        metrics.set_request_model("brand-new-model")
+        assert labels["model"] == "other"
+        metrics.set_request_model("filler-1")
+        assert labels["model"] == "filler-1"
+    finally:
+        metrics._request_labels.reset(token)
+        metrics._model_labels.clear()
+        metrics._model_labels.update(saved)
+
+
+if __name__ == "__main__":
+    test_middleware_records_requests()
+    test_text_format()
+    test_non_finite_values()
+    test_timed_and_connect_hook()
+    test_model_label_cardinality()
+    print("✅ 指标测试全部通过")
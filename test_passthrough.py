@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+测试格式一致时的请求透传：请求体原样流式转发，后端的状态码、流式和非流式响应原样返回
+"""
+
+import asyncio
+import os
+import sys
+import time
+from unittest import mock
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+import format_proxy
+import json_codec
+from disconnect import CLIENT_CLOSED_REQUEST
+from sse_parser import SSEParser
+
+
+class MockBackend:
+    """httpx.MockTransport 模拟的后端，记录收到的请求头和请求体"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        self.requests.append((request, body))
+        return await self.respond(request, body)
+
+
+def run_with_backend(respond, scenario):
+    """把 format_proxy 的共享后端客户端换成模拟后端，运行 scenario(backend)"""
+    backend = MockBackend(respond)
+
+    async def runner():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(backend.handle))
+        saved = format_proxy.http_client
+        format_proxy.http_client = client
+        try:
+            await scenario(backend)
+        finally:
+            format_proxy.http_client = saved
+            await client.aclose()
+
+    with mock.patch.object(format_proxy, "BACKEND_TYPE", "openai"):
+        asyncio.run(runner())
+    return backend
+
+
+async def post(body: bytes) -> httpx.Response:
+    transport = httpx.ASGITransport(app=format_proxy.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/v1/chat/completions", content=body, headers={
+            "content-type": "application/json", "authorization": "Bearer sk-test"})
+
+
+def json_response(status: int, content, headers=None):
+    async def respond(request, body):
+        return httpx.Response(status, json=content, headers=headers)
+    return respond
+
+
+def test_non_stream_response():
+    """测试非流式请求：请求体和 Content-Length 原样转发，返回后端的JSON"""
+    body = b'{"model": "m", "messages": [{"role": "user", "content": "\xe4\xbd\xa0\xe5\xa5\xbd"}]}'
+
+    async def scenario(backend):
+        response = await post(body)
+        assert response.status_code == 200
+        assert response.json() == {"id": "chatcmpl-1", "choices": []}
+        request, received = backend.requests[0]
+        assert received == body
+        assert request.headers["content-length"] == str(len(body))
+        assert request.headers["authorization"] == "Bearer sk-test"
+        assert request.url.path == "/v1/chat/completions"
+
+    run_with_backend(json_response(200, {"id": "chatcmpl-1", "choices": []}), scenario)
+
+
+def test_stream_response():
+    """测试流式请求：后端的SSE字节原样返回"""
+    frames = [b'data: {"choices":[{"delta":{"content":"a"}}]}\n\n', b'data: {"choices":[]}\n\n', b"data: [DONE]\n\n"]
+
+    async def respond(request, body):
+        async def events():
+            for frame in frames:
+                yield frame
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=events())
+
+    async def scenario(backend):
+        response = await post(b'{"model": "m", "stream": true, "messages": []}')
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.content == b"".join(frames)
+
+    run_with_backend(respond, scenario)
+
+
+def test_backend_error_status_kept():
+    """测试后端的4xx状态码和错误内容原样返回，429带上 Retry-After"""
+    async def scenario(backend):
+        response = await post(b'{"model": "missing", "messages": []}')
+        assert response.status_code == 404
+        assert response.json() == {"error": {"message": "Model missing not found"}}
+
+    run_with_backend(json_response(404, {"error": {"message": "Model missing not found"}}), scenario)
+
+    async def limited(backend):
+        for body in (b'{"model": "m", "messages": []}', b'{"model": "m", "stream": true, "messages": []}'):
+            response = await post(body)
+            assert response.status_code == 429
+            assert response.headers["retry-after"] == "7"
+
+    run_with_backend(json_response(429, {"error": {"message": "busy"}}, {"Retry-After": "7"}), limited)
+
+
+def test_stream_error_frame_escaped():
+    """测试流式请求的后端错误内容含引号和换行时，错误帧仍是合法的SSE和JSON"""
+    message = '模型 "m" 不可用\n请稍后重试'
+
+    async def respond(request, body):
+        return httpx.Response(400, content=message.encode())
+
+    async def scenario(backend):
+        response = await post(b'{"model": "m", "stream": true, "messages": []}')
+        events = SSEParser().feed(response.content)
+        assert len(events) == 1
+        assert json_codec.loads(events[0].data) == {"error": message}
+
+    run_with_backend(respond, scenario)
+
+
+def test_malformed_json_forwarded():
+    """测试非法JSON不再在本地返回400，而是原样交给后端，由后端的响应决定结果"""
+    body = b'{"model": "m", "stream": tru'
+
+    async def scenario(backend):
+        response = await post(body)
+        assert response.status_code == 400
+        assert response.json() == {"error": {"message": "invalid json"}}
+        assert backend.requests[0][1] == body
+
+    run_with_backend(json_response(400, {"error": {"message": "invalid json"}}), scenario)
+
+    # 无法识别 stream 字段时按后端响应的 content-type 判断是否流式
+    async def respond(request, body):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=b"data: [DONE]\n\n")
+
+    async def streamed(backend):
+        response = await post(body)
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.content == b"data: [DONE]\n\n"
+
+    run_with_backend(respond, streamed)
+
+
+def test_client_disconnect_cancels_backend():
+    """测试等待后端响应时客户端断开，后端请求被立即取消"""
+    cancelled = []
+
+    async def respond(request, body):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(body)
+            raise
+        return httpx.Response(200, json={})
+
+    async def scenario(backend):
+        body = b'{"model": "m", "messages": []}'
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+            "scheme": "http", "path": "/v1/chat/completions", "raw_path": b"/v1/chat/completions",
+            "root_path": "", "query_string": b"", "server": ("test", 80), "client": ("127.0.0.1", 1),
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(0.05)
+            return {"type": "http.disconnect"}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        start = time.perf_counter()
+        await asyncio.wait_for(format_proxy.app(scope, receive, send), 2)
+        assert time.perf_counter() - start < 1
+        assert sent[0]["status"] == CLIENT_CLOSED_REQUEST
+        assert cancelled == [body]
+
+    run_with_backend(respond, scenario)
+
+
+if __name__ == "__main__":
+    test_non_stream_response()
+    test_stream_response()
+    test_backend_error_status_kept()
+    test_stream_error_frame_escaped()
+    test_malformed_json_forwarded()
+    test_client_disconnect_cancels_backend()
+    print("✅ 请求透传测试全部通过")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+测试对话前缀缓存：多轮对话只转换新增消息，结果与不用缓存时一致
+"""
+
+import copy
+import os
+import random
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import format_proxy
+import main
+from metrics import render
+from prefix_cache import PrefixCache
+from test_message_normalizer import random_transcript, reference_normalize
+
+
+def test_lru_limits_and_kill_switch():
+    """测试条目数/内存上限淘汰、扩展前缀替换旧条目，以及关闭开关"""
+    cache = PrefixCache("test_limits", max_entries=2, max_bytes=10 ** 6)
+    conversations = [[{"n": i, "k": k} for k in range(3)] for i in range(3)]
+    for messages in conversations:
+        match = cache.match(messages)
+        assert match.start == 0 and match.value is None
+        match.commit(2, ["converted"] * 2)
+    assert cache.get_stats()["entries"] == 2 and cache.evictions == 1
+
+    # 命中最长前缀，保存更长的前缀时替换原条目
+    messages = conversations[2] + [{"n": 2, "k": 3}]
+    match = cache.match(messages)
+    assert (match.start, match.restore()) == (2, ["converted", "converted"])
+    match.commit(4, ["converted"] * 4)
+    assert len(cache._cache) == 2 and cache.match(messages).start == 4
+    assert cache.reused_messages == 6 and cache.converted_messages == 3 * 3 + 2
+
+    # 单个前缀超过内存上限时不缓存，总量超过上限时按LRU淘汰
+    cache.max_bytes = cache.cached_bytes
+    match = cache.match([{"big": "x" * 1000}])
+    match.commit(1, ["big"])
+    assert cache.match([{"big": "x" * 1000}]).start == 0
+    assert 'cb2api_prefix_cache_hits_total{cache="test_limits"} 2' in render()
+
+    disabled = PrefixCache("test_disabled", enabled=False)
+    match = disabled.match(conversations[0])
+    assert match.anchor is None and match.start == 0
+    match.commit(3, ["x"] * 3)
+    assert disabled.get_stats()["entries"] == 0 and disabled.converted_messages == 3
+    assert not PrefixCache("test_zero", max_entries=0).enabled
+
+
+def test_normalize_multi_turn_matches_reference():
+    """测试逐轮增长、重发和改写历史的对话，每一轮都与原实现一致"""
+    saved = main.normalize_cache
+    main.normalize_cache = PrefixCache("test_normalize")
+    try:
+        rng = random.Random(19)
+        for case in range(50):
+            transcript = random_transcript(rng, 60)
+            turns = sorted(rng.sample(range(61), 8))
+            for length in turns + [turns[-1]]:
+                messages = copy.deepcopy(transcript[:length])
+                result = main.normalize_messages(messages, f"case-{case}")
+                assert result == reference_normalize(copy.deepcopy(messages)), f"case {case}, {length}"
+            if len(transcript) > 3:
+                # 修改中间的一条消息：只能复用修改之前的前缀
+                edited = copy.deepcopy(transcript)
+                edited[len(edited) // 2] = {"role": "user", "content": "改写"}
+                assert main.normalize_messages(edited, "edited") == reference_normalize(copy.deepcopy(edited))
+        stats = main.normalize_cache.get_stats()
+        assert stats["hits"] > 0 and stats["reused_messages"] > stats["converted_messages"]
+    finally:
+        main.normalize_cache = saved
+
+
+def test_anthropic_conversion_reuses_prefix():
+    """测试 Anthropic→OpenAI 转换在多轮对话中只转换新增消息"""
+    def turn(i):
+        return [
+            {"role": "assistant", "content": [
+                {"type": "text", "text": f"读取文件 {i}"},
+                {"type": "tool_use", "id": f"toolu_{i}", "name": "read", "input": {"path": f"{i}.py"}},
+            ]},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": "内容"}]},
+        ]
+
+    saved = format_proxy.conversion_cache
+    format_proxy.conversion_cache = PrefixCache("test_conversion")
+    uncached = PrefixCache("test_conversion_off", enabled=False)
+    try:
+        messages = [{"role": "user", "content": "开始"}]
+        for i in range(10):
+            messages = messages + turn(i)
+            request = {"model": "m", "system": f"系统 {i % 2}", "messages": copy.deepcopy(messages)}
+            result = format_proxy.convert_anthropic_to_openai(request)
+            format_proxy.conversion_cache, cached = uncached, format_proxy.conversion_cache
+            expected = format_proxy.convert_anthropic_to_openai(copy.deepcopy(request))
+            format_proxy.conversion_cache = cached
+            assert result == expected
+            assert result["messages"][0] == {"role": "system", "content": f"系统 {i % 2}"}
+        stats = format_proxy.conversion_cache.get_stats()
+        assert stats["hits"] == 9 and stats["converted_messages"] == 1 + 2 * 10
+        assert stats["entries"] == 1
+    finally:
+        format_proxy.conversion_cache = saved
+
+
+def test_values_equal_under_eq_do_not_share_entries():
+    """测试 true、1 和 1.0 在 == 下相等，但转换结果不同，不能互相命中"""
+    def request(value):
+        return {"model": "m", "messages": [
+            {"role": "user", "content": "开始"},
+            {"role": "assistant", "content": [
+                {"type": "tool_use", "id": "toolu_1", "name": "set", "input": {"flag": value}}]},
+        ]}
+
+    def arguments(result):
+        return [m for m in result["messages"] if m.get("tool_calls")][0]["tool_calls"][0]["function"]["arguments"]
+
+    saved = format_proxy.conversion_cache
+    format_proxy.conversion_cache = PrefixCache("test_strict")
+    try:
+        results = [arguments(format_proxy.convert_anthropic_to_openai(request(value))) for value in (True, True, 1, 1.0)]
+        assert results == ['{"flag":true}', '{"flag":true}', '{"flag":1}', '{"flag":1.0}']
+        assert format_proxy.conversion_cache.hits == 1
+    finally:
+        format_proxy.conversion_cache = saved
+
+
+def test_mutating_returned_request_leaves_cache_unchanged():
+    """测试修改返回的请求不会影响缓存和之后命中的请求，共享的缓存消息不能就地修改"""
+    request = {"model": "m", "messages": [
+        {"role": "user", "content": "开始"},
+        {"role": "assistant", "content": [
+            {"type": "text", "text": "好的"},
+            {"type": "tool_use", "id": "toolu_1", "name": "read", "input": {"path": "a.py"}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "toolu_1", "content": "ok"}]},
+    ]}
+
+    saved = format_proxy.conversion_cache
+    format_proxy.conversion_cache = PrefixCache("test_frozen")
+    try:
+        expected = format_proxy.convert_anthropic_to_openai(copy.deepcopy(request))
+        snapshot = copy.deepcopy(expected)
+        # 未命中时返回的是本请求自己的对象，可以修改
+        expected["messages"][0]["content"] = "改写"
+        expected["messages"][1]["tool_calls"].append({"id": "x"})
+
+        for _ in range(2):
+            hit = format_proxy.convert_anthropic_to_openai(copy.deepcopy(request))
+            assert hit == snapshot
+            for mutate in (lambda: hit["messages"][0].update(content="改写"),
+                           lambda: hit["messages"][1]["tool_calls"].append({"id": "x"}),
+                           lambda: hit["messages"][1]["tool_calls"][0]["function"].pop("name")):
+                try:
+                    mutate()
+                    assert False, "缓存的消息应该是只读的"
+                except TypeError:
+                    pass
+            # 替换整条消息和修改请求自己的列表不受影响
+            hit["messages"][0] = {**hit["messages"][0], "content": "改写"}
+            hit["messages"].append({"role": "user", "content": "追加"})
+        assert format_proxy.conversion_cache.hits == 2
+    finally:
+        format_proxy.conversion_cache = saved
+
+
+if __name__ == "__main__":
+    test_lru_limits_and_kill_switch()
+    test_normalize_multi_turn_matches_reference()
+    test_anthropic_conversion_reuses_prefix()
+    test_values_equal_under_eq_do_not_share_entries()
+    test_mutating_returned_request_leaves_cache_unchanged()
+    print("✅ 前缀缓存测试全部通过")
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+测试多worker共享状态
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from itertools import cycle
+from unittest import mock
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from shared_state import SharedStateClient, SharedStateServer
+from api_keys import ApiKeyIndex
+import main
+from main import ConfigManager, TokenStatus
+
+
+async def wait_for(predicate, timeout: float = 1.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise AssertionError("等待共享状态同步超时")
+        await asyncio.sleep(0.001)
+    return time.perf_counter()
+
+
+def make_manager(tokens, api_keys, models):
+    """构造一个不读取文件的 ConfigManager，模拟一个worker"""
+    manager = ConfigManager()
+    manager.auth_tokens = list(tokens)
+    manager.token_statuses = {token: TokenStatus(token) for token in tokens}
+    manager.available_tokens = list(tokens)
+    manager.token_cycle = cycle(manager.available_tokens)
+    manager.api_keys = ApiKeyIndex.from_config(list(api_keys))
+    manager.models_map = dict(models)
+    return manager
+
+
+def run_with_server(test):
+    async def runner():
+        with tempfile.TemporaryDirectory() as workdir:
+            server = SharedStateServer(os.path.join(workdir, "state.sock"))
+            await server.start()
+            try:
+                await test(server)
+            finally:
+                await server.close()
+    asyncio.run(runner())
+
+
+def test_clients_see_changes():
+    """测试修改在所有客户端之间广播，后连接的客户端拿到快照"""
+    async def scenario(server):
+        a = SharedStateClient(server.socket_path)
+        b = SharedStateClient(server.socket_path)
+        await a.connect()
+        await b.connect()
+        changes = []
+        b.on_change(lambda key, value: changes.append((key, value)))
+
+        start = time.perf_counter()
+        assert await a.set("x", {"n": 1}) is True
+        seen = await wait_for(lambda: b.get("x") == {"n": 1})
+        assert seen - start < 0.1
+
+        assert await a.incr("counter") == 1
+        assert await b.incr("counter", 2) == 3
+        assert await a.setnx("x", "other") is False
+        assert await a.delete("x") is True
+        await wait_for(lambda: b.get("x") is None)
+        assert ("x", None) in changes
+
+        c = SharedStateClient(server.socket_path)
+        await c.connect()
+        assert c.get("counter") == 3 and c.get("x") is None
+
+        # 并发请求在同一连接上按id匹配响应
+        results = await asyncio.gather(*(a.incr("concurrent") for _ in range(50)))
+        assert sorted(results) == list(range(1, 51))
+
+        for client in (a, b, c):
+            await client.close()
+
+    run_with_server(scenario)
+
+
+def test_rate_limit_shared_between_workers():
+    """测试一个worker标记token限流后，其他worker立即不再使用它，恢复同样同步"""
+    async def scenario(server):
+        tokens = ["tok-a", "tok-b", "tok-c"]
+        worker1 = make_manager(tokens, ["sk-1"], {"m": "m"})
+        worker2 = make_manager(tokens, ["sk-2"], {"other": "other"})
+        await worker1.connect_shared_state(server.socket_path)
+        await worker2.connect_shared_state(server.socket_path)
+
+        # 第一个worker写入的配置为准
+        assert worker2.validate_api_key("sk-1") and not worker2.validate_api_key("sk-2")
+        assert worker2.models_map == {"m": "m"}
+        # 共享状态中只有密钥摘要
+        assert "sk-1" not in str(worker1.shared.get("config:api_keys"))
+
+        await worker1.mark_token_rate_limited("tok-b", "usage exceeds frequency limit")
+        await wait_for(lambda: "tok-b" not in worker2.available_tokens)
+        # 共享状态中只有token摘要
+        assert "tok-b" not in str(worker1.shared.local)
+        assert worker1.shared.get(f"token:{worker1.token_statuses['tok-b'].digest}")["error_count"] == 1
+        assert not worker2.token_statuses["tok-b"].is_available
+        assert "tok-b" not in [await worker2.get_next_token() for _ in range(10)]
+
+        # 后启动的worker从快照中拿到限流状态
+        worker3 = make_manager(tokens, [], {})
+        await worker3.connect_shared_state(server.socket_path)
+        assert worker3.available_tokens == ["tok-a", "tok-c"]
+
+        # 到期后由任意一个worker恢复（各worker的重置时间来自同一份共享状态）
+        for worker in (worker1, worker2, worker3):
+            worker.token_statuses["tok-b"].reset_time = time.time() - 1
+        await worker2._check_and_restore_tokens()
+        await wait_for(lambda: "tok-b" in worker1.available_tokens and "tok-b" in worker3.available_tokens)
+
+        # 配置修改同样广播
+        await worker1.shared.set("config:api_keys", ApiKeyIndex.from_config(["sk-new"]).to_entries())
+        await wait_for(lambda: worker3.validate_api_key("sk-new"))
+
+        for worker in (worker1, worker2, worker3):
+            await worker.close()
+
+    run_with_server(scenario)
+
+
+def test_reconnect_after_sidecar_restart():
+    """测试sidecar重启后客户端自动重新订阅"""
+    async def scenario(server):
+        client = SharedStateClient(server.socket_path, reconnect_delay=0.01)
+        await client.connect()
+        await client.set("k", 1)
+        await wait_for(lambda: client.get("k") == 1)
+
+        await server.close()
+        await wait_for(lambda: not client.connected)
+        restarted = SharedStateServer(server.socket_path)
+        await restarted.start()
+        restarted.data["k"] = 2
+        await wait_for(lambda: client.connected and client.get("k") == 2)
+        assert await client.set("k", 3) is True
+        await wait_for(lambda: client.get("k") == 3)
+        await client.close()
+        await restarted.close()
+
+    run_with_server(scenario)
+
+
+def test_rate_limit_survives_sidecar_restart():
+    """测试sidecar重启后空快照不会清除本地的限流状态，并把它写回新的sidecar"""
+    async def scenario(server):
+        worker = make_manager(["tok-a", "tok-b"], [], {})
+        await worker.connect_shared_state(server.socket_path)
+        worker.shared.reconnect_delay = 0.01
+        await worker.mark_token_rate_limited("tok-b", "usage exceeds frequency limit")
+        key = f"token:{worker.token_statuses['tok-b'].digest}"
+        await wait_for(lambda: worker.shared.get(key) is not None)
+
+        await server.close()
+        await wait_for(lambda: not worker.shared.connected)
+        restarted = SharedStateServer(server.socket_path)
+        await restarted.start()
+        await wait_for(lambda: key in restarted.data)
+        assert worker.available_tokens == ["tok-a"]
+        assert restarted.data[key]["error_count"] == 1
+        await worker.close()
+        await restarted.close()
+
+    run_with_server(scenario)
+
+
+def test_slow_subscriber_disconnected():
+    """测试不读取推送的订阅者在缓冲超过上限后被断开，sidecar内存不会无限增长"""
+    async def scenario():
+        with tempfile.TemporaryDirectory() as workdir:
+            server = SharedStateServer(os.path.join(workdir, "state.sock"), max_subscriber_buffer=256 * 1024)
+            await server.start()
+            reader, writer = await asyncio.open_unix_connection(server.socket_path)
+            writer.write(b'{"id": 0, "op": "subscribe"}\n')
+            await writer.drain()
+            await reader.readline()
+            assert len(server.subscribers) == 1
+
+            client = SharedStateClient(server.socket_path)
+            await client.connect()
+            for i in range(64):
+                await client.set("blob", "x" * 64 * 1024 + str(i))
+            # 正常读取的订阅者不受影响
+            assert len(server.subscribers) == 1
+            await wait_for(lambda: client.get("blob", "").endswith("63"))
+            await client.close()
+            writer.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_token_state_survives_unavailable_sidecar():
+    """测试sidecar不存在或不响应时，标记限流和恢复只在本地生效，请求不报错也不被阻塞"""
+    async def hanging(reader, writer):
+        await reader.read()
+
+    async def scenario():
+        with tempfile.TemporaryDirectory() as workdir:
+            tokens = ["tok-a", "tok-b"]
+            dead = make_manager(tokens, [], {})
+            dead.shared = SharedStateClient(os.path.join(workdir, "missing.sock"))
+
+            server = await asyncio.start_unix_server(hanging, path=os.path.join(workdir, "hang.sock"))
+            stuck = make_manager(tokens, [], {})
+            stuck.shared = SharedStateClient(os.path.join(workdir, "hang.sock"))
+
+            for manager in (dead, stuck):
+                start = time.perf_counter()
+                await manager.mark_token_rate_limited("tok-b", "usage exceeds frequency limit")
+                assert manager.available_tokens == ["tok-a"]
+                manager.token_statuses["tok-b"].reset_time = time.time() - 1
+                manager._last_check_time = 0
+                assert {await manager.get_next_token() for _ in range(4)} == {"tok-a", "tok-b"}
+                assert time.perf_counter() - start < 0.05
+                await manager.close()
+            server.close()
+
+    with mock.patch.object(main, "SHARED_STATE_TIMEOUT", 0.05):
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_clients_see_changes()
+    test_rate_limit_shared_between_workers()
+    test_reconnect_after_sidecar_restart()
+    test_rate_limit_survives_sidecar_restart()
+    test_slow_subscriber_disconnected()
+    test_token_state_survives_unavailable_sidecar()
+    print("✅ 共享状态测试全部通过")
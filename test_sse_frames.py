@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+测试Anthropic SSE帧模板与逐字节golden输出
+"""
+
+import asyncio
+import glob
+import json
+import random
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+import sse_frames
+from sse_frames import sse_frame
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures")
+
+SPECIAL_STRINGS = [
+    "", "a", "你好", "\"quoted\"", "back\\slash", "\n\r\t\b\f", "\x00\x01\x1f\x7f",
+    "</script>", "emoji 🚀", "  ", "\ud800lone surrogate", "{\"partial\": ",
+]
+
+
+def random_strings(count: int):
+    rng = random.Random(1234)
+    alphabet = [chr(c) for c in range(0, 0x80)] + list("äöü中文字符🚀 \ud83d")
+    for _ in range(count):
+        yield "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 24)))
+
+
+def test_templates_match_full_serialization():
+    """测试每种模板与完整序列化结果逐字节一致"""
+    for index in (0, 1, 7, 300):
+        assert sse_frames.text_block_start(index) == sse_frame(
+            "content_block_start",
+            {'type': 'content_block_start', 'index': index, 'content_block': {'type': 'text', 'text': ''}})
+        assert sse_frames.block_stop(index) == sse_frame(
+            "content_block_stop", {'type': 'content_block_stop', 'index': index})
+
+        for text in SPECIAL_STRINGS + list(random_strings(200)):
+            assert sse_frames.text_delta(index, text) == sse_frame(
+                "content_block_delta",
+                {'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': text}})
+            assert sse_frames.input_json_delta(index, text) == sse_frame(
+                "content_block_delta",
+                {'type': 'content_block_delta', 'index': index,
+                 'delta': {'type': 'input_json_delta', 'partial_json': text}})
+            assert sse_frames.tool_use_block_start(index, "toolu_" + text, text) == sse_frame(
+                "content_block_start",
+                {'type': 'content_block_start', 'index': index,
+                 'content_block': {'type': 'tool_use', 'id': "toolu_" + text, 'name': text, 'input': {}}})
+
+    for stop_reason in ("end_turn", "max_tokens", "tool_use", None):
+        usage = {"input_tokens": 12, "output_tokens": 34}
+        assert sse_frames.message_delta(stop_reason, usage) == sse_frame(
+            "message_delta",
+            {'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})
+
+    assert sse_frames.PING == sse_frame("ping", {'type': 'ping'})
+    assert sse_frames.MESSAGE_STOP == sse_frame("message_stop", {'type': 'message_stop'})
+
+
+def test_split_and_merge_deltas():
+    """测试增量帧拆分后按字节合并，与拼接文本后再序列化的帧内容一致"""
+    def payload(frame: bytes):
+        # 含孤立代理项的字符串整体按ASCII转义，字节可能不同，比较解析后的内容
+        return json.loads(frame.split(b"\ndata: ", 1)[1])
+
+    strings = SPECIAL_STRINGS + list(random_strings(100))
+    for render in (sse_frames.text_delta, sse_frames.input_json_delta):
+        for index in (0, 12):
+            for first, second in zip(strings, reversed(strings)):
+                head, literal, tail = sse_frames.split_delta(render(index, first))
+                following = sse_frames.split_delta(render(index, second))
+                assert following[0] == head and following[2] == tail
+                merged = head + sse_frames.merge_delta(literal, following[1]) + tail
+                assert payload(merged) == payload(render(index, first + second))
+
+    # 前缀区分增量类型和index
+    assert sse_frames.split_delta(sse_frames.text_delta(0, "a"))[0] != sse_frames.split_delta(sse_frames.text_delta(1, "a"))[0]
+    assert sse_frames.split_delta(sse_frames.text_delta(0, "a"))[0] != \
+        sse_frames.split_delta(sse_frames.input_json_delta(0, "a"))[0]
+    # 其他帧和多帧拼在一起的chunk不拆分
+    for frame in (sse_frames.block_stop(0), sse_frames.text_block_start(0), sse_frames.PING,
+                  sse_frames.text_delta(0, "a") + sse_frames.text_delta(0, "b"), b"data: [DONE]\n\n"):
+        assert sse_frames.split_delta(frame) is None
+
+
+def test_stream_openai_to_anthropic_golden():
+    """测试转换器输出与录制的golden文件逐字节一致"""
+    import format_proxy
+
+    class FixedUUID:
+        hex = "0" * 32
+
+    original_uuid4 = format_proxy.uuid.uuid4
+    format_proxy.uuid.uuid4 = lambda: FixedUUID()
+    try:
+        async def convert(body: bytes) -> bytes:
+            response = httpx.Response(200, content=body)
+            return b"".join([frame async for frame in format_proxy.stream_openai_to_anthropic(response)])
+
+        fixtures = sorted(glob.glob(os.path.join(FIXTURE_DIR, "openai_stream_*.sse")))
+        assert fixtures
+        for path in fixtures:
+            with open(path, "rb") as f:
+                output = asyncio.run(convert(f.read()))
+            with open(path[:-len(".sse")] + ".golden", "rb") as f:
+                assert output == f.read(), os.path.basename(path)
+    finally:
+        format_proxy.uuid.uuid4 = original_uuid4
+
+
+if __name__ == "__main__":
+    test_templates_match_full_serialization()
+    test_split_and_merge_deltas()
+    test_stream_openai_to_anthropic_golden()
+    print("✅ SSE帧模板测试全部通过")
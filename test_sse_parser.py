@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+测试增量SSE解析器
+"""
+
+import asyncio
+import random
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sse_parser import SSEParser, aiter_sse_events
+
+
+SAMPLE = (
+    b": keep-alive comment\n"
+    b"event: message_start\n"
+    b"data: {\"type\": \"message_start\"}\n"
+    b"\n"
+    b"id: 42\r\n"
+    b"retry: 1500\r\n"
+    b"data: line one\r\n"
+    b"data: line two\r\n"
+    b"\r\n"
+    b"data: lone cr\r\r"
+    b"event: only-event-no-data\n"
+    b"\n"
+    b"data\n"
+    b"\n"
+    b"data: [DONE]\n"
+    b"\n"
+)
+
+
+def parse_all(chunks):
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.flush())
+    return [(e.event, e.data, e.id, e.retry) for e in events]
+
+
+def test_fields_and_line_endings():
+    """测试字段解析和各种行结束符"""
+    events = parse_all([SAMPLE])
+    assert events == [
+        ("message_start", b"{\"type\": \"message_start\"}", None, None),
+        (None, b"line one\nline two", "42", 1500),
+        (None, b"lone cr", "42", 1500),
+        (None, b"", "42", 1500),
+        (None, b"[DONE]", "42", 1500),
+    ]
+
+
+def test_arbitrary_chunk_boundaries():
+    """测试事件跨chunk拆分时结果不变"""
+    expected = parse_all([SAMPLE])
+    assert parse_all([SAMPLE[i:i + 1] for i in range(len(SAMPLE))]) == expected
+
+    rng = random.Random(7)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(SAMPLE)), rng.randint(1, 12)))
+        chunks = [SAMPLE[a:b] for a, b in zip([0] + cuts, cuts + [len(SAMPLE)])]
+        assert parse_all(chunks) == expected
+
+
+def test_flush_without_trailing_blank_line():
+    """测试上游未以空行结束时最后一个事件仍被分发"""
+    assert parse_all([b"data: tail"]) == [(None, b"tail", None, None)]
+    assert parse_all([b"data: a\n\ndata: b\r"]) == [(None, b"a", None, None), (None, b"b", None, None)]
+
+
+def test_encode_roundtrip():
+    """测试事件重新序列化后可以被再次解析"""
+    parser = SSEParser()
+    events = parser.feed(SAMPLE) + parser.flush()
+    encoded = b"".join(e.encode() for e in events)
+    assert parse_all([encoded]) == parse_all([SAMPLE])
+
+
+def test_async_iteration():
+    """测试异步字节流接口"""
+    async def byte_stream():
+        for i in range(0, len(SAMPLE), 5):
+            yield SAMPLE[i:i + 5]
+
+    async def collect():
+        return [e.data async for e in aiter_sse_events(byte_stream())]
+
+    assert asyncio.run(collect())[-1] == b"[DONE]"
+
+
+def test_long_line_scanned_once():
+    """测试长行分多块到达时只扫描新到的字节，CR 在块末尾时等待下一块"""
+    parser = SSEParser()
+    payload = b"x" * (1024 * 1024)
+    line = b"data: " + payload
+    for i in range(0, len(line), 100):
+        assert parser.feed(line[i:i + 100]) == []
+        assert parser._scan_pos == len(parser._buffer)
+    assert parser.feed(b"\r") == []
+    assert parser._scan_pos == len(parser._buffer) - 1
+    events = parser.feed(b"\n\r\n")
+    assert [event.data for event in events] == [payload]
+    assert parser._scan_pos == 0 and not parser._buffer
+
+
+if __name__ == "__main__":
+    test_fields_and_line_endings()
+    test_arbitrary_chunk_boundaries()
+    test_flush_without_trailing_blank_line()
+    test_encode_roundtrip()
+    test_async_iteration()
+    test_long_line_scanned_once()
+    print("✅ SSE解析器测试全部通过")
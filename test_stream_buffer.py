@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+测试流式响应的有界缓冲：顺序、高水位暂停、暂停计数、提前关闭和增量合并
+"""
+
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+import metrics
+import sse_frames
+from sse_parser import SSEParser
+from stream_buffer import Coalescing, StreamBuffer, buffered
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures")
+
+
+def test_passes_through_in_order():
+    """测试数据按顺序输出，str 按UTF-8编码，空块跳过，上游异常传给客户端"""
+    async def source():
+        yield b"data: 1\n\n"
+        yield ""
+        yield "data: 你好\n\n"
+
+    async def failing():
+        yield b"a"
+        raise RuntimeError("upstream reset")
+
+    async def collect(iterable):
+        return [chunk async for chunk in iterable]
+
+    chunks = asyncio.run(collect(buffered(source(), "test_order", high_water=1024)))
+    assert b"".join(chunks) == "data: 1\n\ndata: 你好\n\n".encode("utf-8")
+
+    try:
+        asyncio.run(collect(buffered(failing(), "test_order", high_water=1024)))
+        assert False, "应该抛出上游异常"
+    except RuntimeError as e:
+        assert str(e) == "upstream reset"
+
+    plain = source()
+    assert buffered(plain, "test_order", high_water=0) is plain
+
+
+def test_slow_reader_pauses_upstream():
+    """测试慢客户端时缓冲不超过高水位加一块，上游暂停并计数，积压的数据合并为一次写入"""
+    produced = []
+
+    async def source():
+        for i in range(100):
+            produced.append(i)
+            yield b"x" * 1000
+
+    async def slow_reader(buffer):
+        writes = []
+        async for chunk in buffer:
+            # 每次写入时上游最多领先高水位
+            assert len(produced) * 1000 - sum(writes) - len(chunk) <= 4000
+            writes.append(len(chunk))
+            await asyncio.sleep(0.002)
+        return writes
+
+    buffer = StreamBuffer(source(), 4000, "test_slow")
+    writes = asyncio.run(slow_reader(buffer))
+    assert sum(writes) == 100 * 1000
+    assert len(writes) < 100 and max(writes) == 4000
+    assert buffer.peak_bytes == 4000 and buffer.stalls > 0 and buffer.stalled_seconds > 0
+    assert metrics.STALLED_STREAMS.labels("test_slow").value == 1
+    assert metrics.STREAM_BUFFER_STALLS.labels("test_slow").value == buffer.stalls
+    assert metrics.STREAM_BUFFER_BYTES.labels("test_slow").value == 0
+
+
+def test_client_close_stops_upstream():
+    """测试客户端提前关闭时停止读取上游，并运行上游生成器的 finally"""
+    closed = asyncio.Event()
+
+    async def source():
+        try:
+            while True:
+                yield b"y" * 100
+        finally:
+            closed.set()
+
+    async def scenario():
+        stream = aiter(StreamBuffer(source(), 1000, "test_close"))
+        assert await anext(stream)
+        await asyncio.sleep(0.01)
+        await stream.aclose()
+        return closed.is_set()
+
+    assert asyncio.run(scenario())
+    assert metrics.STREAM_BUFFER_BYTES.labels("test_close").value == 0
+
+
+def merged_events(data: bytes):
+    """解析SSE输出，并把同一内容块相邻的同类增量合并，用于比较合并前后的事件序列"""
+    events = []
+    for event in SSEParser().feed(data):
+        payload = json.loads(event.data) if event.data != b"[DONE]" else None
+        last = events[-1][1] if events else None
+        if (payload and payload.get("type") == "content_block_delta" and last
+                and last.get("type") == "content_block_delta" and last["index"] == payload["index"]
+                and last["delta"]["type"] == payload["delta"]["type"]):
+            field = "text" if payload["delta"]["type"] == "text_delta" else "partial_json"
+            last["delta"][field] += payload["delta"][field]
+        else:
+            events.append((event.event, payload))
+    return events
+
+
+def test_coalescing_keeps_event_sequence():
+    """测试合并增量后事件序列与不合并时一致"""
+    import format_proxy
+
+    async def convert(body: bytes, coalesce):
+        response = httpx.Response(200, content=body)
+        source = format_proxy.stream_openai_to_anthropic(response)
+        buffer = StreamBuffer(source, 64 * 1024, "test_coalesce", coalesce=coalesce)
+        return [chunk async for chunk in buffer], buffer
+
+    class FixedUUID:
+        hex = "0" * 32
+
+    original_uuid4 = format_proxy.uuid.uuid4
+    format_proxy.uuid.uuid4 = lambda: FixedUUID()
+    coalesced = 0
+    try:
+        fixtures = sorted(glob.glob(os.path.join(FIXTURE_DIR, "openai_stream_*.sse")))
+        assert fixtures
+        for path in fixtures:
+            with open(path, "rb") as f:
+                body = f.read()
+            plain, _ = asyncio.run(convert(body, None))
+            chunks, buffer = asyncio.run(convert(body, Coalescing(0.05, 1 << 20)))
+            assert merged_events(b"".join(chunks)) == merged_events(b"".join(plain)), os.path.basename(path)
+            assert buffer.writes == len(chunks) <= len(plain)
+            coalesced += buffer.coalesced
+            # 合并后不会再有同一内容块相邻的同类增量帧
+            events = SSEParser().feed(b"".join(chunks))
+            assert len(events) == len(merged_events(b"".join(chunks)))
+    finally:
+        format_proxy.uuid.uuid4 = original_uuid4
+    assert coalesced > 0
+
+
+def test_coalescing_flushes_on_window_boundary_and_budget():
+    """测试合并窗口到期、块边界和字节预算时立即写出"""
+    async def source(frames):
+        for frame, pause in frames:
+            yield frame
+            await asyncio.sleep(pause)
+
+    async def timed_writes(frames, coalesce):
+        started = time.perf_counter()
+        writes = []
+        async for chunk in StreamBuffer(source(frames), 64 * 1024, "test_coalesce_flush", coalesce=coalesce):
+            writes.append((time.perf_counter() - started, chunk))
+        return writes
+
+    delta = sse_frames.text_delta
+    # 上游停顿时，已有的增量最多等一个窗口
+    writes = asyncio.run(timed_writes([(delta(0, "a"), 0), (delta(0, "b"), 0.3), (delta(0, "c"), 0)],
+                                      Coalescing(0.02, 1024)))
+    assert writes[0][1] == delta(0, "ab") and writes[0][0] < 0.2
+    assert writes[-1][1] == delta(0, "c")
+
+    # 块边界立即写出，不等窗口
+    writes = asyncio.run(timed_writes([(delta(0, "a"), 0), (sse_frames.block_stop(0), 0.3),
+                                       (delta(1, "b"), 0)], Coalescing(1.0, 1024)))
+    assert writes[0][1] == delta(0, "a") + sse_frames.block_stop(0) and writes[0][0] < 0.2
+    assert writes[-1][1] == delta(1, "b")
+
+    # 达到字节预算立即写出
+    frames = [(delta(0, "x" * 100), 0)] * 5 + [(delta(0, "y"), 0.3)]
+    writes = asyncio.run(timed_writes(frames, Coalescing(1.0, 300)))
+    assert writes[0][0] < 0.2 and 300 <= len(writes[0][1]) < 600
+    assert json.loads(writes[0][1].split(b"data: ")[1])["delta"]["text"] == "x" * 200
+
+
+if __name__ == "__main__":
+    test_passes_through_in_order()
+    test_slow_reader_pauses_upstream()
+    test_client_close_stops_upstream()
+    test_coalescing_keeps_event_sequence()
+    test_coalescing_flushes_on_window_boundary_and_budget()
+    print("✅ 流式响应缓冲测试全部通过")
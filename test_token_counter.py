@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+测试带缓存的token计数
+"""
+
+import asyncio
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_codec
+import token_counter
+from metrics import Histogram, render
+from token_counter import TokenCounter, count_message
+
+
+class FakeEncoding:
+    """按空白切分的假编码器，记录编码调用次数（测试环境无法下载tiktoken词表）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+
+    def encode(self, text: str):
+        self.calls += 1
+        return text.split()
+
+
+class SlowEncoding(FakeEncoding):
+    """每次编码占用CPU一段时间（time.sleep模拟），用于检查事件循环是否被阻塞"""
+
+    def encode(self, text: str):
+        time.sleep(0.02)
+        return super().encode(text)
+
+
+def make_counter(max_entries: int = 100, encoding_class=FakeEncoding):
+    loaded = {}
+
+    def load(name):
+        loaded[name] = encoding_class(name)
+        return loaded[name]
+
+    counter = TokenCounter(max_entries=max_entries, load_encoding=load,
+                           encoding_name=lambda model: "o200k_base" if model.startswith("gpt-4o") else "cl100k_base")
+    return counter, loaded
+
+
+def conversation(turns: int):
+    messages = [{"role": "system", "content": "you are a helpful assistant"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question number {i} please"})
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": f"answer {i}"}],
+                         "tool_calls": [{"function": {"name": "lookup", "arguments": '{"q": 1}'}}]})
+    return messages
+
+
+def test_matches_uncached_count():
+    """测试缓存命中与否结果都与逐条计算一致"""
+    counter, loaded = make_counter()
+    messages = conversation(5)
+    first = counter.count_messages(messages, "gpt-4")
+    expected = 2 + sum(count_message(loaded["cl100k_base"], m) for m in messages)
+    assert first == expected
+    assert counter.count_messages(messages, "gpt-4") == expected
+    assert counter.hits == len(messages)
+
+
+def test_growing_conversation_encodes_only_tail():
+    """测试对话增长时只编码新增的消息"""
+    counter, loaded = make_counter()
+    counter.count_messages(conversation(10), "claude-3")
+    encoding = loaded["cl100k_base"]
+    calls = encoding.calls
+    counter.count_messages(conversation(11), "claude-3")
+    # 新增一轮：user(角色+内容) + assistant(角色+文本+工具名+参数)
+    assert encoding.calls - calls == 2 + 4
+    assert counter.get_stats()["hit_rate"] > 0.4
+
+
+def test_encoders_loaded_once_per_encoding():
+    """测试编码器按名称只加载一次，不同编码器的计数互不混用"""
+    counter, loaded = make_counter()
+    counter.preload(["cl100k_base"])
+    first = loaded["cl100k_base"]
+    counter.count_messages(conversation(1), "gpt-4")
+    counter.count_messages(conversation(1), "gpt-3.5-turbo")
+    assert loaded["cl100k_base"] is first
+    counter.count_messages(conversation(1), "gpt-4o")
+    assert sorted(counter.get_stats()["encodings"]) == ["cl100k_base", "o200k_base"]
+    assert counter.get_stats()["entries"] == 2 * len(conversation(1))
+
+
+def test_lru_eviction():
+    """测试超过上限时淘汰最久未使用的条目并更新字节统计"""
+    counter, _ = make_counter(max_entries=3)
+    messages = [{"role": "user", "content": f"m{i}"} for i in range(5)]
+    counter.count_messages(messages[:3], "gpt-4")
+    counter.count_messages(messages[:1], "gpt-4")  # m0 变为最近使用
+    counter.count_messages(messages[3:4], "gpt-4")  # 淘汰 m1
+    stats = counter.get_stats()
+    assert stats["entries"] == 3 and stats["evictions"] == 1
+    hits = counter.hits
+    counter.count_messages(messages[:1], "gpt-4")
+    assert counter.hits == hits + 1
+    counter.count_messages(messages[1:2], "gpt-4")
+    assert counter.hits == hits + 1
+
+    assert counter.cached_bytes == sum(len(json_codec.dumps(m)) for m in [messages[0], messages[3], messages[1]])
+
+
+def test_cache_disabled():
+    """测试 max_entries=0 时不缓存"""
+    counter, loaded = make_counter(max_entries=0)
+    counter.count_messages(conversation(2), "gpt-4")
+    counter.count_messages(conversation(2), "gpt-4")
+    assert counter.get_stats()["entries"] == 0 and counter.hits == 0
+
+
+def test_small_inputs_stay_inline():
+    """测试小输入走内联快速路径，不创建编码池"""
+    counter, _ = make_counter()
+    counter.inline_bytes = 1 << 20
+    total = asyncio.run(counter.count_messages_async(conversation(3), "gpt-4"))
+    assert total == counter.count_messages(conversation(3), "gpt-4")
+    assert counter.inline_encodes == 1 and counter._executor is None
+    assert counter.get_stats()["encode_seconds"]["count"] == 1
+
+
+def test_large_inputs_offloaded_and_batched():
+    """测试大输入交给编码池时事件循环不被阻塞，并发请求的消息合并为一批"""
+    counter, loaded = make_counter(encoding_class=SlowEncoding)
+    counter.inline_bytes = 0
+    counter.batch_window = 0.05
+    requests = [[{"role": "user", "content": f"request {r} " + "word " * 1000}] for r in range(4)]
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        results = await asyncio.gather(*(counter.count_messages_async(m, "gpt-4") for m in requests))
+        task.cancel()
+        return results, ticks
+
+    try:
+        results, ticks = asyncio.run(run())
+    finally:
+        counter.shutdown()
+
+    expected = [2 + count_message(FakeEncoding("x"), m[0]) for m in requests]
+    assert results == expected
+    assert counter.batches == 1 and counter.offloaded_messages == 4
+    assert counter.get_stats()["encode_seconds"]["count"] == 1
+    # 4条消息×2次编码×20ms 在池中执行，期间ticker应持续运行
+    assert ticks >= 10, ticks
+    # 结果已写入缓存
+    assert asyncio.run(counter.count_messages_async(requests[0], "gpt-4")) == expected[0]
+    assert counter.batches == 1
+
+
+def test_histogram():
+    """测试直方图累计计数和分位数估算"""
+    histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in (0.005, 0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value)
+    data = histogram.to_dict()
+    assert data["buckets"] == {"0.01": 1, "0.1": 3, "1.0": 4, "+Inf": 5}
+    assert data["p50"] == 0.1 and data["p99"] == 1.0
+
+
+def test_metrics_export():
+    """测试 /metrics 输出token计数缓存的命中、内存占用和编码耗时"""
+    counter, _ = make_counter()
+    original, token_counter.token_counter = token_counter.token_counter, counter
+    try:
+        counter.count_messages(conversation(1))
+        counter.count_messages(conversation(2))
+        text = render()
+    finally:
+        token_counter.token_counter = original
+    assert "cb2api_token_cache_hits_total 3" in text
+    assert "cb2api_token_cache_misses_total 5" in text
+    assert f"cb2api_token_cache_bytes {counter.cached_bytes}" in text
+    assert 'cb2api_token_encode_seconds_bucket{le="+Inf"} 2' in text
+    assert "cb2api_token_encode_seconds_count 2" in text
+
+
+if __name__ == "__main__":
+    test_matches_uncached_count()
+    test_growing_conversation_encodes_only_tail()
+    test_encoders_loaded_once_per_encoding()
+    test_lru_eviction()
+    test_cache_disabled()
+    test_small_inputs_stay_inline()
+    test_large_inputs_offloaded_and_batched()
+    test_histogram()
+    test_metrics_export()
+    print("✅ token计数缓存测试全部通过")
@@ -0,0 +1,354 @@
+"""
+带缓存的token计数
+
+Agent客户端会用不断增长的同一段对话反复调用 count_tokens，每次都从头编码所有消息代价很高。
+这里把编码器按模型缓存，并以单条消息的内容哈希为键缓存其token数（LRU淘汰），
+对话增长时只需要编码新增的尾部消息。
+
+在异步处理函数中使用 count_messages_async：未命中缓存的内容较小时直接在事件循环中编码，
+较大时交给线程池/进程池，并与同一时间窗口内其他请求的消息合并成一批提交，避免阻塞其他流。
+
+环境变量:
+    TOKEN_CACHE_SIZE        缓存的消息条数上限（默认10000，0表示关闭缓存）
+    TOKEN_PRELOAD_ENCODINGS 启动时预加载的编码器，逗号分隔（默认cl100k_base）
+    TOKEN_POOL_KIND         编码池类型 thread / process（默认thread，tiktoken编码时会释放GIL）
+    TOKEN_POOL_WORKERS      编码池大小（默认min(4, CPU数)）
+    TOKEN_INLINE_BYTES      未命中内容不超过该字节数时在事件循环内直接编码（默认16384）
+    TOKEN_BATCH_WINDOW_MS   合并并发请求的等待窗口毫秒数（默认2）
+    TOKEN_BATCH_MAX_BYTES   单批内容达到该字节数时立即提交（默认1048576）
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import json_codec
+import metrics
+from metrics import Histogram, render_histogram
+
+try:
+    import tiktoken
+    from tiktoken.model import encoding_name_for_model
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    tiktoken = None
+    TIKTOKEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+# 消息的基础开销（角色标识等）和整段对话的额外开销
+MESSAGE_OVERHEAD = 4
+CONVERSATION_OVERHEAD = 2
+IMAGE_TOKENS = 85
+
+
+def _default_encoding_name(model: str) -> str:
+    try:
+        return encoding_name_for_model(model)
+    except KeyError:
+        # 如果模型不支持，使用默认编码器
+        return DEFAULT_ENCODING
+
+
+class TokenCounter:
+    """按模型缓存编码器，按消息内容哈希缓存token数"""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        load_encoding: Optional[Callable[[str], Any]] = None,
+        encoding_name: Optional[Callable[[str], str]] = None,
+    ):
+        if max_entries is None:
+            max_entries = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+        self.max_entries = max_entries
+        self._load_encoding = load_encoding or (tiktoken.get_encoding if tiktoken else None)
+        self._encoding_name = encoding_name or _default_encoding_name
+
+        self._encodings: Dict[str, Any] = {}
+        self._model_encodings: Dict[str, str] = {}
+        # (编码器名, 消息哈希) -> (token数, 消息序列化字节数)
+        self._cache: "OrderedDict[Tuple[str, bytes], Tuple[int, int]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cached_bytes = 0
+
+        self.pool_kind = os.getenv("TOKEN_POOL_KIND", "thread").lower()
+        self.pool_workers = int(os.getenv("TOKEN_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.inline_bytes = int(os.getenv("TOKEN_INLINE_BYTES", "16384"))
+        self.batch_window = float(os.getenv("TOKEN_BATCH_WINDOW_MS", "2")) / 1000.0
+        self.batch_max_bytes = int(os.getenv("TOKEN_BATCH_MAX_BYTES", str(1024 * 1024)))
+        self._executor: Optional[Executor] = None
+        self._batchers: Dict[str, "_EncodeBatcher"] = {}
+
+        # 编码耗时（秒），内联编码按请求、池内编码按批次记录
+        self.encode_seconds = Histogram()
+        self.inline_encodes = 0
+        self.offloaded_messages = 0
+        self.batches = 0
+
+    @property
+    def available(self) -> bool:
+        return self._load_encoding is not None
+
+    def preload(self, names: Optional[List[str]] = None) -> None:
+        """启动时加载编码器，避免第一个请求承担加载（可能包括下载）开销"""
+        if names is None:
+            names = [n.strip() for n in os.getenv("TOKEN_PRELOAD_ENCODINGS", DEFAULT_ENCODING).split(",") if n.strip()]
+        for name in names:
+            try:
+                self._get_encoding(name)
+                logger.info(f"已预加载tiktoken编码器: {name}")
+            except Exception as e:
+                logger.warning(f"预加载tiktoken编码器 {name} 失败，将在首次使用时重试: {e}")
+
+    def _get_encoding(self, name: str):
+        encoding = self._encodings.get(name)
+        if encoding is None:
+            encoding = self._encodings[name] = self._load_encoding(name)
+        return encoding
+
+    def encoding_for_model(self, model: str):
+        name = self._model_encodings.get(model)
+        if name is None:
+            name = self._model_encodings[model] = self._encoding_name(model)
+        return name, self._get_encoding(name)
+
+    def count_messages(self, messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
+        """计算OpenAI格式消息列表的token数（同步，在当前线程编码）"""
+        name, encoding = self.encoding_for_model(model)
+        counts, misses = self._lookup(name, messages)
+        if misses:
+            start = time.perf_counter()
+            tokens = [count_message(encoding, messages[i]) for i, _, _ in misses]
+            self.encode_seconds.observe(time.perf_counter() - start)
+            self.inline_encodes += 1
+            self._store(misses, tokens, counts)
+        return CONVERSATION_OVERHEAD + sum(counts)
+
+    async def count_messages_async(self, messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
+        """计算token数；未命中缓存的内容较大时交给编码池，不阻塞事件循环"""
+        name, encoding = self.encoding_for_model(model)
+        counts, misses = self._lookup(name, messages)
+        if misses:
+            size = sum(n for _, _, n in misses)
+            if size <= self.inline_bytes or self.pool_workers <= 0:
+                start = time.perf_counter()
+                tokens = [count_message(encoding, messages[i]) for i, _, _ in misses]
+                self.encode_seconds.observe(time.perf_counter() - start)
+                self.inline_encodes += 1
+            else:
+                batcher = self._batchers.get(name)
+                if batcher is None:
+                    batcher = self._batchers[name] = _EncodeBatcher(self, name, encoding)
+                tokens = await batcher.submit([messages[i] for i, _, _ in misses], size)
+                self.offloaded_messages += len(misses)
+            self._store(misses, tokens, counts)
+        return CONVERSATION_OVERHEAD + sum(counts)
+
+    def _lookup(self, name: str, messages: List[Dict[str, Any]]):
+        """返回 (每条消息的token数，未命中为0, [(下标, 缓存键, 字节数)])"""
+        counts = [0] * len(messages)
+        misses: List[Tuple[int, Optional[Tuple[str, bytes]], int]] = []
+        for i, message in enumerate(messages):
+            raw = json_codec.dumps(message)
+            if self.max_entries <= 0:
+                misses.append((i, None, len(raw)))
+                continue
+            key = (name, hashlib.blake2b(raw, digest_size=16).digest())
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                counts[i] = cached[0]
+            else:
+                self.misses += 1
+                misses.append((i, key, len(raw)))
+        return counts, misses
+
+    def _store(self, misses, tokens: List[int], counts: List[int]) -> None:
+        for (i, key, size), value in zip(misses, tokens):
+            counts[i] = value
+            if key is None:
+                continue
+            if key not in self._cache:
+                self.cached_bytes += size
+            self._cache[key] = (value, size)
+        while len(self._cache) > self.max_entries:
+            _, (_, size) = self._cache.popitem(last=False)
+            self.cached_bytes -= size
+            self.evictions += 1
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.pool_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_workers, thread_name_prefix="tiktoken")
+            logger.info(f"创建token编码池: {self.pool_kind} x {self.pool_workers}")
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.cached_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "encodings": sorted(self._encodings),
+            "entries": len(self._cache),
+            "max_entries": self.max_entries,
+            "cached_bytes": self.cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "pool": {"kind": self.pool_kind, "workers": self.pool_workers},
+            "inline_encodes": self.inline_encodes,
+            "offloaded_messages": self.offloaded_messages,
+            "batches": self.batches,
+            "encode_seconds": self.encode_seconds.to_dict(),
+        }
+
+
+def count_message(encoding, message: Dict[str, Any]) -> int:
+    """计算单条消息的token数（不含对话整体开销）"""
+    tokens = MESSAGE_OVERHEAD
+
+    tokens += len(encoding.encode(message.get("role", "")))
+
+    content = message.get("content", "")
+    if isinstance(content, str):
+        tokens += len(encoding.encode(content))
+    elif isinstance(content, list):
+        # 处理多模态内容
+        for item in content:
+            if item.get("type") == "text":
+                tokens += len(encoding.encode(item.get("text", "")))
+            elif item.get("type") == "image_url":
+                # 图片token计算（简化处理）
+                tokens += IMAGE_TOKENS
+
+    # 处理工具调用
+    if message.get("tool_calls"):
+        for tool_call in message["tool_calls"]:
+            if "function" in tool_call:
+                func = tool_call["function"]
+                tokens += len(encoding.encode(func.get("name", "")))
+                tokens += len(encoding.encode(func.get("arguments", "")))
+
+    return tokens
+
+
+def _encode_batch(encoding, messages: List[Dict[str, Any]]) -> Tuple[List[int], float]:
+    start = time.perf_counter()
+    tokens = [count_message(encoding, message) for message in messages]
+    return tokens, time.perf_counter() - start
+
+
+# 进程池worker内按名称缓存的编码器
+_worker_encodings: Dict[str, Any] = {}
+
+
+def _encode_batch_in_process(name: str, messages: List[Dict[str, Any]]) -> Tuple[List[int], float]:
+    encoding = _worker_encodings.get(name)
+    if encoding is None:
+        encoding = _worker_encodings[name] = tiktoken.get_encoding(name)
+    return _encode_batch(encoding, messages)
+
+
+class _EncodeBatcher:
+    """把同一编码器下并发请求的未命中消息合并成一批提交到编码池"""
+
+    def __init__(self, counter: TokenCounter, name: str, encoding):
+        self.counter = counter
+        self.name = name
+        self.encoding = encoding
+        self._pending: List[Tuple[List[Dict[str, Any]], asyncio.Future]] = []
+        self._pending_bytes = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, messages: List[Dict[str, Any]], size: int) -> List[int]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((messages, future))
+        self._pending_bytes += size
+        if self._pending_bytes >= self.counter.batch_max_bytes or self.counter.batch_window <= 0:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.counter.batch_window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch) -> None:
+        counter = self.counter
+        flat = [message for messages, _ in batch for message in messages]
+        loop = asyncio.get_running_loop()
+        try:
+            if counter.pool_kind == "process":
+                call = loop.run_in_executor(counter.executor, _encode_batch_in_process, self.name, flat)
+            else:
+                call = loop.run_in_executor(counter.executor, _encode_batch, self.encoding, flat)
+            tokens, elapsed = await call
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        counter.batches += 1
+        counter.encode_seconds.observe(elapsed)
+        offset = 0
+        for messages, future in batch:
+            if not future.done():
+                future.set_result(tokens[offset:offset + len(messages)])
+            offset += len(messages)
+
+
+token_counter = TokenCounter()
+
+
+def collect() -> List[str]:
+    """输出token计数缓存的命中、内存占用和编码耗时（Prometheus文本格式）"""
+    families = (
+        ("cb2api_token_cache_hits_total", "counter", "命中token计数缓存的消息数", "hits"),
+        ("cb2api_token_cache_misses_total", "counter", "未命中缓存、需要编码的消息数", "misses"),
+        ("cb2api_token_cache_evictions_total", "counter", "因条目数上限淘汰的消息数", "evictions"),
+        ("cb2api_token_cache_bytes", "gauge", "缓存消息的序列化字节数", "cached_bytes"),
+    )
+    lines = []
+    for name, kind, help_text, field in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {getattr(token_counter, field)}")
+    name = "cb2api_token_encode_seconds"
+    lines.append(f"# HELP {name} token编码耗时（内联编码按请求、池内编码按批次）")
+    lines.append(f"# TYPE {name} histogram")
+    lines.extend(render_histogram(name, {}, token_counter.encode_seconds))
+    return lines
+
+
+metrics.COLLECTORS.append(collect)